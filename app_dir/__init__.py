@@ -1,40 +1,87 @@
 import os
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
+import click
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
+from jinja2 import FileSystemBytecodeCache
 from config import Config
+from app_dir.routing import RoutingSQLAlchemy
+from app_dir.cache import UserCache, FragmentCache
+from app_dir.last_seen import LastSeenBuffer
+from app_dir.passwords import PasswordHasher, LoginThrottle
+from app_dir.ratelimit import RateLimiter
+from app_dir.sessions import ServerSessions
+from app_dir.instrumentation import Instrumentation
+from app_dir.suggestions import SuggestionEngine
 
 
-db = SQLAlchemy()
-migrate = Migrate()
+# GET 请求的查询可以发到只读副本，见 app_dir/routing.py
+db = RoutingSQLAlchemy()
 login = LoginManager()
 # 当匿名用户请求访问login_required修饰的端点时，在login_required修饰过的的
 # 函数内部，自动将用户重定向到login.login_view端点，同时在新请求的url后面
 # 添加？next=<url_for(原始请求的端点名称)>
 login.login_view = 'auth.login'
 login.login_message = 'Please log in to access this page.'
-mail = Mail()
+# Flask-Migrate 和 Flask-Mail 不在这里创建：前者只有 flask db 命令用到，在 create_app 里
+# 按需初始化；后者只有发邮件的 worker 用到，见 app_dir/email.py 的 get_mail()
 bootstrap = Bootstrap()
 moment = Moment()
+user_cache = UserCache()
+fragment_cache = FragmentCache()
+last_seen = LastSeenBuffer()
+password_hasher = PasswordHasher()
+login_throttle = LoginThrottle()
+rate_limiter = RateLimiter()
+# cookie 里只有 sid，session 数据存在服务端，见 app_dir/sessions.py
+server_sessions = ServerSessions()
+instrumentation = Instrumentation()
+suggestion_engine = SuggestionEngine()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     # Config不必实例化
     app.config.from_object(config_class)
+    # 在反向代理后面时 remote_addr 是代理的地址，按可信代理的层数从 X-Forwarded-For 取客户端 IP
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['TRUSTED_PROXIES'])
+    # 编译好的模板存到磁盘上，新启动的 worker 处理第一个请求时不用重新编译
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = dict(Flask.jinja_options, bytecode_cache=FileSystemBytecodeCache(
+            app.config['JINJA_BYTECODE_CACHE_DIR']))
 
     db.init_app(app)
-    migrate.init_app(app)
+    # Flask-Migrate 会导入 alembic，要几百毫秒，只在通过 flask 命令行加载应用时初始化
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     login.init_app(app)
-    mail.init_app(app)
+    server_sessions.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
+    user_cache.init_app(app)
+    fragment_cache.init_app(app)
+    last_seen.init_app(app)
+    password_hasher.init_app(app)
+    login_throttle.init_app(app)
+    rate_limiter.init_app(app)
+    instrumentation.init_app(app)
+    suggestion_engine.init_app(app)
+
+    from app_dir.translate import translator
+    translator.init_app(app)
+
+    from app_dir.search import search_index
+    search_index.init_app(app)
+
+    from app_dir.language import language_detector
+    language_detector.init_app(app)
 
     # 在404 和 500页面定义url_prefix意义不大，用户看到这些页面的情况
     # 都是flask重定向的，而且重定向后，地址栏不会更新显示url_prefix.
@@ -48,6 +95,9 @@ def create_app(config_class=Config):
     from app_dir.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app_dir.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
     if not app.debug and not app.testing:
         # 邮件错误输出
         if app.config['MAIL_SERVER']:
@@ -83,6 +133,11 @@ def create_app(config_class=Config):
         ))
         file_handler.setLevel(logging.INFO)
         app.logger.addHandler(file_handler)
+        # 开启 INSTRUMENTATION 时每个请求的统计日志也写进这个文件
+        if app.config['INSTRUMENTATION']:
+            request_logger = logging.getLogger('app_dir.instrumentation')
+            request_logger.addHandler(file_handler)
+            request_logger.setLevel(logging.INFO)
         # 针对应用本身
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog starup')
@@ -0,0 +1,7 @@
+from flask import Blueprint
+
+
+bp = Blueprint('api', __name__)
+
+
+from app_dir.api import errors, tokens, posts, users
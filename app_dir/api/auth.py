@@ -0,0 +1,42 @@
+from functools import wraps
+from flask import g, request
+from app_dir import login_throttle, rate_limiter
+from app_dir.api.errors import error_response
+from app_dir.models import User
+
+
+def basic_auth_required(f):
+    # 用户名和密码只用来换令牌，失败次数和网页登录共用 login_throttle
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth = request.authorization
+        if auth is None or not auth.username:
+            return error_response(401)
+        if login_throttle.is_blocked(auth.username, request.remote_addr):
+            return error_response(429, 'Too many failed login attempts.')
+        user = User.query.filter_by(username=auth.username).first()
+        if user is None or not user.check_password(auth.password):
+            login_throttle.record_failure(auth.username, request.remote_addr)
+            return error_response(401)
+        login_throttle.reset(auth.username)
+        g.api_user = user
+        rate_limiter.check_authenticated()
+        return f(*args, **kwargs)
+    # 速率按换到令牌的用户计数，由上面的 check_authenticated() 检查
+    decorated_function.ratelimit_after_auth = True
+    return decorated_function
+
+
+def token_auth_required(f):
+    # 请求头 Authorization: Bearer <token>
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = User.verify_api_token(token) if scheme.lower() == 'bearer' and token else None
+        if user is None:
+            return error_response(401)
+        g.api_user = user
+        rate_limiter.check_authenticated()
+        return f(*args, **kwargs)
+    decorated_function.ratelimit_after_auth = True
+    return decorated_function
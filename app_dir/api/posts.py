@@ -0,0 +1,63 @@
+from flask import jsonify, request, url_for, current_app
+from app_dir import db
+from app_dir.models import User, Post
+from app_dir.pagination import keyset_paginate
+from app_dir.api import bp
+from app_dir.api.auth import token_auth_required
+
+
+# API 直接查询需要的列，得到的是普通的行元组，不创建 ORM 对象，也就不会有
+# 按属性触发的懒加载；作者信息通过 JOIN 在同一条查询里取回
+def post_rows():
+    return db.session.query(
+        Post.id, Post.body, Post.timestamp, Post.language,
+        User.id.label('author_id'), User.username.label('author_username'),
+        User.email_digest.label('author_email_digest'),
+    ).join(User, User.id == Post.user_id)
+
+
+def avatar_url(digest, size):
+    return url_for('main.avatar', digest=digest, size=size, _external=True)
+
+
+def post_to_dict(row):
+    return {
+        'id': row.id,
+        'body': row.body,
+        'timestamp': row.timestamp.isoformat() + 'Z',
+        'language': row.language,
+        'author': {
+            'id': row.author_id,
+            'username': row.author_username,
+            'avatar': avatar_url(row.author_email_digest, 70),
+        },
+    }
+
+
+def paginated_posts(query, keys=None):
+    # 游标分页，参数和网页一样用 before/after；_links 里给出前后两页的完整地址
+    per_page = request.args.get('per_page', current_app.config['POSTS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+    page = keyset_paginate(query, per_page,
+                           before=request.args.get('before'),
+                           after=request.args.get('after'),
+                           keys=keys)
+    view_args = dict(request.view_args, per_page=per_page)
+    return jsonify({
+        'items': [post_to_dict(row) for row in page.items],
+        '_meta': {'per_page': per_page},
+        '_links': {
+            'self': url_for(request.endpoint, before=request.args.get('before'),
+                            after=request.args.get('after'), _external=True, **view_args),
+            'next': url_for(request.endpoint, before=page.next_cursor, _external=True, **view_args)
+            if page.has_next else None,
+            'prev': url_for(request.endpoint, after=page.prev_cursor, _external=True, **view_args)
+            if page.has_prev else None,
+        },
+    })
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth_required
+def get_posts():
+    return paginated_posts(post_rows())
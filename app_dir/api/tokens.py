@@ -0,0 +1,10 @@
+from flask import jsonify, g, current_app
+from app_dir.api import bp
+from app_dir.api.auth import basic_auth_required
+
+
+@bp.route('/tokens', methods=['POST'])
+@basic_auth_required
+def get_token():
+    expires_in = current_app.config['API_TOKEN_EXPIRATION']
+    return jsonify({'token': g.api_user.generate_api_token(expires_in), 'expires_in': expires_in})
@@ -0,0 +1,118 @@
+from flask import jsonify, request, g, current_app
+from app_dir import db, user_cache
+from app_dir.models import User, Post, TimelineEntry, following_relationship_table
+from app_dir.api import bp
+from app_dir.api.auth import token_auth_required
+from app_dir.api.errors import bad_request, error_response
+from app_dir.api.posts import post_rows, paginated_posts, avatar_url
+
+
+def user_rows():
+    return db.session.query(
+        User.id, User.username, User.about_me, User.last_seen, User.email_digest,
+        User.fans_count, User.stars_count, User.posts_count,
+    )
+
+
+def user_to_dict(row, following=None):
+    # following 是当前用户关注的 id 集合，给出时每个用户多一个 following 字段
+    data = {
+        'id': row.id,
+        'username': row.username,
+        'about_me': row.about_me,
+        'last_seen': row.last_seen.isoformat() + 'Z' if row.last_seen else None,
+        'avatar': avatar_url(row.email_digest, 128),
+        'fans_count': row.fans_count,
+        'stars_count': row.stars_count,
+        'posts_count': row.posts_count,
+    }
+    if following is not None:
+        data['following'] = row.id in following
+    return data
+
+
+def id_list(values):
+    # 接受 ids=1,2,3 拆开后的字符串列表或 JSON 里的 [1, 2, 3]，去重后保持原来的顺序。
+    # 不是 list 或者元素不是整数、数字字符串时返回 None
+    if not isinstance(values, list):
+        return None
+    ids = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            return None
+        try:
+            ids.append(int(value))
+        except ValueError:
+            return None
+    return list(dict.fromkeys(ids))
+
+
+@bp.route('/users', methods=['GET'])
+@token_auth_required
+def get_users():
+    ids = id_list([value for value in request.args.get('ids', '').split(',') if value])
+    if not ids:
+        return bad_request('ids must be a comma separated list of user ids.')
+    if len(ids) > current_app.config['API_BULK_LIMIT']:
+        return bad_request('At most {} ids per request.'.format(current_app.config['API_BULK_LIMIT']))
+    rows = {row.id: row for row in user_rows().filter(User.id.in_(ids))}
+    following = g.api_user.is_following_many(rows)
+    return jsonify({'items': [user_to_dict(rows[id], following) for id in ids if id in rows]})
+
+
+@bp.route('/users/<int:id>', methods=['GET'])
+@token_auth_required
+def get_user(id):
+    row = user_rows().filter(User.id == id).first()
+    if row is None:
+        return error_response(404)
+    return jsonify(user_to_dict(row, g.api_user.is_following_many([id])))
+
+
+@bp.route('/users/<int:id>/timeline', methods=['GET'])
+@token_auth_required
+def get_timeline(id):
+    # 主页时间线只能看自己的，查询方式和 User.home_posts 一致
+    if id != g.api_user.id:
+        return error_response(403)
+    if current_app.config['TIMELINE_FANOUT']:
+        query = post_rows().join(TimelineEntry, TimelineEntry.post_id == Post.id) \
+            .filter(TimelineEntry.user_id == id)
+        return paginated_posts(query, (TimelineEntry.timestamp, TimelineEntry.post_id))
+    follows = following_relationship_table
+    stars_posts = post_rows().join(follows, follows.c.star_id == Post.user_id) \
+        .filter(follows.c.fan_id == id)
+    own_posts = post_rows().filter(Post.user_id == id)
+    return paginated_posts(stars_posts.union(own_posts))
+
+
+@bp.route('/follows', methods=['POST'])
+@token_auth_required
+def update_follows():
+    # 请求体 {"follow": [id, ...], "unfollow": [id, ...]}，在同一个事务里完成
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return bad_request('The request body must be a JSON object.')
+    follow_ids = id_list(data.get('follow', []))
+    unfollow_ids = id_list(data.get('unfollow', []))
+    if follow_ids is None or unfollow_ids is None:
+        return bad_request('follow and unfollow must be lists of user ids.')
+    if set(follow_ids) & set(unfollow_ids):
+        return bad_request('A user id can not be in both follow and unfollow.')
+    if len(follow_ids) + len(unfollow_ids) > current_app.config['API_BULK_LIMIT']:
+        return bad_request('At most {} ids per request.'.format(current_app.config['API_BULK_LIMIT']))
+    me = g.api_user
+    ids = set(follow_ids) | set(unfollow_ids)
+    users = {row[0] for row in db.session.query(User.id).filter(User.id.in_(ids))} if ids else set()
+    if me.id in users:
+        return bad_request('You can not follow or unfollow yourself.')
+    # 只返回确实改变了的关系，已经关注的不算 followed，没有关注的不算 unfollowed
+    followed = set(me.follow_many([id for id in follow_ids if id in users]))
+    unfollowed = set(me.unfollow_many([id for id in unfollow_ids if id in users]))
+    db.session.commit()
+    user_cache.delete(me.id, *users)
+    return jsonify({
+        'followed': [id for id in follow_ids if id in followed],
+        'unfollowed': [id for id in unfollow_ids if id in unfollowed],
+        'not_found': sorted(ids - set(users)),
+    })
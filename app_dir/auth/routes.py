@@ -1,7 +1,7 @@
-from flask import render_template, flash, redirect, url_for, request
+from flask import render_template, flash, redirect, url_for, request, session
 from werkzeug.urls import url_parse
 from flask_login import current_user, login_user, logout_user
-from app_dir import db
+from app_dir import db, user_cache, login_throttle, server_sessions
 from app_dir.auth import bp
 from app_dir.auth.forms import LoginForm, RegistrationForm,  \
                                ResetPasswordForm, ResetPasswordRequestForm
@@ -22,11 +22,25 @@ def login():
     # 若干个我们自己定义的格式符合validate_<field_variable>(<field_variable>)的验证函数。
     # 通过格式验证后返回True。
     if form.validate_on_submit():
+        # 同一个用户名或 IP 失败太多次时不再计算密码哈希，防止用登录请求耗尽 CPU
+        if login_throttle.is_blocked(form.username.data, request.remote_addr):
+            flash('Too many failed login attempts. Please try again later.')
+            return redirect(url_for('auth.login'))
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
+            login_throttle.record_failure(form.username.data, request.remote_addr)
             flash('Invalid username or password.')
             return redirect(url_for('auth.login'))
-        login_user(user=user, remember=form.remember_me.data)
+        login_throttle.reset(form.username.data)
+        # 密码哈希的参数变了，趁这次登录拿到明文时按新参数重新计算
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+            user_cache.delete(user.id)
+        # “记住我”用永久的 session 实现，而不是 Flask-Login 的 remember cookie：
+        # 服务端删掉 session 之后登录就失效了，退出登录和重置密码都能注销它
+        login_user(user=user)
+        session.permanent = form.remember_me.data
         # request.args是一个字典，用get访问比较安全
         next_page = request.args.get('next')  # next_page的值是路径，不是端点名
         # 没有next参数或者next参数值是个有着完整协议和域名的非本地相对路径请求（如http://www.baidu.com）
@@ -38,6 +52,8 @@ def login():
 
 @bp.route('/logout')
 def logout():
+    # 先清空 session，服务端的记录随之删除；logout_user 可能再写入清除旧 remember cookie 的标记
+    session.clear()
     logout_user()
     return redirect(url_for('main.index'))
 
@@ -87,6 +103,8 @@ def reset_password(token):
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
+        user_cache.delete(user.id)
+        server_sessions.revoke(user.id)
         flash('Your password has been reset.')
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password.html', form=form)
@@ -0,0 +1,66 @@
+import os
+import struct
+import zlib
+from hashlib import md5
+from tempfile import NamedTemporaryFile
+from flask import current_app
+
+
+def email_digest(email):
+    return md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def png_bytes(width, height, rows):
+    # 最简单的 PNG：8 位 RGB，不分块、每行都用 filter 0
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + \
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + row for row in rows)
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 9)),
+        chunk(b'IEND', b''),
+    ))
+
+
+def identicon(digest, size, grid=5):
+    """由 digest 生成一个左右对称的 grid x grid 方块头像，返回 PNG 数据。"""
+    data = bytes.fromhex(digest)
+    color = bytes(data[-3:])
+    background = b'\xf0\xf0\xf0'
+    half = (grid + 1) // 2
+    cells = []
+    for row in range(grid):
+        left = [data[row * half + col] % 2 == 0 for col in range(half)]
+        cells.append(left + left[:grid - half][::-1])
+    # 每个方块的边长取整，剩下的像素作为四周的留白
+    cell = size // (grid + 1)
+    margin = (size - cell * grid) // 2
+    blank_row = background * size
+    rows = [blank_row] * margin
+    for filled in cells:
+        row = background * margin + b''.join(
+            (color if on else background) * cell for on in filled)
+        row += background * (size - len(row) // 3)
+        rows.extend([row] * cell)
+    rows.extend([blank_row] * (size - len(rows)))
+    return png_bytes(size, size, rows)
+
+
+def avatar_path(digest, size, create=True):
+    """返回 identicon 在磁盘缓存里的路径，文件不存在时先生成；create 为 False 时返回 None。
+
+    同一个 digest 和 size 生成的图片永远一样，所以缓存文件不需要失效。
+    """
+    directory = current_app.config['AVATAR_CACHE_DIR']
+    path = os.path.join(directory, '{}-{}.png'.format(digest, size))
+    if not os.path.exists(path):
+        if not create:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        # 先写临时文件再改名，并发请求不会读到写了一半的图片
+        with NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as f:
+            f.write(identicon(digest, size))
+        os.replace(f.name, path)
+    return path
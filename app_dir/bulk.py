@@ -0,0 +1,150 @@
+import csv
+import json
+import re
+from datetime import datetime
+from app_dir import db, user_cache
+from app_dir.avatars import email_digest
+from app_dir.models import User, Post, following_relationship_table
+
+
+# 按外键依赖排好的顺序：先导入 user，再导入 post 和 follows
+TABLES = [
+    ('user', User.__table__),
+    ('post', Post.__table__),
+    ('follows', following_relationship_table),
+]
+
+FORMATS = ('jsonl', 'csv')
+
+
+DATETIME_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?$')
+
+
+def parse_datetime(value):
+    # 导入时每一行都要解析时间，strptime 太慢，这里只接受 isoformat() 的格式
+    match = DATETIME_RE.match(value)
+    if match is None:
+        raise ValueError('Invalid datetime: {!r}'.format(value))
+    year, month, day, hour, minute, second, fraction = match.groups()
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                    int((fraction or '0').ljust(6, '0')))
+
+
+def column_converters(table):
+    # 把 JSON/CSV 里读出来的值转换成列的 Python 类型；CSV 的空字符串当作 NULL
+    converters = {}
+    for column in table.columns:
+        python_type = column.type.python_type
+        if python_type is datetime:
+            convert = parse_datetime
+        elif python_type is int:
+            convert = int
+        else:
+            convert = str
+        converters[column.name] = convert
+    return converters
+
+
+def keyset_chunks(table, chunk_size):
+    """按主键顺序分块读取整张表，每次只在内存里保留一块。"""
+    keys = list(table.primary_key.columns)
+    last = None
+    with db.engine.connect() as conn:
+        while True:
+            query = db.select([table]).order_by(*keys).limit(chunk_size)
+            if last is not None:
+                # (a, b) > (x, y) 展开成 a > x OR (a = x AND b > y)
+                conditions = []
+                for i, key in enumerate(keys):
+                    conditions.append(db.and_(*[k == last[k.name] for k in keys[:i]] + [key > last[key.name]]))
+                query = query.where(db.or_(*conditions))
+            rows = conn.execute(query).fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1]
+
+
+def export_table(table, fileobj, fmt, chunk_size=10000, progress=None):
+    names = [column.name for column in table.columns]
+    if fmt == 'csv':
+        writer = csv.writer(fileobj)
+        writer.writerow(names)
+    done = 0
+    for rows in keyset_chunks(table, chunk_size):
+        for row in rows:
+            values = [value.isoformat() if isinstance(value, datetime) else value for value in row]
+            if fmt == 'csv':
+                writer.writerow(['' if value is None else value for value in values])
+            else:
+                fileobj.write(json.dumps(dict(zip(names, values)), ensure_ascii=False))
+                fileobj.write('\n')
+        done += len(rows)
+        if progress is not None:
+            progress(done)
+    return done
+
+
+def read_records(fileobj, fmt):
+    if fmt == 'csv':
+        for record in csv.DictReader(fileobj):
+            yield {key: (value if value != '' else None) for key, value in record.items()}
+    else:
+        for line in fileobj:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_table(table, fileobj, fmt, chunk_size=10000, progress=None):
+    """把导出的文件用 executemany 分块插入 table，每块一个事务。
+
+    文件里每条记录的字段以第一条为准，表里没有的字段忽略，缺少的列由数据库默认值
+    填充。不经过 ORM，不会触发 fan-out、计数和搜索索引的更新（导入 user 之后会清空
+    user_cache），导入后需要运行
+    flask counters reconcile、flask timeline rebuild 和 flask search reindex。
+    """
+    converters = column_converters(table)
+    names = None
+    chunk = []
+    done = 0
+
+    def flush():
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), chunk)
+
+    for record in read_records(fileobj, fmt):
+        if names is None:
+            names = [name for name in record if name in converters]
+        row = {}
+        for name in names:
+            value = record.get(name)
+            row[name] = None if value is None else converters[name](value)
+        # 旧版本导出的 user 没有 email_digest，这里顺便算出来
+        if table is User.__table__ and 'email_digest' not in names:
+            row['email_digest'] = email_digest(row['email']) if row.get('email') else None
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            flush()
+            done += len(chunk)
+            chunk = []
+            if progress is not None:
+                progress(done)
+    if chunk:
+        flush()
+        done += len(chunk)
+        if progress is not None:
+            progress(done)
+    reset_sequence(table)
+    if table is User.__table__:
+        user_cache.clear()
+    return done
+
+
+def reset_sequence(table):
+    # 导入时写入了显式的 id，PostgreSQL 的自增序列需要跟上，否则之后插入会主键冲突
+    if db.engine.dialect.name != 'postgresql' or 'id' not in table.columns:
+        return
+    with db.engine.begin() as conn:
+        conn.execute(db.text(
+            "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+            "COALESCE((SELECT MAX(id) FROM \"{0}\"), 1))".format(table.name)))
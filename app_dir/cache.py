@@ -0,0 +1,206 @@
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from time import time
+from flask import current_app, render_template
+from jinja2 import Markup
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+
+class LRUCache(object):
+    """进程内的 LRU 缓存，每一项在 ttl 秒后过期。"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        # 删除值满足 predicate 的所有项（包括已经过期的），返回删除的个数
+        now = time()
+        with self._lock:
+            keys = [key for key, (value, expires_at) in self._data.items()
+                    if expires_at < now or predicate(value)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_redis(app):
+    # redis 是可选依赖，只有用到 redis 后端时才导入。测试时可以预先把
+    # app.redis 换成 fakeredis 之类实现了 Redis 协议的替身
+    if getattr(app, 'redis', None) is None:
+        from redis import StrictRedis
+        app.redis = StrictRedis.from_url(app.config['REDIS_URL'])
+    return app.redis
+
+
+class RedisCache(object):
+    """多个进程共享的缓存，值用 JSON 序列化后存进 Redis。
+
+    不用 pickle：能写 Redis 的人不应该因此能在 web 进程里执行代码。
+    """
+
+    def __init__(self, app, prefix, ttl=300):
+        self.app = app
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @property
+    def client(self):
+        return get_redis(self.app)
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw.decode('utf-8')) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.setex(self.prefix + key, ttl or self.ttl, json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def make_cache(app, backend, prefix, maxsize, ttl):
+    # backend: 'local' 进程内 LRU，'redis' 共享缓存，None 表示不缓存
+    if backend == 'local':
+        return LRUCache(maxsize, ttl)
+    if backend == 'redis':
+        return RedisCache(app, prefix, ttl)
+    if backend:
+        raise ValueError('Unknown cache backend {!r}.'.format(backend))
+    return None
+
+
+class UserCache(object):
+    """load_user 的读穿透缓存。
+
+    缓存的是 FIELDS 里的列，命中时把它还原成 detached 的 User 再
+    merge(load=False) 进当前 session，不需要再按主键 SELECT。password_hash 不缓存，
+    修改、校验密码时访问它才会从数据库里加载。用户资料或计数变化后调用 delete()
+    让缓存失效，批量修改 user 表之后调用 clear()。
+    """
+
+    FIELDS = ('id', 'username', 'email', 'email_digest', 'about_me', 'last_seen',
+              'fans_count', 'stars_count', 'posts_count')
+    DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['user_cache'] = make_cache(
+            app, app.config['USER_CACHE_BACKEND'], 'user:',
+            app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+    @property
+    def backend(self):
+        return current_app.extensions['user_cache']
+
+    def get_user(self, id):
+        from app_dir import db
+        from app_dir.models import User
+        cache = self.backend
+        if cache is None:
+            return User.query.get(id)
+        user = db.session.identity_map.get(identity_key(User, id))
+        if user is not None:
+            return user
+        values = cache.get(str(id))
+        if values is None:
+            user = User.query.get(id)
+            if user is not None:
+                cache.set(str(id), self.dump(user))
+            return user
+        user = User(**self.load(values))
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def dump(self, user):
+        # 只有 JSON 能表示的值：datetime 转成字符串
+        values = {field: getattr(user, field) for field in self.FIELDS}
+        if values['last_seen'] is not None:
+            values['last_seen'] = values['last_seen'].strftime(self.DATETIME_FORMAT)
+        return values
+
+    def load(self, values):
+        values = {field: values.get(field) for field in self.FIELDS}
+        if values['last_seen'] is not None:
+            values['last_seen'] = datetime.strptime(values['last_seen'], self.DATETIME_FORMAT)
+        return values
+
+    def delete(self, *ids, app=None):
+        # 后台线程里没有应用上下文，传入 app
+        cache = (app or current_app).extensions['user_cache']
+        if cache is not None:
+            for id in ids:
+                cache.delete(str(id))
+
+    def clear(self):
+        cache = self.backend
+        if cache is not None:
+            cache.clear()
+
+
+class FragmentCache(object):
+    """渲染好的 HTML 片段的缓存，比如 feed 里的一条 post。
+
+    调用方负责构造 key：片段依赖的任何东西变化时 key 也要变化，
+    这样缓存永远不需要主动失效。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['fragment_cache'] = make_cache(
+            app, app.config['FRAGMENT_CACHE_BACKEND'], 'fragment:',
+            app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+
+    def render(self, key, template_name, **context):
+        cache = current_app.extensions['fragment_cache']
+        html = cache.get(key) if cache is not None else None
+        if html is None:
+            html = render_template(template_name, **context)
+            if cache is not None:
+                cache.set(key, html)
+        return Markup(html)
@@ -0,0 +1,192 @@
+import io
+import os
+import click
+from jinja2 import TemplateSyntaxError
+from app_dir import db, user_cache, suggestion_engine, server_sessions
+from app_dir.bulk import TABLES, FORMATS, export_table, import_table
+from app_dir.email import run_email_worker
+from app_dir.search import search_index
+from app_dir.startup import run_in_subprocess
+from app_dir.language import language_detector
+from app_dir.models import User, TimelineEntry
+
+
+def register(app):
+    @app.cli.group()
+    def timeline():
+        """Home timeline commands."""
+        pass
+
+    @timeline.command()
+    @click.option('--username', default=None, help='Only rebuild this user\'s timeline.')
+    def rebuild(username):
+        """Rebuild timeline_entry from the post and follows tables."""
+        user_ids = None
+        if username is not None:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                raise click.ClickException('User {} not found.'.format(username))
+            user_ids = [user.id]
+        TimelineEntry.rebuild(user_ids)
+        db.session.commit()
+        click.echo('Timeline rebuilt.')
+
+    @app.cli.group()
+    def counters():
+        """User counter commands."""
+        pass
+
+    @counters.command()
+    def reconcile():
+        """Recompute follower, following and post counters."""
+        count = User.reconcile_counters()
+        db.session.commit()
+        user_cache.clear()
+        click.echo('Reconciled counters for {} users.'.format(count))
+
+    @app.cli.group()
+    def email():
+        """Outgoing email commands."""
+        pass
+
+    @email.command()
+    @click.option('--threads', default=2, help='Number of sender threads.')
+    @click.option('--batch-size', default=20, help='Emails sent per SMTP connection.')
+    @click.option('--interval', default=5.0, help='Seconds to wait when the queue is empty.')
+    @click.option('--once', is_flag=True, help='Exit when the queue is empty.')
+    def worker(threads, batch_size, interval, once):
+        """Send queued emails."""
+        run_email_worker(app, threads, batch_size, interval, once)
+
+    @app.cli.group()
+    def search():
+        """Full-text search commands."""
+        pass
+
+    @search.command()
+    @click.option('--chunk-size', default=1000, help='Posts indexed per transaction.')
+    def reindex(chunk_size):
+        """Rebuild the search index from the post table."""
+        count = search_index.reindex(chunk_size, progress=lambda done: click.echo(
+            '{} posts indexed'.format(done)))
+        click.echo('Reindexed {} posts.'.format(count))
+
+    @app.cli.group()
+    def language():
+        """Post language detection commands."""
+        pass
+
+    @language.command()
+    @click.option('--chunk-size', default=1000, help='Posts updated per transaction.')
+    def backfill(chunk_size):
+        """Detect the language of posts where it is empty."""
+        count = language_detector.backfill(chunk_size, progress=lambda done: click.echo(
+            '{} posts checked'.format(done)))
+        click.echo('Detected language for {} posts.'.format(count))
+
+    @app.cli.group()
+    def suggestions():
+        """Follow suggestion commands."""
+        pass
+
+    @suggestions.command()
+    @click.option('--chunk-size', default=1000, help='Users saved per transaction.')
+    def compute(chunk_size):
+        """Compute follow suggestions for every user."""
+        count = suggestion_engine.compute(chunk_size, progress=lambda done: click.echo(
+            '{} users done'.format(done)))
+        click.echo('Computed suggestions for {} users.'.format(count))
+
+    @app.cli.group()
+    def sessions():
+        """Server-side session commands."""
+        pass
+
+    @sessions.command()
+    def sweep():
+        """Delete expired sessions."""
+        click.echo('Deleted {} expired sessions.'.format(server_sessions.sweep()))
+
+    @app.cli.group()
+    def templates():
+        """Jinja template commands."""
+        pass
+
+    @templates.command('compile')
+    def compile_templates():
+        """Compile every template into the bytecode cache."""
+        env = app.jinja_env
+        if env.bytecode_cache is None:
+            raise click.ClickException('JINJA_BYTECODE_CACHE_DIR is not set.')
+        count = 0
+        for name in env.list_templates():
+            try:
+                env.get_template(name)
+            except TemplateSyntaxError as e:
+                click.echo('{}: {}'.format(name, e), err=True)
+            else:
+                count += 1
+        click.echo('Compiled {} templates into {}.'.format(count, app.config['JINJA_BYTECODE_CACHE_DIR']))
+
+    @app.cli.group()
+    def profile():
+        """Performance profiling commands."""
+        pass
+
+    @profile.command()
+    @click.option('--top', default=20, help='Number of packages and modules to list.')
+    @click.option('--path', default='/auth/login', help='URL requested after create_app().')
+    def startup(top, path):
+        """Time imports, create_app() and the first request in a fresh interpreter."""
+        code = run_in_subprocess(['--top', str(top), '--path', path])
+        if code:
+            raise SystemExit(code)
+
+    @app.cli.group()
+    def data():
+        """Bulk import and export commands."""
+        pass
+
+    def table_files(directory, fmt, names):
+        for name, table in TABLES:
+            if not names or name in names:
+                yield name, table, os.path.join(directory, '{}.{}'.format(name, fmt))
+
+    def open_data_file(path, mode):
+        # csv 模块要求 newline=''，jsonl 不受影响
+        return io.open(path, mode, encoding='utf-8', newline='')
+
+    @data.command('export')
+    @click.argument('directory', type=click.Path(file_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), default='jsonl')
+    @click.option('--table', 'tables', multiple=True, type=click.Choice([name for name, _ in TABLES]),
+                  help='Only export these tables (repeatable).')
+    @click.option('--chunk-size', default=10000, help='Rows read per query.')
+    def export_data(directory, fmt, tables, chunk_size):
+        """Export users, posts and follows to DIRECTORY."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, table, path in table_files(directory, fmt, tables):
+            with open_data_file(path, 'w') as f:
+                count = export_table(table, f, fmt, chunk_size, progress=lambda done: click.echo(
+                    '{}: {} rows exported'.format(name, done)))
+            click.echo('Exported {} {} rows to {}.'.format(count, name, path))
+
+    @data.command('import')
+    @click.argument('directory', type=click.Path(exists=True, file_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), default='jsonl')
+    @click.option('--table', 'tables', multiple=True, type=click.Choice([name for name, _ in TABLES]),
+                  help='Only import these tables (repeatable).')
+    @click.option('--chunk-size', default=10000, help='Rows inserted per transaction.')
+    def import_data(directory, fmt, tables, chunk_size):
+        """Import users, posts and follows from DIRECTORY."""
+        for name, table, path in table_files(directory, fmt, tables):
+            if not os.path.exists(path):
+                click.echo('Skipping {}: {} not found.'.format(name, path))
+                continue
+            with open_data_file(path, 'r') as f:
+                count = import_table(table, f, fmt, chunk_size, progress=lambda done: click.echo(
+                    '{}: {} rows imported'.format(name, done)))
+            click.echo('Imported {} {} rows from {}.'.format(count, name, path))
+        click.echo('Run flask counters reconcile, flask timeline rebuild and '
+                   'flask search reindex to rebuild derived data.')
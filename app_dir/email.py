@@ -1,18 +1,152 @@
-from threading import Thread
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime, timedelta
+from smtplib import SMTPServerDisconnected
 from flask import current_app
-from flask_mail import Message
-from app_dir import mail
+from app_dir import db
+from app_dir.instrumentation import external_call
+from app_dir.models import EmailJob
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+logger = logging.getLogger(__name__)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject=subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    new_thread = Thread(target=send_async_email, args=(current_app._get_current_object(), msg))
-    new_thread.start()
+    # 邮件先存进 email_job 表，重启进程也不会丢；真正的发送由 flask email worker 完成
+    job = EmailJob(subject=subject, sender=sender, recipients=json.dumps(recipients),
+                   text_body=text_body, html_body=html_body)
+    db.session.add(job)
+    db.session.commit()
+    return job
 
+
+def get_mail(app):
+    # Flask-Mail 只有 flask email worker 用得到，第一次发送时才导入和初始化
+    state = app.extensions.get('mail')
+    if state is None:
+        from flask_mail import Mail
+        Mail(app)
+        state = app.extensions['mail']
+    return state
+
+
+def build_message(job):
+    from flask_mail import Message
+    msg = Message(subject=job.subject, sender=job.sender, recipients=json.loads(job.recipients))
+    msg.body = job.text_body
+    msg.html = job.html_body
+    return msg
+
+
+def claim_email_jobs(limit):
+    now = datetime.utcnow()
+    # 超过 EMAIL_JOB_LEASE 秒还没发完的任务（worker 可能已经退出）重新排队
+    EmailJob.query.filter(
+        EmailJob.status == 'sending',
+        EmailJob.claimed_at < now - timedelta(seconds=current_app.config['EMAIL_JOB_LEASE'])
+    ).update({'status': 'queued'}, synchronize_session=False)
+    ids = [id for id, in db.session.query(EmailJob.id).filter(
+        EmailJob.status == 'queued', EmailJob.run_at <= now
+    ).order_by(EmailJob.run_at, EmailJob.id).limit(limit)]
+    if not ids:
+        db.session.commit()
+        return []
+    # 多个 worker 可能选中同样的任务，只有 UPDATE 成功把 status 从 queued 改掉的那个拿到
+    token = uuid.uuid4().hex
+    EmailJob.query.filter(EmailJob.id.in_(ids), EmailJob.status == 'queued').update(
+        {'status': 'sending', 'claimed_by': token, 'claimed_at': now}, synchronize_session=False)
+    db.session.commit()
+    return EmailJob.query.filter(EmailJob.id.in_(ids), EmailJob.claimed_by == token).all()
+
+
+def retry_later(job, error):
+    job.attempts += 1
+    job.last_error = str(error)
+    if job.attempts >= current_app.config['EMAIL_MAX_ATTEMPTS']:
+        job.status = 'failed'
+        logger.error('Giving up on email job %d: %s', job.id, error)
+        return
+    job.status = 'queued'
+    job.run_at = datetime.utcnow() + timedelta(
+        seconds=current_app.config['EMAIL_RETRY_BACKOFF'] * 2 ** (job.attempts - 1))
+
+
+def requeue(job, error):
+    # 连不上或者连接断了，邮件根本没发出去，不算一次失败的尝试
+    job.status = 'queued'
+    job.last_error = str(error)
+    job.run_at = datetime.utcnow() + timedelta(seconds=current_app.config['EMAIL_RETRY_BACKOFF'])
+
+
+def process_email_jobs(batch_size):
+    """发送一批到期的邮件，整批共用一个 SMTP 连接，返回处理的任务数。
+
+    连接中途断开时重连一次接着发，再断开就结束这一批，没发出去的任务放回队列。
+    """
+    jobs = claim_email_jobs(batch_size)
+    if not jobs:
+        return 0
+    pending = list(jobs)
+    reconnected = False
+    while pending:
+        try:
+            with external_call('mail'), get_mail(current_app).connect() as conn:
+                while pending:
+                    job = pending[0]
+                    try:
+                        conn.send(build_message(job))
+                    except SMTPServerDisconnected:
+                        raise
+                    except Exception as e:
+                        retry_later(job, e)
+                    else:
+                        job.status = 'sent'
+                        job.sent_at = datetime.utcnow()
+                    pending.pop(0)
+        except SMTPServerDisconnected as e:
+            if reconnected:
+                for job in pending:
+                    requeue(job, e)
+                break
+            reconnected = True
+        except Exception as e:
+            # 连不上 SMTP 服务器
+            for job in pending:
+                requeue(job, e)
+            break
+    db.session.commit()
+    return len(jobs)
+
+
+def run_email_worker(app, threads=2, batch_size=20, interval=5.0, once=False):
+    """启动 threads 个线程发送邮件，直到 Ctrl+C；once 为 True 时发完当前队列就退出。"""
+    stop = threading.Event()
+
+    def work():
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    count = process_email_jobs(batch_size)
+                except Exception:
+                    logger.exception('Email worker failed')
+                    db.session.rollback()
+                    count = 0
+                if count == 0:
+                    if once:
+                        return
+                    stop.wait(interval)
+
+    workers = [threading.Thread(target=work, name='email-worker-{}'.format(i))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
@@ -1,15 +1,48 @@
-from flask import render_template
+import math
+from flask import render_template, request, make_response
 from app_dir import db
+from app_dir.api.errors import error_response as api_error_response
 from app_dir.errors import bp
+from app_dir.passwords import HashingBusy
+from app_dir.ratelimit import RateLimitExceeded
+
+
+# API 的请求返回 JSON 格式的错误，网页返回 HTML 错误页
+def wants_json_response():
+    return request.path.startswith('/api/') or \
+        request.accept_mimetypes['application/json'] > request.accept_mimetypes['text/html']
 
 
 @bp.app_errorhandler(404)
 def not_found_error(error):
+    if wants_json_response():
+        return api_error_response(404)
     return render_template('errors/404.html'), 404
 
 
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
+    if wants_json_response():
+        return api_error_response(500)
     return render_template('errors/500.html'), 500
 
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy_error(error):
+    if wants_json_response():
+        response = api_error_response(503)
+    else:
+        response = make_response(render_template('errors/503.html'), 503)
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@bp.app_errorhandler(RateLimitExceeded)
+def rate_limit_error(error):
+    if wants_json_response():
+        response = api_error_response(429)
+    else:
+        response = make_response(render_template('errors/429.html'), 429)
+    response.headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
+    return response
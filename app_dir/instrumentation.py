@@ -0,0 +1,247 @@
+import json
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from flask import current_app, g, has_app_context, has_request_context, request, Response
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats(object):
+    """一个请求里的 SQL、模板和外部调用耗时，存在 g.request_stats 里。"""
+
+    def __init__(self, slow_statements):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest = []  # [(耗时, SQL)]，只保留最慢的几条
+        self.slow_statements = slow_statements
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.template_started = None
+        self.external_seconds = {}
+
+    def add_query(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if len(self.slowest) < self.slow_statements or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: -item[0])
+            del self.slowest[self.slow_statements:]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """进程内的指标，按 Prometheus 文本格式输出。多进程部署时每个进程各自统计。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}           # (endpoint, method, status) -> 次数
+        self.durations = {}          # endpoint -> Histogram
+        self.queries = {}            # endpoint -> SQL 语句数
+        self.db_seconds = {}         # endpoint -> SQL 耗时
+        self.template_seconds = {}   # endpoint -> 模板渲染耗时
+        self.external = {}           # service -> Histogram
+
+    def observe_request(self, endpoint, method, status, stats, seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.durations.setdefault(endpoint, Histogram()).observe(seconds)
+            self.queries[endpoint] = self.queries.get(endpoint, 0) + stats.queries
+            self.db_seconds[endpoint] = self.db_seconds.get(endpoint, 0.0) + stats.db_seconds
+            self.template_seconds[endpoint] = self.template_seconds.get(endpoint, 0.0) + stats.template_seconds
+
+    def observe_external(self, service, seconds):
+        with self._lock:
+            self.external.setdefault(service, Histogram()).observe(seconds)
+
+    def render(self, extra=None):
+        lines = []
+
+        def header(name, kind, help):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        def labels(**values):
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in sorted(values.items())) + '}'
+
+        def histogram(name, items, label):
+            for value, hist in sorted(items):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, labels(**{label: value, 'le': bound}), cumulative))
+                lines.append('{}_sum{} {}'.format(name, labels(**{label: value}), hist.sum))
+                lines.append('{}_count{} {}'.format(name, labels(**{label: value}), cumulative))
+
+        def totals(name, items, label):
+            for value, total in sorted(items):
+                lines.append('{}{} {}'.format(name, labels(**{label: value}), total))
+
+        with self._lock:
+            header('microblog_requests_total', 'counter', 'HTTP requests by endpoint, method and status.')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append('microblog_requests_total{} {}'.format(
+                    labels(endpoint=endpoint, method=method, status=status), count))
+            header('microblog_request_duration_seconds', 'histogram', 'Request latency.')
+            histogram('microblog_request_duration_seconds', self.durations.items(), 'endpoint')
+            header('microblog_db_queries_total', 'counter', 'SQL statements issued while handling requests.')
+            totals('microblog_db_queries_total', self.queries.items(), 'endpoint')
+            header('microblog_db_seconds_total', 'counter', 'Time spent in SQL statements.')
+            totals('microblog_db_seconds_total', self.db_seconds.items(), 'endpoint')
+            header('microblog_template_seconds_total', 'counter', 'Time spent rendering templates.')
+            totals('microblog_template_seconds_total', self.template_seconds.items(), 'endpoint')
+            header('microblog_external_call_seconds', 'histogram', 'Calls to the translation service and SMTP.')
+            histogram('microblog_external_call_seconds', self.external.items(), 'service')
+        for name, (kind, help, value) in sorted((extra or {}).items()):
+            header(name, kind, help)
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def current_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+@contextmanager
+def external_call(service):
+    """统计一次外部调用（翻译、发邮件）的耗时，在请求里时同时记到这个请求上。"""
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - started
+        metrics = current_app.extensions.get('instrumentation') if has_app_context() else None
+        if metrics is not None:
+            metrics.observe_external(service, seconds)
+        stats = current_stats()
+        if stats is not None:
+            stats.external_seconds[service] = stats.external_seconds.get(service, 0.0) + seconds
+
+
+# 下面的事件处理函数对所有 Engine 和所有应用只注册一次，没有开启统计的请求里
+# g.request_stats 不存在，它们只做一次判断就返回
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = perf_counter() - conn.info['query_started'].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.add_query(statement, seconds)
+
+
+def handle_error(context):
+    # 出错的语句不会触发 after_cursor_execute，把它的开始时间丢掉
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def on_before_render_template(app, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        # 模板里通过 render_post 之类嵌套渲染的片段，只算最外层的时间
+        if stats.template_depth == 0:
+            stats.template_started = perf_counter()
+        stats.template_depth += 1
+
+
+def on_template_rendered(app, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.template_depth:
+        stats.template_depth -= 1
+        if stats.template_depth == 0:
+            stats.template_seconds += perf_counter() - stats.template_started
+
+
+class Instrumentation(object):
+    """按请求统计 SQL 语句数和耗时、最慢的语句、模板渲染和外部调用的耗时。
+
+    开启 INSTRUMENTATION 后每个响应带上 Server-Timing 头，每个请求输出一行 JSON
+    日志，并在 /metrics 提供 Prometheus 格式的汇总指标。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['INSTRUMENTATION']:
+            return
+        app.extensions['instrumentation'] = Metrics()
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+        before_render_template.connect(on_before_render_template, app)
+        template_rendered.connect(on_template_rendered, app)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.add_url_rule(app.config['METRICS_PATH'], 'metrics', self.metrics)
+
+    def start_request(self):
+        g.request_stats = RequestStats(current_app.config['INSTRUMENTATION_SLOW_STATEMENTS'])
+
+    def finish_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        seconds = perf_counter() - stats.started
+        timings = [
+            'db;dur={:.2f};desc="{} queries"'.format(stats.db_seconds * 1000, stats.queries),
+            'tpl;dur={:.2f}'.format(stats.template_seconds * 1000),
+        ]
+        timings.extend('{};dur={:.2f}'.format(service, value * 1000)
+                       for service, value in sorted(stats.external_seconds.items()))
+        timings.append('total;dur={:.2f}'.format(seconds * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+        endpoint = request.endpoint or 'unknown'
+        current_app.extensions['instrumentation'].observe_request(
+            endpoint, request.method, response.status_code, stats, seconds)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'duration_ms': round(seconds * 1000, 2),
+                'db_queries': stats.queries,
+                'db_ms': round(stats.db_seconds * 1000, 2),
+                'template_ms': round(stats.template_seconds * 1000, 2),
+                'external_ms': {service: round(value * 1000, 2)
+                                for service, value in stats.external_seconds.items()},
+                'slowest': [{'ms': round(value * 1000, 2), 'sql': statement[:200]}
+                            for value, statement in stats.slowest],
+            }, sort_keys=True))
+        return response
+
+    def metrics(self):
+        from app_dir import last_seen
+        extra = {}
+        for key, value in last_seen.stats().items():
+            extra['microblog_last_seen_{}'.format(key)] = ('gauge', 'LastSeenBuffer {}.'.format(key), value or 0)
+        body = current_app.extensions['instrumentation'].render(extra)
+        return Response(body, mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,142 @@
+import atexit
+import logging
+import queue
+import re
+import threading
+from sqlalchemy import bindparam
+from app_dir import db
+from app_dir.cache import LRUCache
+from app_dir.models import Post
+from app_dir.search import tokenize
+
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize(text):
+    return WHITESPACE_RE.sub(' ', text).strip().lower()
+
+
+class LanguageDetector(object):
+    """在后台线程里检测新 post 的语言，批量回填 post.language。
+
+    发 post 时 language 先留空（NULL），提交后调用 submit()，后台线程攒够
+    LANGUAGE_DETECTION_BATCH 条或者等了 LANGUAGE_DETECTION_INTERVAL 秒就用一条
+    executemany 的 UPDATE 写回。检测结果按规范化后的正文缓存，转发、重复的内容
+    不用再算一遍。LANGUAGE_DETECTION_INTERVAL 为 0 时在 submit() 里直接检测并写回。
+    检测不出语言时写入空字符串，和“还没检测”的 NULL 区分开。
+    post 发出时已经不带语言加进了全文检索，写回语言的同时按语言重新索引一次。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache = LRUCache(app.config['LANGUAGE_CACHE_SIZE'], ttl=365 * 24 * 3600)
+        app.extensions['language_detector'] = self
+        atexit.register(self.stop)
+
+    def detect(self, text):
+        key = normalize(text)
+        language = self.cache.get(key)
+        if language is None:
+            # guess_language 只在后台线程和 flask language backfill 里用到，web worker 启动时不导入
+            from guess_language import guess_language
+            language = guess_language(key)
+            if language == 'UNKNOWN' or len(language) > 5:
+                language = ''
+            self.cache.set(key, language)
+        return language
+
+    def submit(self, post_id, body):
+        if not self.app.config['LANGUAGE_DETECTION_INTERVAL']:
+            self.save([(post_id, body, self.detect(body))])
+            return
+        if not self._workers:
+            self._start_workers()
+        self._queue.put((post_id, body))
+
+    def save(self, results):
+        # results 是 [(post_id, body, language), ...]。
+        # 不经过 db.session，和 LastSeenBuffer 一样直接用连接池里的连接
+        if not results:
+            return 0
+        table = Post.__table__
+        update = table.update().where(table.c.id == bindparam('b_id')) \
+            .values(language=bindparam('b_language'))
+        search = self.app.extensions['search']
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(update, [{'b_id': id, 'b_language': language} for id, _, language in results])
+            if search is not None:
+                search.add([(id, tokenize(body, language or None)) for id, body, language in results], conn)
+        return len(results)
+
+    def backfill(self, chunk_size=1000, progress=None):
+        """检测 language 为空的历史 post，按 id 分块处理，返回处理的条数。"""
+        last_id = 0
+        done = 0
+        while True:
+            rows = db.session.query(Post.id, Post.body).filter(
+                Post.id > last_id, db.or_(Post.language.is_(None), Post.language == '')
+            ).order_by(Post.id).limit(chunk_size).all()
+            db.session.commit()
+            if not rows:
+                return done
+            self.save([(id, body or '', self.detect(body or '')) for id, body in rows])
+            last_id = rows[-1][0]
+            done += len(rows)
+            if progress is not None:
+                progress(done)
+
+    def stop(self):
+        # 把队列里剩下的都处理完再退出
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+        self._workers = []
+
+    def _start_workers(self):
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.app.config['LANGUAGE_DETECTION_WORKERS']):
+                worker = threading.Thread(target=self._run, name='language-detector-{}'.format(i))
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+
+    def _run(self):
+        batch_size = self.app.config['LANGUAGE_DETECTION_BATCH']
+        interval = self.app.config['LANGUAGE_DETECTION_INTERVAL']
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch = []
+            # 拿到第一条之后最多再等 interval 秒，把这段时间里的 post 攒成一批
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=interval)
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+            try:
+                self.save([(id, body, self.detect(body)) for id, body in batch])
+            except Exception:
+                logger.exception('Failed to save language for %d posts', len(batch))
+
+
+language_detector = LanguageDetector()
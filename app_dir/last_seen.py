@@ -0,0 +1,132 @@
+import atexit
+import logging
+import threading
+import weakref
+from datetime import datetime
+from time import time, perf_counter
+from flask import current_app
+from sqlalchemy import bindparam
+
+
+logger = logging.getLogger(__name__)
+
+
+class LastSeenBuffer(object):
+    """把 last_seen 的更新攒在内存里，由后台线程定期用一条批量 UPDATE 写回。
+
+    同一个用户在 LAST_SEEN_THROTTLE 秒内只记录一次，多次记录只保留最新的时间；
+    后台线程每 LAST_SEEN_FLUSH_INTERVAL 秒写一次，进程退出时再写一次。
+    LAST_SEEN_FLUSH_INTERVAL 为 0 时不启动后台线程，每次记录都立即写回。
+    每个 app 的缓冲区、后台线程和统计放在 app.extensions['last_seen'] 里。
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # 进程退出时要把所有 app 缓冲区里剩下的写回去
+        self._apps = weakref.WeakSet()
+        atexit.register(self.stop)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['last_seen'] = {
+            'pending': {},  # user_id -> 最新的 last_seen
+            'recent': {},   # user_id -> 上一次被记录的 time()
+            'lock': threading.Lock(),
+            'flush_lock': threading.Lock(),
+            'stop': threading.Event(),
+            'worker': None,
+            'flushes': 0,
+            'flushed_rows': 0,
+            'last_flush_seconds': 0.0,
+            'flush_seconds_total': 0.0,
+        }
+        with self._lock:
+            self._apps.add(app)
+
+    def touch(self, user_id, when=None):
+        app = current_app._get_current_object()
+        state = app.extensions['last_seen']
+        now = time()
+        with state['lock']:
+            last = state['recent'].get(user_id)
+            if last is not None and now - last < app.config['LAST_SEEN_THROTTLE']:
+                return False
+            state['recent'][user_id] = now
+            state['pending'][user_id] = when or datetime.utcnow()
+        if not app.config['LAST_SEEN_FLUSH_INTERVAL']:
+            self.flush(app)
+        elif state['worker'] is None:
+            self._start_worker(app)
+        return True
+
+    def flush(self, app=None):
+        from app_dir import db, user_cache
+        from app_dir.models import User
+        app = app or current_app._get_current_object()
+        state = app.extensions['last_seen']
+        with state['flush_lock']:
+            with state['lock']:
+                pending, state['pending'] = state['pending'], {}
+                cutoff = time() - app.config['LAST_SEEN_THROTTLE']
+                state['recent'] = {id: t for id, t in state['recent'].items() if t >= cutoff}
+            if not pending:
+                return 0
+            table = User.__table__
+            update = table.update().where(table.c.id == bindparam('b_id')) \
+                .values(last_seen=bindparam('b_last_seen'))
+            start = perf_counter()
+            try:
+                # 不经过 db.session，避免和请求里的 session 互相影响
+                with db.get_engine(app).begin() as conn:
+                    conn.execute(update, [{'b_id': id, 'b_last_seen': last_seen}
+                                          for id, last_seen in pending.items()])
+            except Exception:
+                logger.exception('Failed to flush %d last_seen updates', len(pending))
+                with state['lock']:
+                    for id, last_seen in pending.items():
+                        state['pending'].setdefault(id, last_seen)
+                return 0
+            # 缓存里的 User 带着旧的 last_seen，个人主页和 ETag 都会用到
+            user_cache.delete(*pending, app=app)
+            elapsed = perf_counter() - start
+            state['flushes'] += 1
+            state['flushed_rows'] += len(pending)
+            state['last_flush_seconds'] = elapsed
+            state['flush_seconds_total'] += elapsed
+            return len(pending)
+
+    def stats(self, app=None):
+        state = (app or current_app).extensions['last_seen']
+        return {
+            'buffer_size': len(state['pending']),
+            'flushes': state['flushes'],
+            'flushed_rows': state['flushed_rows'],
+            'last_flush_seconds': state['last_flush_seconds'],
+            'flush_seconds_total': state['flush_seconds_total'],
+        }
+
+    def stop(self, app=None):
+        """停掉后台线程并把剩下的写回；不传 app 时处理所有 app。"""
+        if app is None:
+            with self._lock:
+                apps = list(self._apps)
+            for app in apps:
+                self.stop(app)
+            return
+        app.extensions['last_seen']['stop'].set()
+        self.flush(app)
+
+    def _start_worker(self, app):
+        state = app.extensions['last_seen']
+        with state['lock']:
+            if state['worker'] is not None:
+                return
+            state['worker'] = threading.Thread(target=self._run, args=(app,), name='last-seen-flusher')
+            state['worker'].daemon = True
+        state['worker'].start()
+
+    def _run(self, app):
+        stop = app.extensions['last_seen']['stop']
+        while not stop.wait(app.config['LAST_SEEN_FLUSH_INTERVAL']):
+            self.flush(app)
@@ -4,5 +4,5 @@ from flask import Blueprint
 bp = Blueprint('main', __name__)
 
 
-from app_dir.main import routes
+from app_dir.main import routes, fragments
 
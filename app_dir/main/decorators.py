@@ -0,0 +1,81 @@
+from functools import wraps
+from hashlib import md5
+from time import time
+from flask import current_app, g, has_app_context, request, session, make_response
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+
+
+def sql_budget(f):
+    # 测试模式下统计 GET 视图（包括模板渲染）发出的 SQL 语句数，
+    # 超过 FEED_SQL_BUDGET 就抛出 AssertionError，防止 N+1 查询混进来
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        budget = current_app.config.get('FEED_SQL_BUDGET')
+        if not current_app.testing or budget is None or request.method != 'GET':
+            return f(*args, **kwargs)
+        g.sql_statements = 0
+        try:
+            rv = f(*args, **kwargs)
+        finally:
+            count = g.pop('sql_statements')
+        if count > budget:
+            raise AssertionError('{} issued {} SQL statements, the budget is {}.'.format(
+                request.endpoint, count, budget))
+        return rv
+    return decorated_function
+
+
+def conditional(validator, form=False):
+    """根据 validator 算出的 ETag/Last-Modified 处理条件请求。
+
+    validator 接收和视图函数一样的参数，返回 (values, last_modified)：values 是
+    页面内容依赖的一组廉价的值（比如最新一条 post 的 id），last_modified 可以是
+    None；返回 None 表示这次不做条件判断。客户端缓存的版本没有变化时直接返回
+    304，不再执行视图函数里的查询和模板渲染。
+
+    只按 If-None-Match 判断：last_modified 在取关、裁剪时间线之后会变早，
+    只看 If-Modified-Since 会把旧页面当成没变。页面里有表单时传 form=True，
+    ETag 里加上 session 里的 CSRF 令牌和半个 WTF_CSRF_TIME_LIMIT 的时间段，
+    浏览器缓存的页面里的令牌过期之前 ETag 就会变。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # 有待显示的 flash 消息时页面内容和缓存的不一样
+            if request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+            result = validator(*args, **kwargs)
+            if result is None:
+                return f(*args, **kwargs)
+            values, last_modified = result
+            values = list(values) + [request.full_path, g.locale]
+            if current_user.is_authenticated:
+                values.append(current_user.version_stamp)
+            if form:
+                values.append(session.get('csrf_token'))
+                time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+                if time_limit:
+                    values.append(int(time() // (time_limit / 2)))
+            etag = md5('|'.join(str(value) for value in values).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            response.vary.add('Accept-Language')
+            return response
+        return decorated_function
+    return decorator
@@ -1,8 +1,9 @@
+from flask import request
+from flask_login import current_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired, Length, ValidationError
 from app_dir.models import User
-from flask_login import current_user
 
 
 class EditProfileForm(FlaskForm):
@@ -21,3 +22,14 @@ class PostForm(FlaskForm):
                          validators=[DataRequired(), Length(min=1, max=140)])
     submit = SubmitField('Submit')
 
+
+class SearchForm(FlaskForm):
+    q = StringField('Search', validators=[DataRequired()])
+
+    # 搜索表单用 GET 提交，数据在 request.args 里，也不需要 CSRF 保护
+    def __init__(self, *args, **kwargs):
+        if 'formdata' not in kwargs:
+            kwargs['formdata'] = request.args
+        if 'meta' not in kwargs:
+            kwargs['meta'] = {'csrf': False}
+        super(SearchForm, self).__init__(*args, **kwargs)
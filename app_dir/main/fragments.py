@@ -0,0 +1,17 @@
+from flask import g
+from app_dir import fragment_cache
+from app_dir.main import bp
+
+
+# post 发布后正文不会再变，一条 post 渲染出来的 HTML 只取决于下面这些值
+@bp.app_template_global()
+def render_post(post):
+    key = 'post:{}:{}:{}:{}:{}'.format(post.id, g.locale, post.language,
+                                       post.author.username, post.author.email_digest)
+    return fragment_cache.render(key, '_post.html', post=post)
+
+
+@bp.app_template_global()
+def render_profile_header(user):
+    key = 'user:{}:{}'.format(user.id, user.version_stamp)
+    return fragment_cache.render(key, '_user_header.html', user=user)
@@ -1,60 +1,104 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+import re
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, send_file
 from flask_login import current_user, login_required
-from guess_language import guess_language
-from app_dir import db
-from app_dir.models import User, Post
-from app_dir.translate import translate
+from app_dir import db, user_cache, last_seen
+from app_dir.models import User, Post, TimelineEntry, Suggestion
+from app_dir.translate import translate, translate_many
+from app_dir.pagination import keyset_paginate
+from app_dir.search import search_index
+from app_dir.language import language_detector
+from app_dir.avatars import avatar_path, identicon
 from app_dir.main import bp
-from app_dir.main.forms import EditProfileForm, PostForm
+from app_dir.main.decorators import sql_budget, conditional
+from app_dir.routing import use_primary
+from app_dir.main.forms import EditProfileForm, PostForm, SearchForm
 
 
 @bp.before_request
 def before_request():
+    # last_seen 先记在内存里，由后台线程批量写回数据库，页面浏览不再是一次写事务
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user.id)
+        g.search_form = SearchForm()
     # g.locale == zh， zh-CN 或者 zh-TW之类的
     # 从接受一个请求到返回一个请求，我们从头到尾在同一个线程中访问的g
     g.locale = request.accept_languages[0][0]
 
 
+# 下面两个函数是 conditional 用的验证器，每个最多执行一次很轻的查询
+def newest_in_home_timeline():
+    # 首页还有“可能认识的人”，把推荐的计算时间也算进去，三个值用一条语句查出来
+    if not current_app.config['TIMELINE_FANOUT']:
+        return None
+    newest = TimelineEntry.query.filter(TimelineEntry.user_id == current_user.id).order_by(
+        TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()).limit(1)
+    values = db.session.query(
+        newest.with_entities(TimelineEntry.post_id).as_scalar(),
+        newest.with_entities(TimelineEntry.timestamp).as_scalar(),
+        db.session.query(db.func.max(Suggestion.timestamp)).filter(
+            Suggestion.user_id == current_user.id).as_scalar(),
+    ).one()
+    timestamps = [timestamp for timestamp in values[1:] if timestamp is not None]
+    return values, max(timestamps) if timestamps else None
+
+
+def profile_version(username):
+    # posts_count 在 version_stamp 里，用户发了新 post 这个值就会变。
+    # 查到的用户留在 g 里，需要渲染页面时 user() 直接用，不再查一次
+    g.profile_user = User.query.filter_by(username=username).first_or_404()
+    return (g.profile_user.id, g.profile_user.version_stamp), None
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@conditional(newest_in_home_timeline, form=True)
+@sql_budget
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # 先和 post 一起提交进全文检索，保证马上能搜到；语言由 language_detector 在后台检测，
+        # 写回语言时按语言的停用词重新索引一次。检测没有完成 post 也照样能搜到
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        current_user.posts_count = User.posts_count + 1
+        db.session.flush()
+        if current_app.config['TIMELINE_FANOUT']:
+            TimelineEntry.fan_out(post)
+        search_index.add_posts([post])
         db.session.commit()
+        user_cache.delete(current_user.id)
+        language_detector.submit(post.id, post.body)
         flash('Your post is now live!')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = current_user.stars_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    query, keys = current_user.home_posts()
+    pagination = keyset_paginate(query, current_app.config['POSTS_PER_PAGE'],
+                                 before=request.args.get('before'),
+                                 after=request.args.get('after'),
+                                 keys=keys)
     posts = pagination.items
-    next_url = url_for('main.index', page=pagination.next_num) \
+    next_url = url_for('main.index', before=pagination.next_cursor) \
         if pagination.has_next else None
-    prev_url = url_for('main.index', page=pagination.prev_num) \
+    prev_url = url_for('main.index', after=pagination.prev_cursor) \
         if pagination.has_prev else None
     return render_template('index.html', title='Home Page', form=form, posts=posts,
+                           suggestions=current_user.suggested_users(),
                            next_url=next_url, prev_url=prev_url)
 
 
+# 页面上是所有人的 post，任何一个作者改了用户名或头像页面都会变，没有廉价的验证器，不做条件请求
 @bp.route('/explore')
 @login_required
+@sql_budget
 def explore():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    query = Post.load_authors(Post.query)
+    pagination = keyset_paginate(query, current_app.config['POSTS_PER_PAGE'],
+                                 before=request.args.get('before'),
+                                 after=request.args.get('after'))
     posts = pagination.items
-    next_url = url_for('main.explore', page=pagination.next_num) \
+    next_url = url_for('main.explore', before=pagination.next_cursor) \
         if pagination.has_next else None
-    prev_url = url_for('main.explore', page=pagination.prev_num) \
+    prev_url = url_for('main.explore', after=pagination.prev_cursor) \
         if pagination.has_prev else None
     return render_template('index.html', title='Explore', posts=posts,
                            next_url=next_url, prev_url=prev_url)
@@ -62,20 +106,38 @@ def explore():
 
 @bp.route('/user/<username>')
 @login_required
+@conditional(profile_version)
+@sql_budget
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    user = g.get('profile_user') or User.query.filter_by(username=username).first_or_404()
+    query = Post.load_authors(user.posts)
+    pagination = keyset_paginate(query, current_app.config['POSTS_PER_PAGE'],
+                                 before=request.args.get('before'),
+                                 after=request.args.get('after'))
     posts = pagination.items
-    next_url = url_for('main.user', username=user.username, page=pagination.next_num) \
+    next_url = url_for('main.user', username=user.username, before=pagination.next_cursor) \
         if pagination.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=pagination.prev_num) \
+    prev_url = url_for('main.user', username=user.username, after=pagination.prev_cursor) \
         if pagination.has_prev else None
-    return render_template('user.html', user=user, posts=posts,
+    # 关注按钮要的关注状态在这里查好传给模板，看自己的主页时不查 follows
+    following = user != current_user and bool(current_user.is_following_many([user.id]))
+    return render_template('user.html', user=user, posts=posts, following=following,
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/search')
+@login_required
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for('main.explore'))
+    posts, next_cursor = search_index.search(g.search_form.q.data,
+                                             current_app.config['POSTS_PER_PAGE'],
+                                             after=request.args.get('after'), language=g.locale)
+    next_url = url_for('main.search', q=g.search_form.q.data, after=next_cursor) \
+        if next_cursor else None
+    return render_template('search.html', title='Search', posts=posts, next_url=next_url)
+
+
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
@@ -84,6 +146,7 @@ def edit_profile():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        user_cache.delete(current_user.id)
         flash('Your changes have been saved.')
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -94,6 +157,7 @@ def edit_profile():
 
 @bp.route('/follow/<username>')
 @login_required
+@use_primary
 def follow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
@@ -104,12 +168,14 @@ def follow(username):
         return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    user_cache.delete(current_user.id, user.id)
     flash('You are following {}.'.format(username))
     return redirect(url_for('main.user', username=username))
 
 
 @bp.route('/unfollow/<username>')
 @login_required
+@use_primary
 def unfollow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
@@ -120,6 +186,7 @@ def unfollow(username):
         return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)
     db.session.commit()
+    user_cache.delete(current_user.id, user.id)
     flash('You are not following {}.'.format(username))
     return redirect(url_for('main.user', username=username))
 
@@ -131,3 +198,51 @@ def translate_text():
                                       request.form['source_language'],
                                       request.form['target_language'])})
 
+
+def is_language(value):
+    # 语言代码存进 translation 表的 String(5) 列
+    return isinstance(value, str) and 0 < len(value) <= 5
+
+
+# 一次翻译页面上所有需要翻译的 post，请求体形如
+# {"target_language": "zh", "items": [{"id": "42", "text": "...", "source_language": "en"}]}
+@bp.route('/translate/batch', methods=['post'])
+@login_required
+def translate_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    items = data.get('items')
+    target_language = data.get('target_language')
+    if not is_language(target_language) or not isinstance(items, list) or \
+            len(items) > current_app.config['TRANSLATION_BATCH_LIMIT']:
+        abort(400)
+    try:
+        pairs = [(item['text'], item['source_language']) for item in items]
+    except (KeyError, TypeError):
+        abort(400)
+    if not all(isinstance(text, str) and is_language(source) for text, source in pairs):
+        abort(400)
+    texts = translate_many(pairs, target_language)
+    return jsonify({'translations': {item.get('id'): text for item, text in zip(items, texts)}})
+
+
+# 头像只由 digest 和 size 决定，内容永远不变，浏览器可以缓存一年
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    if not re.match(r'^[0-9a-f]{32}$', digest) or size not in current_app.config['AVATAR_SIZES']:
+        abort(404)
+    # 这个地址不需要登录，只有现有用户的头像写进磁盘缓存，其他 digest 每次现算，
+    # 防止用随机的 digest 把磁盘写满
+    path = avatar_path(digest, size, create=False)
+    if path is None and db.session.query(User.query.filter_by(email_digest=digest).exists()).scalar():
+        path = avatar_path(digest, size)
+    if path is not None:
+        response = send_file(path, mimetype='image/png', conditional=True, cache_timeout=365 * 24 * 3600)
+    else:
+        response = current_app.response_class(identicon(digest, size), mimetype='image/png')
+        response.add_etag()
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.make_conditional(request)
+    response.cache_control.public = True
+    return response
@@ -1,19 +1,22 @@
 from hashlib import md5
 from datetime import datetime
 from time import time
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import joinedload, selectinload, subqueryload, lazyload
 import jwt
-from app_dir import db, login
+from app_dir import db, login, user_cache, password_hasher
+from app_dir.avatars import email_digest
 
 # 关系表，实现User到User的多对多关系
 # A fan follows a star. The left User follows the right User.
 # 这个关系表我们不会直接操作， 而是通过user_object.stars 和 user_object.fans 进行简介管理
+# 主键 (fan_id, star_id) 同时保证不会重复关注；反向索引 (star_id, fan_id) 用于查粉丝
 following_relationship_table = db.Table(
     'follows',
-    db.Column('fan_id', db.Integer, db.ForeignKey('user.id')),  # User 对象的表名是小写的user
-    db.Column('star_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('fan_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),  # User 对象的表名是小写的user
+    db.Column('star_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_follows_star_id_fan_id', 'star_id', 'fan_id')
 )
 
 
@@ -28,9 +31,16 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    # md5(email) 在修改 email 时算好存下来，渲染头像时不用每次都算
+    email_digest = db.Column(db.String(32), index=True)
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # 冗余计数，避免个人主页每次对 follows 和 post 做 COUNT；
+    # 和实际数据不一致时用 flask counters reconcile 修正
+    fans_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stars_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     # 左侧对象通过 self.stars 找到关联的右侧对象
     stars = db.relationship(
@@ -46,35 +56,113 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    # 哈希在 password_hasher 的进程池里计算，算法和强度由 PASSWORD_HASH_METHOD 决定
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
+
+    @property
+    def version_stamp(self):
+        # 个人资料页头部显示的字段任何一个变化，这个值都会变化
+        return md5('|'.join(str(value) for value in (
+            self.username, self.email, self.about_me, self.last_seen,
+            self.fans_count, self.stars_count, self.posts_count
+        )).encode('utf-8')).hexdigest()
+
+    @db.validates('email')
+    def validate_email(self, key, email):
+        self.email_digest = email_digest(email) if email else None
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return url_for('main.avatar', digest=self.email_digest or email_digest(self.email), size=size)
 
+    # follow/unfollow 不先查是否已经关注：重复的关注被 INSERT 忽略，没有的关注 DELETE
+    # 删不到行，计数、时间线和关注推荐只按实际插入/删除的行更新，并发的重复点击也不会算两次
     def follow(self, user):
-        if not self.is_following(user):
-            self.stars.append(user)
+        return bool(self.follow_many([user.id]))
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.stars.remove(user)
+        return bool(self.unfollow_many([user.id]))
+
+    def follow_many(self, ids):
+        """关注 ids 里的用户（这些用户必须存在），返回新关注的用户 id 列表。"""
+        ids = [id for id in dict.fromkeys(ids) if id != self.id]
+        added = insert_follows(self.id, ids) if ids else []
+        if added:
+            self._update_follows(added, 1)
+        return added
+
+    def unfollow_many(self, ids):
+        """取消关注 ids 里的用户，返回确实取消了的用户 id 列表。"""
+        ids = list(dict.fromkeys(ids))
+        removed = delete_follows(self.id, ids) if ids else []
+        if removed:
+            self._update_follows(removed, -1)
+        return removed
+
+    def _update_follows(self, star_ids, delta):
+        # 自己的 stars_count 和对方的 fans_count 在同一条 UPDATE 里原子地加减
+        user_table = User.__table__
+        db.session.execute(user_table.update().where(user_table.c.id.in_([self.id] + star_ids)).values(
+            stars_count=db.case([(user_table.c.id == self.id, user_table.c.stars_count + delta * len(star_ids))],
+                                else_=user_table.c.stars_count),
+            fans_count=db.case([(user_table.c.id.in_(star_ids), user_table.c.fans_count + delta)],
+                               else_=user_table.c.fans_count),
+        ))
+        if current_app.config['TIMELINE_FANOUT']:
+            if delta > 0:
+                TimelineEntry.backfill(self.id, star_ids)
+            else:
+                TimelineEntry.trim(self.id, star_ids)
+        for star_id in star_ids:
+            record_follow_change(self.id, star_id, delta > 0)
 
     def is_following(self, user):
-        return self.stars.filter(following_relationship_table.c.star_id == user.id).count() > 0
+        return user.id in self.is_following_many([user.id])
+
+    def is_following_many(self, ids):
+        """一条查询返回 ids 里已经关注了的用户 id 集合。"""
+        ids = list(ids)
+        if not ids:
+            return set()
+        follows = following_relationship_table
+        return {row[0] for row in db.session.execute(db.select([follows.c.star_id]).where(
+            db.and_(follows.c.fan_id == self.id, follows.c.star_id.in_(ids))))}
 
-    def stars_posts(self):
+    def stars_posts(self, author_loading=None):
         # post 表和 following_relationship_table 联结
         stars_posts = Post.query.join(
             following_relationship_table,
             (following_relationship_table.c.star_id == Post.user_id)
         ).filter(following_relationship_table.c.fan_id == self.id)
         own_posts = Post.query.filter_by(user_id=self.id)
-        return stars_posts.union(own_posts).order_by(Post.timestamp.desc())
+        return Post.load_authors(stars_posts.union(own_posts), author_loading) \
+            .order_by(Post.timestamp.desc())
+
+    def home_posts(self, author_loading=None):
+        # 主页时间线：开启 TIMELINE_FANOUT 时直接按索引 (user_id, timestamp) 读取
+        # timeline_entry 表，否则退回到 stars_posts() 的 UNION 查询。
+        # 返回 (query, 排序键)，排序键供 keyset_paginate 使用
+        if not current_app.config['TIMELINE_FANOUT']:
+            return self.stars_posts(author_loading), (Post.timestamp, Post.id)
+        query = Post.load_authors(Post.query, author_loading).join(
+            TimelineEntry, TimelineEntry.post_id == Post.id
+        ).filter(TimelineEntry.user_id == self.id).order_by(TimelineEntry.timestamp.desc())
+        return query, (TimelineEntry.timestamp, TimelineEntry.post_id)
+
+    def suggested_users(self, limit=5):
+        # suggestion 表里是离线算好的推荐，去掉推荐之后已经关注了的人
+        follows = following_relationship_table
+        return User.query.join(Suggestion, Suggestion.suggested_id == User.id).filter(
+            Suggestion.user_id == self.id,
+            ~db.exists().where(db.and_(follows.c.fan_id == self.id, follows.c.star_id == User.id))
+        ).order_by(Suggestion.score.desc(), User.id).limit(limit).all()
 
     def generate_reset_password_token(self, expires_in_seconds=60*20):
         return jwt.encode(
@@ -96,10 +184,95 @@ class User(UserMixin, db.Model):
         return User.query.get(user_id)
 
 
+    # API 令牌和重置密码令牌用同一套 JWT，只是字段名不同，两者不能互相冒用
+    def generate_api_token(self, expires_in_seconds=3600):
+        return jwt.encode(
+            payload={'api_user_id': self.id, 'exp': time() + expires_in_seconds},
+            key=current_app.config['SECRET_KEY'],
+            algorithm='HS256',
+        ).decode('utf-8')
+
+    @staticmethod
+    def verify_api_token(token):
+        try:
+            user_id = jwt.decode(jwt=token,
+                                 key=current_app.config['SECRET_KEY'],
+                                 algorithms=['HS256']
+                                 )['api_user_id']
+        except:
+            return
+        # 令牌里已经有 id，走 user_cache，不用每个 API 请求都查 user 表
+        return user_cache.get_user(user_id)
+
+    @staticmethod
+    def reconcile_counters(user_ids=None):
+        # 用 follows 和 post 表里的实际数据一次性批量重算计数，调用方提交之后要清掉 user_cache
+        user_table = User.__table__
+        follows = following_relationship_table
+        update = user_table.update().values(
+            fans_count=db.select([db.func.count()]).where(follows.c.star_id == user_table.c.id).as_scalar(),
+            stars_count=db.select([db.func.count()]).where(follows.c.fan_id == user_table.c.id).as_scalar(),
+            posts_count=db.select([db.func.count()]).where(Post.__table__.c.user_id == user_table.c.id).as_scalar(),
+        )
+        if user_ids is not None:
+            update = update.where(user_table.c.id.in_(user_ids))
+        return db.session.execute(update).rowcount
+
+
+def sqlite_returning():
+    # 3.35 以后的 SQLite 支持 INSERT/DELETE ... RETURNING，一条语句就能知道改了哪些行
+    dialect = db.engine.dialect
+    return dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 35)
+
+
+def insert_follows(fan_id, star_ids):
+    # 一条 INSERT ... ON CONFLICT DO NOTHING RETURNING 插入所有行，返回真正插入了的 star_id。
+    # MySQL 没有 RETURNING，多行 INSERT IGNORE 的 rowcount 只有总数，不知道是哪几行，
+    # 而计数和时间线要按实际插入的行更新，所以仍然每行一条 INSERT IGNORE 看 rowcount
+    follows = following_relationship_table
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(follows).values([{'fan_id': fan_id, 'star_id': star_id} for star_id in star_ids]) \
+            .on_conflict_do_nothing().returning(follows.c.star_id)
+        return [row[0] for row in db.session.execute(statement)]
+    if sqlite_returning():
+        # SQLAlchemy 1.2 的 SQLite 方言不会生成 RETURNING，直接写 SQL
+        params = {'star_id_{}'.format(i): star_id for i, star_id in enumerate(star_ids)}
+        statement = db.text('INSERT INTO follows (fan_id, star_id) VALUES {} ON CONFLICT DO NOTHING '
+                            'RETURNING star_id'.format(', '.join('(:fan_id, :{})'.format(name) for name in params)))
+        return [row[0] for row in db.session.execute(statement, dict(params, fan_id=fan_id)).fetchall()]
+    statement = follows.insert().prefix_with('IGNORE' if db.engine.dialect.name == 'mysql' else 'OR IGNORE')
+    return [star_id for star_id in star_ids
+            if db.session.execute(statement, {'fan_id': fan_id, 'star_id': star_id}).rowcount]
+
+
+def delete_follows(fan_id, star_ids):
+    follows = following_relationship_table
+    if db.engine.dialect.name == 'postgresql':
+        statement = follows.delete().where(db.and_(
+            follows.c.fan_id == fan_id, follows.c.star_id.in_(star_ids))).returning(follows.c.star_id)
+        return [row[0] for row in db.session.execute(statement)]
+    if sqlite_returning():
+        params = {'star_id_{}'.format(i): star_id for i, star_id in enumerate(star_ids)}
+        statement = db.text('DELETE FROM follows WHERE fan_id = :fan_id AND star_id IN ({}) '
+                            'RETURNING star_id'.format(', '.join(':' + name for name in params)))
+        return [row[0] for row in db.session.execute(statement, dict(params, fan_id=fan_id)).fetchall()]
+    statement = follows.delete().where(db.and_(
+        follows.c.fan_id == db.bindparam('b_fan_id'), follows.c.star_id == db.bindparam('b_star_id')))
+    return [star_id for star_id in star_ids
+            if db.session.execute(statement, {'b_fan_id': fan_id, 'b_star_id': star_id}).rowcount]
+
+
+def record_follow_change(fan_id, star_id, followed):
+    # 事务提交之后由 suggestion_engine 更新关注图，回滚时丢弃
+    db.session.info.setdefault('follow_changes', []).append((fan_id, star_id, followed))
+
+
 # Flask_Login 要求我们自己写一个提供用户id（id是字符串形式）返回用户实例的函数以供他调用, 这个函数用 login对象的user_loader装饰器装饰
+# 先查 user_cache，命中时不再访问数据库
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.get_user(int(id))
 
 
 class Post(db.Model):
@@ -108,7 +281,157 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    # 个人主页按作者取 post 并按时间排序
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @staticmethod
+    def load_authors(query, strategy=None):
+        # 渲染 post 列表时每条都要读 post.author，默认的懒加载会对每个作者单独
+        # SELECT 一次（N+1）。strategy 为 None 时使用 POST_AUTHOR_LOADING 配置
+        strategy = strategy or current_app.config['POST_AUTHOR_LOADING']
+        return query.options(AUTHOR_LOADERS[strategy](Post.author))
+
+
+AUTHOR_LOADERS = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'subquery': subqueryload,
+    'lazy': lazyload,
+}
+
+
+# 写扩散（fan-out-on-write）的主页时间线：每发一条 post，就给作者本人和作者的每个粉丝
+# 各写一行 timeline_entry。timestamp 冗余自 post.timestamp，这样主页只需按
+# (user_id, timestamp) 索引做一次范围读取，不用再 UNION 和排序。
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entry'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # 时间线的主人
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index('ix_timeline_entry_user_id_timestamp', 'user_id', 'timestamp'),
+        db.UniqueConstraint('user_id', 'post_id'),
+    )
+
+    def __repr__(self):
+        return '<TimelineEntry {} {}>'.format(self.user_id, self.post_id)
+
+    @staticmethod
+    def fan_out(post):
+        # post 需要已经 flush 过（有 id）
+        table = TimelineEntry.__table__
+        db.session.execute(table.insert().values(
+            user_id=post.user_id, post_id=post.id, timestamp=post.timestamp))
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([following_relationship_table.c.fan_id,
+                       db.literal(post.id),
+                       db.literal(post.timestamp)])
+            .where(following_relationship_table.c.star_id == post.user_id)
+            .distinct()
+        ))
+
+    @staticmethod
+    def backfill(fan_id, star_ids):
+        # fan 新关注了 star_ids 里的用户：把他们已有的 post 补进 fan 的时间线
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([db.literal(fan_id), Post.id, Post.timestamp])
+            .where(Post.user_id.in_(star_ids))
+        ))
+
+    @staticmethod
+    def trim(fan_id, star_ids):
+        # fan 取消关注 star_ids 里的用户：从 fan 的时间线里删掉他们的 post
+        db.session.execute(TimelineEntry.__table__.delete().where(db.and_(
+            TimelineEntry.user_id == fan_id,
+            TimelineEntry.post_id.in_(db.select([Post.id]).where(Post.user_id.in_(star_ids)))
+        )))
+
+    @staticmethod
+    def rebuild(user_ids=None):
+        # 按 post 和 follows 表重建时间线；user_ids 为 None 时重建所有用户
+        table = TimelineEntry.__table__
+        columns = ['user_id', 'post_id', 'timestamp']
+        # 和迁移里一样跳过没有作者的 post，timeline_entry.user_id 不能为空
+        own_posts = db.select([Post.user_id, Post.id, Post.timestamp]).where(Post.user_id.isnot(None))
+        stars_posts = db.select([following_relationship_table.c.fan_id, Post.id, Post.timestamp]) \
+            .select_from(db.join(Post, following_relationship_table,
+                                 following_relationship_table.c.star_id == Post.user_id)) \
+            .distinct()
+        delete = table.delete()
+        if user_ids is not None:
+            delete = delete.where(table.c.user_id.in_(user_ids))
+            own_posts = own_posts.where(Post.user_id.in_(user_ids))
+            stars_posts = stars_posts.where(following_relationship_table.c.fan_id.in_(user_ids))
+        db.session.execute(delete)
+        db.session.execute(table.insert().from_select(columns, own_posts))
+        db.session.execute(table.insert().from_select(columns, stars_posts))
+
+
+# 翻译结果的持久缓存，按 (原文的 sha1, 源语言, 目标语言) 查找
+class Translation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    text_hash = db.Column(db.String(40), nullable=False)
+    source_language = db.Column(db.String(5), nullable=False)
+    target_language = db.Column(db.String(5), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.UniqueConstraint('text_hash', 'source_language', 'target_language'),
+    )
+
+    def __repr__(self):
+        return '<Translation {} {}>'.format(self.text_hash, self.target_language)
+
+
+# 待发送的邮件。send_email 只负责把邮件写进这张表，由 flask email worker 发送
+class EmailJob(db.Model):
+    __tablename__ = 'email_job'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(120))
+    recipients = db.Column(db.Text)  # JSON 列表
+    text_body = db.Column(db.Text)
+    html_body = db.Column(db.Text)
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # 最早什么时候可以（重新）发送
+    claimed_by = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_email_job_status_run_at', 'status', 'run_at'),)
+
+    def __repr__(self):
+        return '<EmailJob {} {}>'.format(self.id, self.status)
+
+
+# “可能认识的人”，由 suggestion_engine 在内存里的关注图上离线计算，每个用户只存前几名
+class Suggestion(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    # 计算时间，首页的 ETag 用它判断“可能认识的人”有没有变
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Suggestion {} {}>'.format(self.user_id, self.suggested_id)
+
+
+# 服务端 session：cookie 里只有随机的 sid，数据按 Flask 的 TaggedJSON 格式存在 data 里。
+# user_id 冗余自 data，用来注销一个用户的所有 session；expires 上的索引供批量清理使用
+class WebSession(db.Model):
+    __tablename__ = 'web_session'
+    sid = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<WebSession {}>'.format(self.sid[:8])
@@ -0,0 +1,87 @@
+import base64
+from datetime import datetime
+from app_dir import db
+from app_dir.models import Post
+
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+# 游标是 (timestamp, id) 的 urlsafe base64 编码，对用户来说是不透明的字符串
+def encode_cursor(timestamp, id):
+    raw = '{}|{}'.format(timestamp.strftime(CURSOR_TIME_FORMAT), id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        timestamp, id = raw.decode('utf-8').split('|')
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+    except ValueError:
+        # 被篡改或格式不对的游标当作没有游标，回到第一页
+        return None
+
+
+class KeysetPagination(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor  # 更早的一页
+        self.prev_cursor = prev_cursor  # 更新的一页
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, per_page, before=None, after=None, keys=None, cursor_of=None):
+    """按 (timestamp, id) 倒序做游标分页，代替 paginate() 的 OFFSET + COUNT。
+
+    before 取比游标更早的一页，after 取比游标更新的一页。keys 是排序用的
+    (timestamp 列, id 列)，默认是 (Post.timestamp, Post.id)；cursor_of 从结果中的
+    一项取出对应的 (timestamp, id)。每页只查询一次，多取一行用来判断是否还有下一页。
+    """
+    timestamp_key, id_key = keys or (Post.timestamp, Post.id)
+    if cursor_of is None:
+        cursor_of = lambda item: (item.timestamp, item.id)
+    query = query.order_by(None)
+    after_cursor = decode_cursor(after)
+    before_cursor = decode_cursor(before)
+    if after_cursor is not None:
+        timestamp, id = after_cursor
+        items = query.filter(db.or_(
+            timestamp_key > timestamp,
+            db.and_(timestamp_key == timestamp, id_key > id)
+        )).order_by(timestamp_key.asc(), id_key.asc()).limit(per_page + 1).all()
+        has_newer = len(items) > per_page
+        items = items[:per_page][::-1]
+        if not items:
+            # 游标之后的 post 被删光了，留一个回到来时那一页的链接；id + 1 让那一页包含游标本身
+            return KeysetPagination(items, encode_cursor(timestamp, id + 1), None)
+        return KeysetPagination(items,
+                                encode_cursor(*cursor_of(items[-1])),
+                                encode_cursor(*cursor_of(items[0])) if has_newer else None)
+    if before_cursor is not None:
+        timestamp, id = before_cursor
+        query = query.filter(db.or_(
+            timestamp_key < timestamp,
+            db.and_(timestamp_key == timestamp, id_key < id)
+        ))
+    items = query.order_by(timestamp_key.desc(), id_key.desc()).limit(per_page + 1).all()
+    has_older = len(items) > per_page
+    items = items[:per_page]
+    if not items:
+        if before_cursor is None:
+            return KeysetPagination(items, None, None)
+        # 游标之前的 post 被删光了，留一个回到来时那一页的链接
+        timestamp, id = before_cursor
+        return KeysetPagination(items, None, encode_cursor(timestamp, id - 1))
+    return KeysetPagination(items,
+                            encode_cursor(*cursor_of(items[-1])) if has_older else None,
+                            encode_cursor(*cursor_of(items[0])) if before_cursor is not None else None)
@@ -0,0 +1,139 @@
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+
+
+class HashingBusy(Exception):
+    """等待计算密码哈希的请求超过了 PASSWORD_HASH_QUEUE。"""
+    pass
+
+
+class PasswordHasher(object):
+    """在独立的进程池里计算密码哈希，不占用处理请求的线程的 CPU。
+
+    同时排队的哈希计算最多 PASSWORD_HASH_QUEUE 个，超过时等待
+    PASSWORD_HASH_QUEUE_TIMEOUT 秒后抛出 HashingBusy。
+    PASSWORD_HASH_WORKERS 为 0 时在当前线程里直接计算。
+    """
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['password_hasher'] = self
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+
+    @property
+    def method(self):
+        # werkzeug 存储的方法里总是带着迭代次数，比如 pbkdf2:sha256:50000
+        method = current_app.config['PASSWORD_HASH_METHOD']
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method = '{}:{}'.format(method, DEFAULT_PBKDF2_ITERATIONS)
+        return method
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method,
+                         current_app.config['PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # 哈希算法、迭代次数或 salt 长度和当前配置不同
+        if pwhash.count('$') < 2:
+            return True
+        method, salt, _ = pwhash.split('$', 2)
+        return method != self.method or len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
+
+    def _run(self, func, *args):
+        workers = current_app.config['PASSWORD_HASH_WORKERS']
+        if not workers:
+            return func(*args)
+        if not self._slots.acquire(timeout=current_app.config['PASSWORD_HASH_QUEUE_TIMEOUT']):
+            raise HashingBusy()
+        try:
+            return self._get_executor(workers).submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_executor(self, workers):
+        # 第一次用到时才创建进程池，避免在 gunicorn 之类 fork 之前就创建子进程
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+            return self._executor
+
+
+class LoginThrottle(object):
+    """按用户名和 IP 记录登录失败次数（滑动窗口）。
+
+    一个 key 在 LOGIN_ATTEMPT_WINDOW 秒内失败次数达到上限后，在窗口过去之前
+    直接拒绝登录，不再计算密码哈希。每过一个窗口清理一次所有过期的 key，
+    用大量不同用户名或 IP 尝试登录也不会让内存一直增长。
+    """
+
+    def __init__(self, app=None):
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._swept_at = time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['login_throttle'] = self
+
+    def _limits(self, username, ip):
+        config = current_app.config
+        return [('user:' + username.lower(), config['LOGIN_MAX_ATTEMPTS']),
+                ('ip:' + (ip or ''), config['LOGIN_MAX_ATTEMPTS_PER_IP'])]
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        window_start = now - current_app.config['LOGIN_ATTEMPT_WINDOW']
+        while failures and failures[0] < window_start:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def is_blocked(self, username, ip):
+        now = time()
+        with self._lock:
+            for key, limit in self._limits(username, ip):
+                failures = self._recent(key, now)
+                if failures is not None and len(failures) >= limit:
+                    return True
+        return False
+
+    def record_failure(self, username, ip):
+        now = time()
+        with self._lock:
+            for key, limit in self._limits(username, ip):
+                failures = self._recent(key, now)
+                if failures is None:
+                    failures = self._failures[key] = deque(maxlen=limit)
+                failures.append(now)
+            window = current_app.config['LOGIN_ATTEMPT_WINDOW']
+            if now - self._swept_at > window:
+                # 最近一次失败已经在窗口之外的 key 整个删掉
+                self._failures = {key: failures for key, failures in self._failures.items()
+                                  if failures[-1] >= now - window}
+                self._swept_at = now
+
+    def __len__(self):
+        return len(self._failures)
+
+    def reset(self, username):
+        with self._lock:
+            self._failures.pop('user:' + username.lower(), None)
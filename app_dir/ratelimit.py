@@ -0,0 +1,200 @@
+import re
+import threading
+from time import time
+from flask import current_app, g, request
+from flask_login import current_user
+from app_dir.cache import get_redis
+
+
+RATE_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$')
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimitExceeded(Exception):
+    """请求超过了 RATELIMITS 里为这个端点配置的速率，retry_after 秒后可以重试。"""
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
+
+def parse_rate(rate):
+    """'10/minute'、'5/10minutes' 这样的字符串或 (次数, 秒数) 转成 (次数, 秒数)。"""
+    if isinstance(rate, (tuple, list)):
+        count, period = rate
+        return int(count), float(period)
+    match = RATE_RE.match(rate)
+    if match is None:
+        raise ValueError('Invalid rate limit {!r}.'.format(rate))
+    count, multiplier, unit = match.groups()
+    return int(count), float(int(multiplier or 1) * PERIODS[unit])
+
+
+def gcra(tat, now, count, period):
+    """GCRA（通用信元速率算法），等价于容量为 count、每 period / count 秒补充一个的令牌桶。
+
+    每个 key 只需要保存一个数：理论到达时间 tat。返回 (新的 tat, 需要等待的秒数)，
+    等待秒数为 0 表示放行，这时把新的 tat 存回去，它过期之前都要保留。
+    """
+    interval = period / count
+    tat = max(tat or now, now) + interval
+    wait = tat - period - now
+    if wait > 0:
+        return None, wait
+    return tat, 0
+
+
+class MemoryBackend(object):
+    """进程内的后端，多进程部署时每个进程各自计数。"""
+
+    def __init__(self, sweep_interval=60):
+        self._tats = {}
+        self._lock = threading.Lock()
+        self._swept_at = time()
+        self.sweep_interval = sweep_interval
+
+    def __len__(self):
+        return len(self._tats)
+
+    def hit(self, limits):
+        """limits 是 [(key, count, period)]，全部放行时才记下这次请求，返回需要等待的秒数。"""
+        now = time()
+        with self._lock:
+            results = [(key, gcra(self._tats.get(key), now, count, period)) for key, count, period in limits]
+            wait = max(key_wait for _, (_, key_wait) in results)
+            if not wait:
+                self._tats.update((key, tat) for key, (tat, _) in results)
+            # tat 已经过去的 key 和不存在一样，定期清掉，内存只跟最近活跃的 key 数有关
+            if now - self._swept_at > self.sweep_interval:
+                self._tats = {k: v for k, v in self._tats.items() if v > now}
+                self._swept_at = now
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._tats.clear()
+
+
+class RedisBackend(object):
+    """多个进程共享的后端，每个 key 在 Redis 里是一个带过期时间的字符串。"""
+
+    def __init__(self, app, prefix='ratelimit:'):
+        self.app = app
+        self.prefix = prefix
+
+    @property
+    def client(self):
+        return get_redis(self.app)
+
+    def hit(self, limits):
+        from redis import WatchError
+        keys = [self.prefix + key for key, _, _ in limits]
+        # WATCH/MULTI 乐观锁：读出 tat 之后任何一个 key 被别的进程改了就重试
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(*keys)
+                    now = time()
+                    results = []
+                    for key, (_, count, period) in zip(keys, limits):
+                        stored = pipe.get(key)
+                        results.append(gcra(float(stored) if stored is not None else None, now, count, period))
+                    wait = max(key_wait for _, key_wait in results)
+                    if wait:
+                        pipe.unwatch()
+                        return wait
+                    pipe.multi()
+                    for key, (tat, _) in zip(keys, results):
+                        pipe.set(key, repr(tat), px=max(1, int((tat - now) * 1000) + 1))
+                    pipe.execute()
+                    return 0
+                except WatchError:
+                    continue
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class RateLimiter(object):
+    """按端点限制请求速率，超过时抛出 RateLimitExceeded，返回 429 和 Retry-After。
+
+    RATELIMITS 的 key 是端点名，可以加上 ':方法' 只限制某种请求（比如 'main.index:POST'），
+    值是 '10/minute' 这样的速率，多个速率用分号分开。一个请求匹配的所有速率都放行时
+    才计数，被拒绝的请求不占用任何一个速率的额度。登录用户和 API 令牌用户按用户 id
+    计数，匿名用户按 IP 计数。RATELIMIT_BACKEND 为 local（进程内）、redis（多进程共享）
+    或留空关闭。
+
+    API 的视图在 before_request 里还不知道是哪个用户，认证装饰器给视图加上
+    ratelimit_after_auth 标记，设置好 g.api_user 之后再调用 check_authenticated()。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.rules = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.backend = None
+        self.rules = {}
+        backend = app.config['RATELIMIT_BACKEND']
+        if not backend:
+            return
+        if backend == 'local':
+            self.backend = MemoryBackend()
+        elif backend == 'redis':
+            self.backend = RedisBackend(app)
+        else:
+            raise ValueError('Unknown rate limit backend {!r}.'.format(backend))
+        for name, rates in app.config['RATELIMITS'].items():
+            if isinstance(rates, str):
+                rates = [rate for rate in rates.split(';') if rate.strip()]
+            elif isinstance(rates, tuple):
+                rates = [rates]
+            self.rules[name] = [parse_rate(rate) for rate in rates]
+        app.extensions['ratelimit'] = self
+        app.before_request(self.check_request)
+
+    def identity(self):
+        api_user = g.get('api_user')
+        if api_user is not None:
+            return 'user:{}'.format(api_user.id)
+        if current_user.is_authenticated:
+            return 'user:{}'.format(current_user.id)
+        return 'ip:{}'.format(request.remote_addr or '')
+
+    def check_request(self):
+        if request.endpoint is None:
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'ratelimit_after_auth', False):
+            return
+        self.check_endpoint()
+
+    def check_authenticated(self):
+        if self.backend is not None:
+            self.check_endpoint()
+
+    def check_endpoint(self):
+        method_rule = '{}:{}'.format(request.endpoint, request.method)
+        identity = self.identity()
+        limits = []
+        for name in (method_rule, request.endpoint):
+            for count, period in self.rules.get(name, ()):
+                key = '{}/{}/{}/{}'.format(name, identity, count, int(period))
+                limits.append((key, count, period))
+        if limits:
+            self.check(limits)
+
+    def check(self, limits):
+        """limits 是 [(key, count, period)]，有一个超过就抛出 RateLimitExceeded，什么都不计数。"""
+        wait = self.backend.hit(limits)
+        if wait:
+            raise RateLimitExceeded(wait)
+
+    def reset(self):
+        if self.backend is not None:
+            self.backend.clear()
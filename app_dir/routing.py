@@ -0,0 +1,81 @@
+import random
+import re
+from functools import wraps
+from time import time
+from flask import current_app, g, has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+
+# text() 写的 SQL 只有 SELECT 发到副本，DDL、INSERT、PRAGMA 之类的都当作写
+SELECT_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+
+
+def is_write(clause):
+    if isinstance(clause, UpdateBase):
+        return True
+    return isinstance(clause, TextClause) and not SELECT_RE.match(clause.text)
+
+
+class RoutingSession(SignallingSession):
+    """把 GET 请求里的查询发到只读副本，其余的都走主库。
+
+    下面几种情况使用主库：
+    - 不在请求里（命令行、后台线程）或者没有配置 SQLALCHEMY_REPLICAS；
+    - 不是 GET/HEAD 请求，或者视图用 use_primary 标记过；
+    - 这个请求已经写过数据库（flush、执行了 INSERT/UPDATE/DELETE 或者不是 SELECT 的
+      text() 语句），之后的读取都留在主库，保证读到自己刚写的数据；
+    - 用户自己写过数据后的 REPLICA_LAG_WINDOW 秒内，防止副本延迟导致看不到自己的修改。
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.replica_bind(clause)
+        if replica is not None:
+            return get_state(self.app).db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def replica_bind(self, clause):
+        if not has_request_context():
+            return None
+        replicas = self.app.config['SQLALCHEMY_REPLICAS']
+        if not replicas:
+            return None
+        if self._flushing or is_write(clause):
+            g.db_wrote = True
+            return None
+        if g.get('db_wrote') or g.get('use_primary') or request.method not in ('GET', 'HEAD'):
+            return None
+        if flask_session.get('_primary_until', 0) > time():
+            return None
+        # 同一个请求只用一个副本，各个查询看到的是同一份数据
+        if 'replica_bind' not in g:
+            g.replica_bind = random.choice(replicas)
+        return g.replica_bind
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+        app.after_request(remember_write)
+
+
+def remember_write(response):
+    # 写过数据的用户接下来一段时间的请求都读主库，记在 session cookie 里。
+    # API 客户端用令牌认证、不带 session cookie，不给它们创建 session
+    if g.get('db_wrote') and current_app.config['SQLALCHEMY_REPLICAS'] and g.get('api_user') is None:
+        flask_session['_primary_until'] = time() + current_app.config['REPLICA_LAG_WINDOW']
+    return response
+
+
+def use_primary(f):
+    # 用 GET 请求修改数据的视图（比如 follow），要在主库上读到最新的状态再写
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.use_primary = True
+        return f(*args, **kwargs)
+    return decorated_function
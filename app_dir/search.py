@@ -0,0 +1,297 @@
+import base64
+import math
+import re
+import shelve
+import sqlite3
+import threading
+from collections import Counter
+from flask import current_app
+from sqlalchemy import select, text
+from app_dir import db
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+# 中日韩文字之间没有空格，按相邻两个字（bigram）切分
+CJK_RUN_RE = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+)')
+
+STOPWORDS = {
+    'en': {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into',
+           'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then',
+           'there', 'these', 'they', 'this', 'to', 'was', 'will', 'with'},
+    'fr': {'au', 'aux', 'avec', 'ce', 'ces', 'dans', 'de', 'des', 'du', 'elle', 'en', 'et',
+           'il', 'je', 'la', 'le', 'les', 'leur', 'lui', 'ma', 'mais', 'me', 'mes', 'ne', 'nous',
+           'on', 'ou', 'par', 'pas', 'pour', 'qu', 'que', 'qui', 'sa', 'se', 'ses', 'son', 'sur',
+           'ta', 'te', 'tes', 'ton', 'tu', 'un', 'une', 'vous'},
+    'de': {'aber', 'als', 'am', 'an', 'auch', 'auf', 'aus', 'bei', 'bin', 'das', 'dass', 'dem',
+           'den', 'der', 'des', 'die', 'du', 'ein', 'eine', 'einem', 'einen', 'einer', 'er', 'es',
+           'für', 'hat', 'ich', 'im', 'in', 'ist', 'mit', 'nicht', 'noch', 'sie', 'sind', 'und',
+           'von', 'was', 'wie', 'wir', 'zu', 'zum', 'zur'},
+    'es': {'al', 'como', 'con', 'de', 'del', 'el', 'en', 'es', 'la', 'las', 'lo', 'los', 'mas',
+           'me', 'mi', 'no', 'o', 'para', 'pero', 'por', 'que', 'se', 'si', 'su', 'sus', 'un',
+           'una', 'y', 'ya'},
+}
+ALL_STOPWORDS = set().union(*STOPWORDS.values())
+
+
+def tokenize(body, language=None):
+    """把文本切成检索词。
+
+    language 是 Post.language 或者搜索时的界面语言（比如 en、zh），用来去掉对应语言的停用词；
+    language 为 None 时（还没检测出语言的 post）去掉所有已知语言的停用词。
+    中日韩文字不管 language 是什么都按 bigram 切分。
+    """
+    stopwords = ALL_STOPWORDS if language is None else STOPWORDS.get(language[:2], ())
+    tokens = []
+    for word in WORD_RE.findall(body.lower()):
+        for i, part in enumerate(CJK_RUN_RE.split(word)):
+            if not part:
+                continue
+            if i % 2:
+                tokens.extend([part] if len(part) == 1 else
+                              [part[j:j + 2] for j in range(len(part) - 1)])
+            elif part not in stopwords:
+                tokens.append(part)
+    return tokens
+
+
+def encode_cursor(score, id):
+    raw = '{!r}|{}'.format(score, id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        score, id = raw.decode('utf-8').split('|')
+        return float(score), int(id)
+    except ValueError:
+        return None
+
+
+class FTS5Backend(object):
+    """SQLite FTS5 虚拟表 post_search，rowid 就是 post.id。
+
+    写入默认走 db.session，和新 post 的 INSERT 在同一个事务里提交；
+    重建索引时传入单独的连接 conn。表由迁移创建，setup 只在重建索引时补建。
+    """
+
+    def setup(self, conn):
+        conn.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(terms)'))
+
+    def add(self, docs, conn=None):
+        # docs 是 [(post_id, terms), ...]
+        if not docs:
+            return
+        conn = db.session if conn is None else conn
+        params = [{'id': id, 'terms': ' '.join(terms)} for id, terms in docs]
+        conn.execute(text('DELETE FROM post_search WHERE rowid = :id'), params)
+        conn.execute(text('INSERT INTO post_search (rowid, terms) VALUES (:id, :terms)'), params)
+
+    def clear(self, conn=None):
+        (db.session if conn is None else conn).execute(text('DELETE FROM post_search'))
+
+    def search(self, terms, limit, cursor=None):
+        # bm25() 越小越相关，取负数后和 Python 索引一样按分数从高到低排列
+        match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        sql = 'SELECT rowid, -bm25(post_search) AS score FROM post_search WHERE post_search MATCH :match'
+        params = {'match': match, 'limit': limit}
+        if cursor is not None:
+            sql += ' AND (-bm25(post_search) < :score OR (-bm25(post_search) = :score AND rowid > :id))'
+            params['score'], params['id'] = cursor
+        sql += ' ORDER BY score DESC, rowid LIMIT :limit'
+        return [(row[0], row[1]) for row in db.session.execute(text(sql), params)]
+
+
+class PythonBackend(object):
+    """用 shelve 存在磁盘上的倒排索引，没有 FTS5 时使用，按 BM25 打分。
+
+    t:<term> -> {post_id: (词频, 文档长度)}，d:<post_id> -> 文档的检索词，
+    meta -> (文档数, 总词数)。只适合单进程写入。
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _open(self, flag='c'):
+        # shelve 只在第一次用到时打开一次，dbm.dumb 之类的实现每次打开都要读整个目录文件
+        if self._index is None or flag == 'n':
+            if self._index is not None:
+                self._index.close()
+            self._index = shelve.open(self.path, flag=flag)
+        return self._index
+
+    def setup(self, conn=None):
+        with self._lock:
+            self._open().setdefault('meta', (0, 0))
+
+    def close(self):
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+    def add(self, docs, conn=None):
+        if not docs:
+            return
+        with self._lock:
+            index = self._open()
+            count, total = index.get('meta', (0, 0))
+            postings = {}
+            for id, terms in docs:
+                count, total = self._remove(index, id, count, total, postings)
+                index['d:{}'.format(id)] = terms
+                count += 1
+                total += len(terms)
+                for term, tf in Counter(terms).items():
+                    self._posting(index, postings, term)[id] = (tf, len(terms))
+            for term, posting in postings.items():
+                if posting:
+                    index['t:' + term] = posting
+                else:
+                    index.pop('t:' + term, None)
+            index['meta'] = (count, total)
+            index.sync()
+
+    def _posting(self, index, postings, term):
+        if term not in postings:
+            postings[term] = index.get('t:' + term, {})
+        return postings[term]
+
+    def _remove(self, index, id, count, total, postings):
+        terms = index.pop('d:{}'.format(id), None)
+        if terms is None:
+            return count, total
+        for term in set(terms):
+            self._posting(index, postings, term).pop(id, None)
+        return count - 1, total - len(terms)
+
+    def clear(self, conn=None):
+        with self._lock:
+            self._open('n')['meta'] = (0, 0)
+
+    def search(self, terms, limit, cursor=None):
+        with self._lock:
+            index = self._open()
+            count, total = index.get('meta', (0, 0))
+            postings = [index.get('t:' + term, {}) for term in set(terms)]
+        if not count or not all(postings):
+            return []
+        ids = set.intersection(*(set(posting) for posting in postings))
+        average = total / count
+        scores = []
+        for id in ids:
+            score = 0.0
+            for posting in postings:
+                idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+                tf, length = posting[id]
+                score += idf * tf * (self.K1 + 1) / (
+                    tf + self.K1 * (1 - self.B + self.B * length / average))
+            if cursor is None or score < cursor[0] or (score == cursor[0] and id > cursor[1]):
+                scores.append((id, score))
+        scores.sort(key=lambda item: (-item[1], item[0]))
+        return scores[:limit]
+
+
+class SearchIndex(object):
+    """post 正文的全文检索。
+
+    SEARCH_BACKEND 为 auto 时，数据库是支持 FTS5 的 SQLite 就用 FTS5，
+    否则用 SEARCH_INDEX_PATH 下的 Python 倒排索引；为 None 时关闭检索。
+    FTS5 的 post_search 表由迁移创建，init_app 不连接数据库。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['search'] = None
+        if not app.config['SEARCH_BACKEND']:
+            return
+        app.extensions['search'] = self._create_backend(app, db.get_engine(app))
+
+    @property
+    def backend(self):
+        return current_app.extensions['search']
+
+    def _create_backend(self, app, engine):
+        name = app.config['SEARCH_BACKEND']
+        if name == 'auto':
+            name = 'fts5' if self._fts5_available(engine) else 'python'
+        if name == 'fts5':
+            return FTS5Backend()
+        if name == 'python':
+            return PythonBackend(app.config['SEARCH_INDEX_PATH'])
+        raise ValueError('Unknown search backend {!r}.'.format(name))
+
+    def _fts5_available(self, engine):
+        # 应用和迁移用的是同一个 sqlite3 模块，在内存数据库里试一下就知道有没有 FTS5
+        if engine.dialect.name != 'sqlite':
+            return False
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute('CREATE VIRTUAL TABLE fts5_probe USING fts5(x)')
+        except sqlite3.OperationalError:
+            return False
+        finally:
+            conn.close()
+        return True
+
+    def add_posts(self, posts):
+        backend = self.backend
+        if backend is not None:
+            backend.add([(post.id, tokenize(post.body, post.language or None)) for post in posts])
+
+    def reindex(self, chunk_size=1000, progress=None):
+        """分批重建索引，每批在主库上单独的事务里读 post、写索引。"""
+        from app_dir.models import Post
+        backend = self.backend
+        engine = db.get_engine(current_app._get_current_object())
+        post = Post.__table__
+        with engine.begin() as conn:
+            backend.setup(conn)
+            backend.clear(conn)
+        last_id = 0
+        done = 0
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(select([post.c.id, post.c.body, post.c.language]).where(
+                    post.c.id > last_id).order_by(post.c.id).limit(chunk_size)).fetchall()
+                if not rows:
+                    break
+                backend.add([(id, tokenize(body or '', language or None)) for id, body, language in rows], conn)
+            last_id = rows[-1][0]
+            done += len(rows)
+            if progress is not None:
+                progress(done)
+        return done
+
+    def search(self, query, per_page, after=None, language=None):
+        """返回 (按相关度排序的 post 列表, 下一页的游标)。
+
+        language 是用户的界面语言，只去掉这种语言的停用词：
+        英语用户搜 die 不会因为它是德语停用词而什么都搜不到。
+        """
+        from app_dir.models import Post
+        terms = tokenize(query, language or '')
+        backend = self.backend
+        if not terms or backend is None:
+            return [], None
+        hits = backend.search(terms, per_page + 1, decode_cursor(after))
+        next_cursor = None
+        if len(hits) > per_page:
+            hits = hits[:per_page]
+            next_cursor = encode_cursor(hits[-1][1], hits[-1][0])
+        posts = Post.load_authors(Post.query.filter(Post.id.in_([id for id, _ in hits]))).all()
+        posts = {post.id: post for post in posts}
+        return [posts[id] for id, _ in hits if id in posts], next_cursor
+
+
+search_index = SearchIndex()
@@ -0,0 +1,243 @@
+import atexit
+import logging
+import re
+import secrets
+import threading
+import weakref
+from datetime import datetime
+from flask import current_app
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SecureCookieSession, SecureCookieSessionInterface
+from app_dir.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+SID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+def new_sid():
+    # 256 位随机数，cookie 里只有它，不需要签名
+    return secrets.token_urlsafe(32)
+
+
+class ServerSession(SecureCookieSession):
+    """数据存在服务端的 session，sid 为 None 表示还没有保存过。"""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        SecureCookieSession.__init__(self, initial)
+        self.sid = sid
+        self.expires = expires
+        self.loaded_user_id = self.get('user_id')
+
+
+class SQLSessionStore(object):
+    """存在 web_session 表里，直接用连接池里的连接，不参与请求里 db.session 的事务。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @property
+    def table(self):
+        from app_dir.models import WebSession
+        return WebSession.__table__
+
+    def engine(self):
+        from app_dir import db
+        return db.get_engine(self.app)
+
+    def load(self, sid):
+        table = self.table
+        with self.engine().connect() as conn:
+            row = conn.execute(table.select().where(table.c.sid == sid)).first()
+        if row is None or row.expires < datetime.utcnow():
+            return None
+        return row.data, row.expires
+
+    def save(self, sid, user_id, data, expires):
+        table = self.table
+        with self.engine().begin() as conn:
+            values = {'user_id': user_id, 'data': data, 'expires': expires}
+            if not conn.execute(table.update().where(table.c.sid == sid).values(**values)).rowcount:
+                conn.execute(table.insert().values(sid=sid, **values))
+
+    def delete(self, sid):
+        table = self.table
+        with self.engine().begin() as conn:
+            conn.execute(table.delete().where(table.c.sid == sid))
+
+    def delete_user(self, user_id):
+        table = self.table
+        with self.engine().begin() as conn:
+            return conn.execute(table.delete().where(table.c.user_id == user_id)).rowcount
+
+    def sweep(self):
+        table = self.table
+        with self.engine().begin() as conn:
+            return conn.execute(table.delete().where(table.c.expires < datetime.utcnow())).rowcount
+
+
+class MemorySessionStore(object):
+    """进程内的 LRU，重启后 session 全部丢失，只适合单进程部署和测试。"""
+
+    def __init__(self, maxsize):
+        self.cache = LRUCache(maxsize)
+
+    def load(self, sid):
+        item = self.cache.get(sid)
+        if item is None:
+            return None
+        user_id, data, expires = item
+        return data, expires
+
+    def save(self, sid, user_id, data, expires):
+        ttl = max(1, (expires - datetime.utcnow()).total_seconds())
+        self.cache.set(sid, (user_id, data, expires), ttl)
+
+    def delete(self, sid):
+        self.cache.delete(sid)
+
+    def delete_user(self, user_id):
+        return self.cache.delete_matching(lambda item: item[0] == user_id)
+
+    def sweep(self):
+        now = datetime.utcnow()
+        return self.cache.delete_matching(lambda item: item[2] < now)
+
+
+class ServerSessionInterface(SessionInterface):
+    """cookie 里只放不透明的 sid，session 数据存在 store 里。
+
+    只有 session 被修改过，或者有效期已经过了一半时才写回 store；session 被清空时
+    删除 store 里的记录和 cookie。登录或登出（session 里的 user_id 变化）时换一个新的 sid，
+    防止 session 固定攻击。
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, on_save=None):
+        self.store = store
+        self.on_save = on_save
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and SID_RE.match(sid):
+            record = self.store.load(sid)
+            if record is not None:
+                data, expires = record
+                return ServerSession(self.serializer.loads(data), sid, expires)
+        return ServerSession()
+
+    def lifetime(self, app, session):
+        return app.permanent_session_lifetime if session.permanent else app.config['SESSION_IDLE_LIFETIME']
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        now = datetime.utcnow()
+        lifetime = self.lifetime(app, session)
+        if not session.modified and session.sid is not None and session.expires - now > lifetime / 2:
+            return
+        sid = session.sid
+        if sid is not None and session.get('user_id') != session.loaded_user_id:
+            self.store.delete(sid)
+            sid = None
+        if sid is None:
+            sid = new_sid()
+        self.store.save(sid, session.get('user_id'), self.serializer.dumps(dict(session)), now + lifetime)
+        # 永久 session 的 cookie 过期时间随每次写回顺延，非永久的是浏览器会话 cookie
+        if sid != session.sid or session.permanent:
+            response.set_cookie(app.session_cookie_name, sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        if self.on_save is not None:
+            self.on_save()
+
+
+class ServerSessions(object):
+    """按 SESSION_BACKEND 注册服务端 session：sql、memory，留空时使用 Flask 默认的签名 cookie。
+
+    过期的 session 由后台线程每 SESSION_SWEEP_INTERVAL 秒批量删除一次（0 表示不启动线程，
+    用 flask sessions sweep 定时清理）。每个 app 的 store 和后台线程放在
+    app.extensions['server_sessions'] 里。
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # 各个 app 后台线程的停止信号，进程退出时全部停掉
+        self._stops = weakref.WeakSet()
+        atexit.register(self.stop)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['SESSION_BACKEND']
+        if not backend:
+            app.session_interface = SecureCookieSessionInterface()
+            return
+        if backend == 'sql':
+            store = SQLSessionStore(app)
+        elif backend == 'memory':
+            store = MemorySessionStore(app.config['SESSION_MEMORY_SIZE'])
+        else:
+            raise ValueError('Unknown session backend {!r}.'.format(backend))
+        app.session_interface = ServerSessionInterface(store, on_save=self._ensure_worker)
+        app.extensions['server_sessions'] = {'store': store, 'worker': None, 'stop': threading.Event()}
+
+    @staticmethod
+    def get_store(app=None):
+        state = (app or current_app).extensions.get('server_sessions')
+        return state['store'] if state is not None else None
+
+    def revoke(self, user_id, app=None):
+        """删除一个用户的所有 session，比如重置密码之后让其他设备上的登录失效。"""
+        store = self.get_store(app)
+        if store is None:
+            return 0
+        return store.delete_user(user_id)
+
+    def sweep(self, app=None):
+        store = self.get_store(app)
+        if store is None:
+            return 0
+        return store.sweep()
+
+    def stop(self, app=None):
+        if app is not None:
+            state = app.extensions.get('server_sessions')
+            if state is not None:
+                state['stop'].set()
+            return
+        for stop in list(self._stops):
+            stop.set()
+
+    def _ensure_worker(self):
+        app = current_app._get_current_object()
+        state = app.extensions['server_sessions']
+        if state['worker'] is not None or not app.config['SESSION_SWEEP_INTERVAL']:
+            return
+        with self._lock:
+            if state['worker'] is not None:
+                return
+            state['worker'] = threading.Thread(target=self._run, args=(app, state['stop']),
+                                               name='session-sweeper')
+            state['worker'].daemon = True
+            self._stops.add(state['stop'])
+        state['worker'].start()
+
+    def _run(self, app, stop):
+        while not stop.wait(app.config['SESSION_SWEEP_INTERVAL']):
+            try:
+                self.sweep(app)
+            except Exception:
+                logger.exception('Failed to sweep expired sessions')
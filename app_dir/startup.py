@@ -0,0 +1,137 @@
+import importlib.abc
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+
+
+# 启动分析要在一个还没有导入过 app_dir 的新解释器里运行。python -m app_dir.startup 会先导入
+# app_dir 包本身，所以子进程按文件路径加载这个模块，不经过 app_dir/__init__.py
+RUNNER = (
+    'import importlib.util, sys\n'
+    'spec = importlib.util.spec_from_file_location("startup_profile", sys.argv[1])\n'
+    'module = importlib.util.module_from_spec(spec)\n'
+    'spec.loader.exec_module(module)\n'
+    'module.main(sys.argv[2:])\n'
+)
+
+
+def run_in_subprocess(args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.call([sys.executable, '-c', RUNNER, os.path.abspath(__file__)] + list(args), cwd=root)
+
+
+class TimedLoader(object):
+    """包装真正的 loader，统计模块执行（import 语句主体）的耗时。"""
+
+    def __init__(self, loader, timer):
+        self.loader = loader
+        self.timer = timer
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # 模块上留原来的 loader，pkgutil、jinja2 的 PackageLoader 之类靠它读包里的文件
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        with self.timer.measure(module.__name__):
+            self.loader.exec_module(module)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """和 python -X importtime 一样按模块统计导入耗时（自身和累计），Python 3.6 也能用。"""
+
+    def __init__(self):
+        self.records = []   # [(模块名, 自身耗时, 累计耗时)]
+        self._children = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    @contextmanager
+    def measure(self, name):
+        self._children.append(0.0)
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            total = perf_counter() - started
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += total
+            self.records.append((name, total - children, total))
+
+    def by_package(self):
+        totals = {}
+        for name, own, _ in self.records:
+            package = name.split('.')[0]
+            totals[package] = totals.get(package, 0.0) + own
+        return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def profile_startup(top=20, path='/auth/login'):
+    """返回 [(阶段, 秒数)]、按包汇总的导入耗时和最慢的 top 个模块。"""
+    timer = ImportTimer()
+    phases = []
+    timer.install()
+    try:
+        started = perf_counter()
+        from app_dir import create_app
+        from config import Config
+        phases.append(('import app_dir', perf_counter() - started))
+
+        class ProfileConfig(Config):
+            # 只看启动本身：session 放内存里，不需要数据库里有 web_session 表
+            SESSION_BACKEND = 'memory'
+            RATELIMIT_BACKEND = ''
+
+        started = perf_counter()
+        app = create_app(ProfileConfig)
+        phases.append(('create_app()', perf_counter() - started))
+        client = app.test_client()
+        for label in ('first request', 'second request'):
+            started = perf_counter()
+            client.get(path)
+            phases.append(('{} GET {}'.format(label, path), perf_counter() - started))
+    finally:
+        timer.uninstall()
+    slowest = sorted(timer.records, key=lambda record: -record[1])[:top]
+    return phases, timer.by_package()[:top], slowest
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='flask profile startup', description='Profile app startup.')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--path', default='/auth/login')
+    args = parser.parse_args(argv)
+    phases, packages, slowest = profile_startup(args.top, args.path)
+    print('Startup phases:')
+    for label, seconds in phases:
+        print('  {:>9.1f} ms  {}'.format(seconds * 1000, label))
+    print('Import time by top-level package (self time):')
+    for package, seconds in packages:
+        print('  {:>9.1f} ms  {}'.format(seconds * 1000, package))
+    print('Slowest modules (self / cumulative):')
+    for name, own, total in slowest:
+        print('  {:>9.1f} ms  {:>9.1f} ms  {}'.format(own * 1000, total * 1000, name))
@@ -0,0 +1,279 @@
+import atexit
+import heapq
+import logging
+import threading
+from array import array
+from datetime import datetime
+from time import time
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+
+class FollowGraph(object):
+    """follows 表在内存里的 CSR（压缩稀疏行）表示。
+
+    用户 u 关注的人是 out_targets[out_offsets[u]:out_offsets[u + 1]]，
+    u 的粉丝是 in_sources[in_offsets[u]:in_offsets[u + 1]]，都是 array('i')，
+    每条边在两个方向上各占 4 个字节。加载之后的 follow/unfollow 记在
+    added_*/removed_* 里，下次重新加载时合并进数组。
+    """
+
+    def __init__(self, size, out_offsets, out_targets, in_offsets, in_sources):
+        self.size = size
+        self.out_offsets = out_offsets
+        self.out_targets = out_targets
+        self.in_offsets = in_offsets
+        self.in_sources = in_sources
+        # 加载之后的改动：用户 id -> 新增/删除的邻居集合
+        self.added_stars = {}
+        self.removed_stars = {}
+        self.added_fans = {}
+        self.removed_fans = {}
+        self.loaded_at = time()
+
+    @classmethod
+    def from_edges(cls, edges, size=None):
+        """edges 是 (fan_id, star_id) 的可迭代对象，size 是最大的用户 id + 1。"""
+        fans = array('i')
+        stars = array('i')
+        for fan_id, star_id in edges:
+            fans.append(fan_id)
+            stars.append(star_id)
+        if size is None:
+            size = max(max(fans, default=0), max(stars, default=0)) + 1
+        out_offsets, out_targets = cls._compress(fans, stars, size)
+        in_offsets, in_sources = cls._compress(stars, fans, size)
+        return cls(size, out_offsets, out_targets, in_offsets, in_sources)
+
+    @staticmethod
+    def _compress(rows, columns, size):
+        # 计数排序：先数出每一行的长度算出偏移，再把每条边放进自己那一行
+        offsets = array('i', bytes(4 * (size + 1)))
+        for row in rows:
+            offsets[row + 1] += 1
+        for i in range(size):
+            offsets[i + 1] += offsets[i]
+        cursor = array('i', offsets)
+        values = array('i', bytes(4 * len(rows)))
+        for row, column in zip(rows, columns):
+            values[cursor[row]] = column
+            cursor[row] += 1
+        return offsets, values
+
+    def _neighbors(self, offsets, values, u, added, removed):
+        base = values[offsets[u]:offsets[u + 1]] if u < self.size else array('i')
+        extra = added.get(u)
+        gone = removed.get(u)
+        if not extra and not gone:
+            return base
+        base = [v for v in base if v not in gone] if gone else list(base)
+        if extra:
+            base.extend(v for v in extra if v not in base)
+        return base
+
+    def stars(self, u):
+        return self._neighbors(self.out_offsets, self.out_targets, u, self.added_stars, self.removed_stars)
+
+    def fans(self, u):
+        return self._neighbors(self.in_offsets, self.in_sources, u, self.added_fans, self.removed_fans)
+
+    def add_edge(self, fan_id, star_id):
+        self._update(self.removed_stars, self.added_stars, fan_id, star_id)
+        self._update(self.removed_fans, self.added_fans, star_id, fan_id)
+
+    def remove_edge(self, fan_id, star_id):
+        self._update(self.added_stars, self.removed_stars, fan_id, star_id)
+        self._update(self.added_fans, self.removed_fans, star_id, fan_id)
+
+    @staticmethod
+    def _update(discard_from, add_to, u, v):
+        if v in discard_from.get(u, ()):
+            discard_from[u].discard(v)
+        else:
+            add_to.setdefault(u, set()).add(v)
+
+    def nbytes(self):
+        arrays = (self.out_offsets, self.out_targets, self.in_offsets, self.in_sources)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    def suggest(self, u, k=10, fof_weight=1.0, shared_weight=0.5, max_neighbors=200):
+        """返回 u 的前 k 个推荐 [(用户 id, 分数)]。
+
+        朋友的朋友：u 关注的人又关注了谁，每条路径加 fof_weight；
+        共同粉丝：u 的粉丝还关注了谁，每条路径加 shared_weight。
+        粉丝和关注都只取前 max_neighbors 个，避免大 V 的计算量失控。
+        """
+        stars = self.stars(u)
+        following = set(stars)
+        scores = {}
+        for star in stars[:max_neighbors]:
+            for candidate in self.stars(star)[:max_neighbors]:
+                scores[candidate] = scores.get(candidate, 0.0) + fof_weight
+        for fan in self.fans(u)[:max_neighbors]:
+            for candidate in self.stars(fan)[:max_neighbors]:
+                scores[candidate] = scores.get(candidate, 0.0) + shared_weight
+        scores.pop(u, None)
+        for star in following:
+            scores.pop(star, None)
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+
+class SuggestionEngine(object):
+    """在内存里的关注图上计算“可能认识的人”，每个用户的前 SUGGESTIONS_PER_USER 个存进 suggestion 表。
+
+    flask suggestions compute 批量计算所有用户。User.follow/unfollow 把改动记在
+    session.info 里，提交之后交给 changed()，由后台线程每 SUGGESTION_REFRESH_INTERVAL 秒
+    更新内存中的图并重新计算受影响的用户（0 表示提交时立即计算）。每个进程各有一份图，
+    超过 SUGGESTION_GRAPH_TTL 秒后从数据库重新加载，合并其他进程的改动。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._graph = None
+        self._changes = []
+        # _lock 保护关注图，重新加载时可能要持有几秒；_changes 另用一把锁，
+        # after_commit 里调用 changed() 时不用等图加载完
+        self._lock = threading.RLock()
+        self._changes_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app_dir import db
+        self.app = app
+        app.extensions['suggestions'] = self
+        if not event.contains(db.session, 'after_commit', apply_follow_changes):
+            event.listen(db.session, 'after_commit', apply_follow_changes)
+            event.listen(db.session, 'after_rollback', discard_follow_changes)
+        atexit.register(self.stop)
+
+    @property
+    def graph(self):
+        with self._lock:
+            if self._graph is None or time() - self._graph.loaded_at > self.app.config['SUGGESTION_GRAPH_TTL']:
+                self._graph = self.load_graph()
+            return self._graph
+
+    def load_graph(self):
+        from app_dir import db
+        from app_dir.models import User, following_relationship_table as follows
+        engine = db.get_engine(self.app)
+        with engine.connect() as conn:
+            size = (conn.execute(db.select([db.func.max(User.id)])).scalar() or 0) + 1
+            result = conn.execution_options(stream_results=True).execute(
+                db.select([follows.c.fan_id, follows.c.star_id]))
+            return FollowGraph.from_edges(result, size)
+
+    def suggest(self, user_id):
+        config = self.app.config
+        with self._lock:
+            return self.graph.suggest(user_id, config['SUGGESTIONS_PER_USER'],
+                                      config['SUGGESTION_FOF_WEIGHT'],
+                                      config['SUGGESTION_SHARED_WEIGHT'],
+                                      config['SUGGESTION_MAX_NEIGHBORS'])
+
+    def save(self, results):
+        """results 是 {user_id: [(suggested_id, score)]}，整体替换这些用户的推荐。"""
+        from app_dir import db
+        from app_dir.models import Suggestion
+        table = Suggestion.__table__
+        now = datetime.utcnow()
+        rows = [{'user_id': user_id, 'suggested_id': suggested_id, 'score': score, 'timestamp': now}
+                for user_id, suggestions in results.items() for suggested_id, score in suggestions]
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(table.delete().where(table.c.user_id.in_(list(results))))
+            if rows:
+                conn.execute(table.insert(), rows)
+
+    def refresh(self, user_ids):
+        user_ids = list(user_ids)
+        if user_ids:
+            self.save({user_id: self.suggest(user_id) for user_id in user_ids})
+        return len(user_ids)
+
+    def compute(self, chunk_size=1000, progress=None):
+        """重新加载关注图，计算所有用户的推荐。"""
+        from app_dir import db
+        from app_dir.models import User
+        with self._lock:
+            self._graph = self.load_graph()
+        last_id = 0
+        done = 0
+        while True:
+            with db.get_engine(self.app).connect() as conn:
+                ids = [row[0] for row in conn.execute(
+                    db.select([User.id]).where(User.id > last_id).order_by(User.id).limit(chunk_size))]
+            if not ids:
+                return done
+            done += self.refresh(ids)
+            last_id = ids[-1]
+            if progress is not None:
+                progress(done)
+
+    def changed(self, changes):
+        """changes 是已经提交的 [(fan_id, star_id, 是否关注)]，由 session 的 after_commit 事件调用。"""
+        with self._changes_lock:
+            self._changes.extend(changes)
+        if not self.app.config['SUGGESTION_REFRESH_INTERVAL']:
+            self.flush()
+        elif self._worker is None:
+            self._start_worker()
+
+    def flush(self):
+        # 加载关注图可能要几秒，放在这里而不是 changed() 里，不拖慢发起 follow 的请求
+        # 取出改动和更新图都在 _lock 里，两个线程同时 flush 时改动按提交的顺序应用到图上
+        with self._lock:
+            with self._changes_lock:
+                changes, self._changes = self._changes, []
+            if not changes:
+                return 0
+            graph = self.graph
+            limit = self.app.config['SUGGESTION_REFRESH_FANOUT']
+            dirty = set()
+            for fan_id, star_id, added in changes:
+                if added:
+                    graph.add_edge(fan_id, star_id)
+                else:
+                    graph.remove_edge(fan_id, star_id)
+                # fan 自己的推荐、fan 的粉丝的“朋友的朋友”、star 和 fan 关注的人的“共同粉丝”都变了
+                dirty.add(fan_id)
+                dirty.add(star_id)
+                dirty.update(graph.fans(fan_id)[:limit])
+                dirty.update(graph.stars(fan_id)[:limit])
+        try:
+            return self.refresh(dirty)
+        except Exception:
+            logger.exception('Failed to refresh suggestions for %d users', len(dirty))
+            return 0
+
+    def stop(self):
+        self._stop.set()
+        if self.app is not None:
+            self.flush()
+
+    def _start_worker(self):
+        with self._changes_lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run, name='suggestion-refresher')
+            self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        while not self._stop.wait(self.app.config['SUGGESTION_REFRESH_INTERVAL']):
+            self.flush()
+
+
+def apply_follow_changes(session):
+    changes = session.info.pop('follow_changes', None)
+    engine = session.app.extensions.get('suggestions') if changes else None
+    if engine is not None:
+        engine.changed(changes)
+
+
+def discard_follow_changes(session):
+    session.info.pop('follow_changes', None)
@@ -1,22 +1,172 @@
-import requests
+import atexit
+import hashlib
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app_dir import db
+from app_dir.cache import make_cache
+from app_dir.instrumentation import external_call
+from app_dir.models import Translation
 
 
-def translate(text, source_language, target_language):
+ERROR_TEXT = 'Error: Fail to connect to translation service provider.'
+
+logger = logging.getLogger(__name__)
+
+
+class Translator(object):
+    """翻译服务的客户端。
+
+    所有请求共用一个带连接池（keep-alive）的 requests.Session，有超时和重试；
+    翻译结果按 (文本哈希, 源语言, 目标语言) 缓存在 LRU/Redis 里，
+    开启 TRANSLATION_PERSIST 时还会存进 translation 表。
+    """
+
+    def __init__(self, app=None):
+        # 所有 app 的线程池，进程退出时统一关掉
+        self._executors = weakref.WeakSet()
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['translator'] = {
+            'session': None,
+            'executor': None,
+            'lock': threading.Lock(),
+            'cache': make_cache(app, app.config['TRANSLATION_CACHE_BACKEND'], 'translation:',
+                                app.config['TRANSLATION_CACHE_SIZE'],
+                                app.config['TRANSLATION_CACHE_TTL']),
+        }
+
+    def get_executor(self, state, config):
+        # 第一次有翻译要请求上游时才创建线程池
+        with state['lock']:
+            if state['executor'] is None:
+                state['executor'] = ThreadPoolExecutor(max_workers=config['TRANSLATION_POOL_SIZE'])
+                self._executors.add(state['executor'])
+            return state['executor']
+
+    def close(self, app):
+        """关掉 app 的线程池和 HTTP session。"""
+        state = app.extensions['translator']
+        with state['lock']:
+            executor, state['executor'] = state['executor'], None
+            session, state['session'] = state['session'], None
+        if executor is not None:
+            executor.shutdown()
+        if session is not None:
+            session.close()
+
+    def shutdown(self):
+        for executor in list(self._executors):
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def get_session(state, config):
+        # requests 导入要几十毫秒，等到第一次真正请求翻译服务时才导入并创建 session
+        with state['lock']:
+            if state['session'] is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                retry = Retry(total=config['TRANSLATION_RETRIES'], backoff_factor=0.2,
+                              status_forcelist=(500, 502, 503, 504))
+                adapter = HTTPAdapter(pool_maxsize=config['TRANSLATION_POOL_SIZE'],
+                                      max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['user-agent'] = 'Mozilla/5.0 (X11; Linux x86_64) ' \
+                                                'AppleWebKit/537.36 (KHTML, like Gecko) ' \
+                                                'Chrome/69.0.3497.92 Safari/537.36'
+                state['session'] = session
+            return state['session']
+
+    def translate(self, text, source_language, target_language):
+        return self.translate_many([(text, source_language)], target_language)[0]
 
-    url = current_app.config['TRANSLATION_SERVICE_API'].format(
-        source_language,
-        target_language,
-        text
-    )
-    headers = {
-        'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) '
-                      'AppleWebKit/537.36 (KHTML, like Gecko) '
-                      'Chrome/69.0.3497.92 Safari/537.36'
-    }
-    r = requests.get(url=url, headers=headers)
+    def translate_many(self, items, target_language):
+        """items 是 [(text, source_language), ...]，按顺序返回译文。"""
+        state = current_app.extensions['translator']
+        cache = state['cache']
+        keys = [(text_hash(text), source, target_language) for text, source in items]
+        results = [None] * len(items)
+        missing = []
+        for i, key in enumerate(keys):
+            if cache is not None:
+                results[i] = cache.get(':'.join(key))
+            if results[i] is None:
+                missing.append(i)
+
+        if missing and current_app.config['TRANSLATION_PERSIST']:
+            stored = Translation.query.filter(
+                Translation.text_hash.in_({keys[i][0] for i in missing}),
+                Translation.target_language == target_language
+            ).all()
+            stored = {(t.text_hash, t.source_language, t.target_language): t.text for t in stored}
+            for i in missing:
+                results[i] = stored.get(keys[i])
+            missing = [i for i in missing if results[i] is None]
+
+        # 剩下的并发请求上游，连接由 session 的连接池复用
+        url = current_app.config['TRANSLATION_SERVICE_API']
+        timeout = current_app.config['TRANSLATION_TIMEOUT']
+        session = self.get_session(state, current_app.config) if missing else None
+        executor = self.get_executor(state, current_app.config) if missing else None
+        futures = [(i, executor.submit(fetch_translation, session, url, timeout,
+                                       items[i][0], items[i][1], target_language))
+                   for i in missing]
+        with external_call('translate'):
+            fetched = [(i, future.result()) for i, future in futures]
+        translations = []
+        for i, translated in fetched:
+            if translated is None:
+                results[i] = ERROR_TEXT
+                continue
+            results[i] = translated
+            if cache is not None:
+                cache.set(':'.join(keys[i]), translated)
+            translations.append(Translation(text_hash=keys[i][0], source_language=keys[i][1],
+                                            target_language=keys[i][2], text=translated))
+        if translations and current_app.config['TRANSLATION_PERSIST']:
+            db.session.add_all(translations)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # 另一个请求已经存过同样的翻译
+                db.session.rollback()
+        return results
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def fetch_translation(session, url, timeout, text, source_language, target_language):
+    import requests
+    try:
+        # 交给 requests 做 URL 编码，正文里的 &、#、+ 不会改掉查询参数
+        r = session.get(url, params={'sl': source_language, 'tl': target_language, 'q': text},
+                        timeout=timeout)
+    except requests.RequestException as e:
+        logger.warning('Translation request failed: %s', e)
+        return None
     if r.status_code != 200:
-        print(r.status_code)
-        return 'Error: Fail to connect to translation service provider.'
+        logger.warning('Translation service returned %d', r.status_code)
+        return None
     return r.json()[0][0][0]
 
+
+translator = Translator()
+
+
+def translate(text, source_language, target_language):
+    return translator.translate(text, source_language, target_language)
+
+
+def translate_many(items, target_language):
+    return translator.translate_many(items, target_language)
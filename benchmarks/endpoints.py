@@ -0,0 +1,225 @@
+"""Drive the main endpoints through the test client and report latency as JSON.
+
+Seeds a synthetic graph (see seed.py), logs --clients users in, then runs
+--requests timed requests per scenario: main.index, main.explore,
+main.user, main.follow and auth.login. For every scenario it reports
+p50/p90/p99 latency, mean SQL statements per request and throughput.
+
+    python benchmarks/endpoints.py --output before.json
+    python benchmarks/endpoints.py --set TIMELINE_FANOUT=false --compare before.json
+
+--set overrides any config key (values are parsed as JSON when possible).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from config import Config  # noqa: E402
+from app_dir import create_app, db  # noqa: E402
+from app_dir.models import User, following_relationship_table  # noqa: E402
+from seed import seed_graph, PASSWORD  # noqa: E402
+
+
+SCENARIOS = ['index', 'explore', 'user', 'follow', 'login']
+
+
+class BenchConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # 基准测试关心的是页面本身，降低哈希强度、关闭登录限流，last_seen 直接写回
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+    LOGIN_MAX_ATTEMPTS = LOGIN_MAX_ATTEMPTS_PER_IP = 10 ** 9
+    RATELIMIT_BACKEND = ''
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    SEARCH_BACKEND = ''
+    # SQL 语句数由基准测试自己统计，不让 sql_budget 中断运行
+    FEED_SQL_BUDGET = None
+
+
+class StatementCounter(object):
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def parse_override(text):
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def make_client(app, username=None):
+    client = app.test_client()
+    client.environ_base['HTTP_ACCEPT_LANGUAGE'] = 'en'
+    if username is not None:
+        r = client.post('/auth/login', data={'username': username, 'password': PASSWORD})
+        assert r.status_code == 302 and '/auth/login' not in r.location, r.location
+    return client
+
+
+def current_stars(app, names):
+    with app.app_context():
+        fan = db.aliased(User)
+        rows = db.session.query(fan.username, User.username).join(
+            following_relationship_table, following_relationship_table.c.fan_id == fan.id
+        ).join(User, User.id == following_relationship_table.c.star_id).filter(fan.username.in_(names))
+        following = {name: set() for name in names}
+        for fan_name, star_name in rows:
+            following[fan_name].add(star_name)
+        return following
+
+
+def scenario_requests(app, name, clients, usernames, rnd):
+    """Yield (client, method, url, cleanup url) for one scenario, forever."""
+    if name == 'follow':
+        following = current_stars(app, [me for _, me in clients])
+    while True:
+        client, me = rnd.choice(clients)
+        if name == 'index':
+            yield client, 'get', '/index', None
+        elif name == 'explore':
+            yield client, 'get', '/explore', None
+        elif name == 'user':
+            yield client, 'get', '/user/{}'.format(rnd.choice(usernames)), None
+        elif name == 'follow':
+            other = rnd.choice(usernames)
+            if other != me and other not in following[me]:
+                # 只统计 follow；随后的 unfollow 不计时，让关注关系保持不变
+                yield client, 'get', '/follow/{}'.format(other), '/unfollow/{}'.format(other)
+        elif name == 'login':
+            yield make_client(app), 'post', '/auth/login', None
+
+
+def run_scenario(app, name, clients, usernames, requests, warmup, counter, rnd):
+    latencies = []
+    statements = 0
+    source = scenario_requests(app, name, clients, usernames, rnd)
+    started = None
+    for i in range(warmup + requests):
+        client, method, url, cleanup = next(source)
+        data = None
+        if name == 'login':
+            data = {'username': rnd.choice(usernames), 'password': PASSWORD}
+        if i == warmup:
+            started = perf_counter()
+        before = counter.count
+        begin = perf_counter()
+        r = getattr(client, method)(url, data=data)
+        elapsed = perf_counter() - begin
+        assert r.status_code < 400, (url, r.status_code)
+        if i >= warmup:
+            latencies.append(elapsed)
+            statements += counter.count - before
+        if cleanup is not None:
+            client.get(cleanup)
+    total = perf_counter() - started
+    return {
+        'requests': requests,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'sql_per_request': round(statements / requests, 2),
+        # 包括 follow 之后不计时的 unfollow，吞吐量按整段时间计算
+        'throughput_rps': round(requests / total, 1),
+    }
+
+
+def compare(results, baseline):
+    print('{:<10} {:>24} {:>24} {:>18}'.format('scenario', 'p50 ms (base -> now)',
+                                              'p99 ms (base -> now)', 'sql/request'), file=sys.stderr)
+    for name, now in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        print('{:<10} {:>24} {:>24} {:>18}'.format(
+            name,
+            '{:.2f} -> {:.2f} ({:+.0%})'.format(base['p50_ms'], now['p50_ms'], now['p50_ms'] / base['p50_ms'] - 1),
+            '{:.2f} -> {:.2f} ({:+.0%})'.format(base['p99_ms'], now['p99_ms'], now['p99_ms'] / base['p99_ms'] - 1),
+            '{} -> {}'.format(base['sql_per_request'], now['sql_per_request'])), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--mean-stars', type=int, default=20, help='Average number of accounts a user follows.')
+    parser.add_argument('--alpha', type=float, default=1.1, help='Exponent of the follower popularity power law.')
+    parser.add_argument('--clients', type=int, default=50, help='Number of logged-in users to sample from.')
+    parser.add_argument('--requests', type=int, default=500, help='Timed requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS)
+    parser.add_argument('--database', choices=['memory', 'file'], default='file')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=VALUE')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+    parser.add_argument('--compare', help='A previous JSON report to compare against.')
+    args = parser.parse_args()
+
+    if args.database == 'memory':
+        BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    else:
+        BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    overrides = dict(parse_override(text) for text in args.overrides)
+    for key, value in overrides.items():
+        setattr(BenchConfig, key, value)
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        begin = perf_counter()
+        usernames = seed_graph(args.users, args.posts, args.mean_stars, args.alpha, args.seed)
+        seed_seconds = perf_counter() - begin
+
+    rnd = random.Random(args.seed)
+    clients = [(make_client(app, name), name) for name in rnd.sample(usernames, min(args.clients, len(usernames)))]
+    counter = StatementCounter()
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'database': args.database,
+            'users': args.users,
+            'posts': args.posts,
+            'mean_stars': args.mean_stars,
+            'alpha': args.alpha,
+            'overrides': overrides,
+            'seed_seconds': round(seed_seconds, 2),
+        },
+        'results': {},
+    }
+    for name in args.scenarios or SCENARIOS:
+        report['results'][name] = run_scenario(app, name, clients, usernames, args.requests,
+                                               args.warmup, counter, rnd)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Show how the follows/post indexes change query plans and timings.
+
+Seeds a SQLite database with the pre-index schema (follows without a
+primary key, post without the (user_id, timestamp) index), runs the
+queries behind is_following, the follower counts, stars_posts and the
+profile feed, then applies the same DDL as migration c4f1a9d72e85 and
+runs them again.
+
+    python benchmarks/follows_query_plan.py --follows 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+QUERIES = [
+    ('is_following',
+     'SELECT count(*) FROM follows WHERE fan_id = :fan AND star_id = :star'),
+    ('fans count',
+     'SELECT count(*) FROM follows WHERE star_id = :star'),
+    ('stars count',
+     'SELECT count(*) FROM follows WHERE fan_id = :fan'),
+    ('stars_posts',
+     'SELECT post.id FROM post JOIN follows ON follows.star_id = post.user_id '
+     'WHERE follows.fan_id = :fan UNION SELECT post.id FROM post WHERE post.user_id = :fan '
+     'ORDER BY 1 DESC LIMIT 11'),
+    ('profile feed',
+     'SELECT id FROM post WHERE user_id = :star ORDER BY timestamp DESC, id DESC LIMIT 11'),
+]
+
+MIGRATION = [
+    'CREATE TABLE follows_new (fan_id INTEGER NOT NULL, star_id INTEGER NOT NULL, '
+    'PRIMARY KEY (fan_id, star_id))',
+    'INSERT INTO follows_new (fan_id, star_id) SELECT DISTINCT fan_id, star_id FROM follows '
+    'WHERE fan_id IS NOT NULL AND star_id IS NOT NULL',
+    'DROP TABLE follows',
+    'ALTER TABLE follows_new RENAME TO follows',
+    'CREATE INDEX ix_follows_star_id_fan_id ON follows (star_id, fan_id)',
+    'CREATE INDEX ix_post_user_id_timestamp ON post (user_id, timestamp)',
+]
+
+
+def seed(conn, users, follows, posts):
+    conn.executescript(
+        'CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(64));'
+        'CREATE TABLE follows (fan_id INTEGER, star_id INTEGER);'
+        'CREATE TABLE post (id INTEGER PRIMARY KEY, body VARCHAR(140), timestamp DATETIME, '
+        'user_id INTEGER);'
+        'CREATE INDEX ix_post_timestamp ON post (timestamp);'
+    )
+    conn.executemany('INSERT INTO user (id, username) VALUES (?, ?)',
+                     ((i, 'user{}'.format(i)) for i in range(1, users + 1)))
+    rnd = random.Random(42)
+    conn.executemany('INSERT INTO follows (fan_id, star_id) VALUES (?, ?)',
+                     ((rnd.randint(1, users), rnd.randint(1, users)) for _ in range(follows)))
+    start = datetime(2018, 9, 1)
+    conn.executemany('INSERT INTO post (body, timestamp, user_id) VALUES (?, ?, ?)',
+                     (('post {}'.format(i), start + timedelta(seconds=i), rnd.randint(1, users))
+                      for i in range(posts)))
+    conn.commit()
+
+
+def run_queries(conn, samples, repeat):
+    results = {}
+    for name, sql in QUERIES:
+        plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, samples[0])]
+        begin = time.perf_counter()
+        for _ in range(repeat):
+            for params in samples:
+                conn.execute(sql, params).fetchall()
+        elapsed = (time.perf_counter() - begin) / (repeat * len(samples))
+        results[name] = (plan, elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=1000000)
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--samples', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'follows_bench.db')
+    conn = sqlite3.connect(path)
+    print('Seeding {} users, {} follows, {} posts into {}'.format(
+        args.users, args.follows, args.posts, path))
+    seed(conn, args.users, args.follows, args.posts)
+    rnd = random.Random(7)
+    samples = [{'fan': rnd.randint(1, args.users), 'star': rnd.randint(1, args.users)}
+               for _ in range(args.samples)]
+
+    before = run_queries(conn, samples, args.repeat)
+    begin = time.perf_counter()
+    for statement in MIGRATION:
+        conn.execute(statement)
+    conn.commit()
+    print('Migration took {:.2f}s'.format(time.perf_counter() - begin))
+    after = run_queries(conn, samples, args.repeat)
+
+    for name, _ in QUERIES:
+        print('\n== {}'.format(name))
+        for label, (plan, elapsed) in (('before', before[name]), ('after', after[name])):
+            print('  {:<7}{:>10.3f} ms'.format(label, elapsed * 1000))
+            for line in plan:
+                print('           {}'.format(line))
+    conn.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Measure auth.login throughput at different password hash work factors.
+
+For every iteration count, a user is created with a hash of that cost,
+then --clients threads post to /auth/login through the Flask test client
+for --seconds seconds. Run it with the hashing process pool on
+(PASSWORD_HASH_WORKERS > 0) and off to compare.
+
+    python benchmarks/login_throughput.py --iterations 50000 150000 --workers 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from app_dir import create_app, db  # noqa: E402
+from app_dir.models import User  # noqa: E402
+
+
+class BenchConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'login.db')
+    LOGIN_MAX_ATTEMPTS = LOGIN_MAX_ATTEMPTS_PER_IP = 10 ** 9
+
+
+def run(app, username, clients, seconds):
+    counts = [0] * clients
+    deadline = perf_counter() + seconds
+
+    def client(i):
+        c = app.test_client()
+        c.environ_base['HTTP_ACCEPT_LANGUAGE'] = 'en'
+        while perf_counter() < deadline:
+            r = c.post('/auth/login', data={'username': username, 'password': 'secret'})
+            assert r.status_code == 302 and '/auth/login' not in r.location, r.location
+            c.get('/auth/logout')
+            counts[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, nargs='+', default=[10000, 50000, 150000])
+    parser.add_argument('--workers', type=int, default=BenchConfig.PASSWORD_HASH_WORKERS,
+                        help='PASSWORD_HASH_WORKERS, 0 hashes in the request thread')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    BenchConfig.PASSWORD_HASH_WORKERS = args.workers
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+    print('{:>12} {:>12}'.format('iterations', 'logins/s'))
+    for iterations in args.iterations:
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:{}'.format(iterations)
+        username = 'user{}'.format(iterations)
+        with app.app_context():
+            user = User(username=username, email='{}@example.com'.format(username))
+            user.set_password('secret')
+            db.session.add(user)
+            db.session.commit()
+        print('{:>12} {:>12.1f}'.format(iterations, run(app, username, args.clients, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
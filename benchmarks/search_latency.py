@@ -0,0 +1,82 @@
+"""Measure /search query latency on a large synthetic post table.
+
+Inserts --posts posts drawn from a Zipf-like vocabulary with core bulk
+inserts, builds the index through SearchIndex.reindex() and times
+SearchIndex.search() for random one- and two-word queries.
+
+    python benchmarks/search_latency.py --posts 1000000 --backend fts5
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from app_dir import create_app, db  # noqa: E402
+from app_dir.models import Post, User  # noqa: E402
+from app_dir.search import search_index  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--backend', choices=['fts5', 'python'], default='fts5')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+
+    class BenchConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'search.db')
+        SEARCH_BACKEND = args.backend
+        SEARCH_INDEX_PATH = os.path.join(workdir, 'search_index')
+
+    app = create_app(BenchConfig)
+    rnd = random.Random(42)
+    words = ['w{}'.format(i) for i in range(args.vocabulary)]
+    cum_weights = list(itertools.accumulate(1.0 / (i + 1) for i in range(args.vocabulary)))
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [{'username': 'bench', 'email': 'bench@example.com'}])
+        start = datetime(2018, 9, 1)
+        begin = perf_counter()
+        for offset in range(0, args.posts, args.chunk_size):
+            rows = [{'body': ' '.join(rnd.choices(words, cum_weights=cum_weights, k=rnd.randint(5, 20))),
+                     'timestamp': start + timedelta(seconds=offset + i), 'user_id': 1, 'language': 'en'}
+                    for i in range(min(args.chunk_size, args.posts - offset))]
+            db.session.execute(Post.__table__.insert(), rows)
+            db.session.commit()
+        print('Inserted {} posts in {:.1f}s'.format(args.posts, perf_counter() - begin))
+
+        begin = perf_counter()
+        search_index.reindex(args.chunk_size)
+        print('Indexed with {} in {:.1f}s'.format(args.backend, perf_counter() - begin))
+
+        latencies = []
+        for _ in range(args.queries):
+            # 查询词偏向常见词，才能测到长倒排表的情况
+            query = ' '.join(rnd.choices(words[:2000], cum_weights=cum_weights[:2000], k=rnd.randint(1, 2)))
+            begin = perf_counter()
+            search_index.search(query, app.config['POSTS_PER_PAGE'])
+            latencies.append((perf_counter() - begin) * 1000)
+            db.session.rollback()
+        print('{} queries: p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            args.queries, percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies)))
+
+
+if __name__ == '__main__':
+    main()
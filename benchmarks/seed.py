@@ -0,0 +1,57 @@
+"""Seed a synthetic social graph for the benchmarks.
+
+Users follow a number of accounts drawn from a Pareto distribution, and
+who they follow is weighted by a Zipf-like popularity rank, so a few
+users end up with most of the fans. Everything is written with core bulk
+inserts; counters and the fan-out timeline are rebuilt at the end.
+"""
+import itertools
+import random
+from datetime import datetime, timedelta
+from app_dir import db, password_hasher
+from app_dir.avatars import email_digest
+from app_dir.models import User, Post, TimelineEntry, following_relationship_table
+
+
+PASSWORD = 'secret'
+
+
+def seed_graph(users=1000, posts=20000, mean_stars=20, alpha=1.1, seed=42, chunk_size=10000):
+    """Fill an empty database. Needs an app context; returns the usernames."""
+    rnd = random.Random(seed)
+    password_hash = password_hasher.hash(PASSWORD)
+    usernames = ['user{}'.format(i) for i in range(1, users + 1)]
+    start = datetime(2018, 9, 1)
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': name, 'email': '{}@example.com'.format(name),
+         'email_digest': email_digest('{}@example.com'.format(name)),
+         'password_hash': password_hash, 'last_seen': start}
+        for i, name in enumerate(usernames, 1)])
+
+    # 粉丝数服从幂律：第 rank 受欢迎的用户被选中的权重是 1 / rank^alpha
+    popularity = list(range(1, users + 1))
+    rnd.shuffle(popularity)
+    cum_weights = list(itertools.accumulate(1.0 / rank ** alpha for rank in popularity))
+    ids = list(range(1, users + 1))
+    edges = []
+    for fan_id in ids:
+        wanted = min(users - 1, int(rnd.paretovariate(1.5) * mean_stars / 3))
+        stars = set(rnd.choices(ids, cum_weights=cum_weights, k=wanted))
+        stars.discard(fan_id)
+        edges.extend({'fan_id': fan_id, 'star_id': star_id} for star_id in stars)
+        if len(edges) >= chunk_size:
+            db.session.execute(following_relationship_table.insert(), edges)
+            edges = []
+    if edges:
+        db.session.execute(following_relationship_table.insert(), edges)
+
+    for offset in range(0, posts, chunk_size):
+        db.session.execute(Post.__table__.insert(), [
+            {'body': 'post {} from the benchmark'.format(offset + i),
+             'timestamp': start + timedelta(seconds=offset + i),
+             'user_id': rnd.randint(1, users), 'language': 'en'}
+            for i in range(min(chunk_size, posts - offset))])
+    User.reconcile_counters()
+    TimelineEntry.rebuild()
+    db.session.commit()
+    return usernames
@@ -0,0 +1,100 @@
+"""Measure FollowGraph memory, build time and suggestion refresh time.
+
+Generates a synthetic power-law follow graph with --edges edges over
+--users users (same model as seed.py), builds the CSR arrays, then times
+suggest() for a sample of users and the incremental refresh that
+follows a batch of random follow/unfollow changes. No database is used;
+the graph is built straight from the generated edge list.
+
+    python benchmarks/suggestion_graph.py --users 100000 --edges 1000000
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_dir.suggestions import FollowGraph  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def power_law_edges(users, edges, alpha, rnd):
+    popularity = list(range(1, users + 1))
+    rnd.shuffle(popularity)
+    ids = list(range(1, users + 1))
+    cum_weights = list(itertools.accumulate(1.0 / rank ** alpha for rank in popularity))
+    seen = set()
+    while len(seen) < edges:
+        fans = rnd.choices(ids, k=edges - len(seen))
+        stars = rnd.choices(ids, cum_weights=cum_weights, k=len(fans))
+        seen.update((fan, star) for fan, star in zip(fans, stars) if fan != star)
+    return seen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--alpha', type=float, default=1.1)
+    parser.add_argument('--samples', type=int, default=1000, help='Users timed for a full suggest().')
+    parser.add_argument('--changes', type=int, default=100, help='Follow/unfollow changes per refresh.')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-neighbors', type=int, default=200)
+    parser.add_argument('--refresh-fanout', type=int, default=100)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    begin = perf_counter()
+    edges = power_law_edges(args.users, args.edges, args.alpha, rnd)
+    print('generated {} edges in {:.1f}s'.format(len(edges), perf_counter() - begin))
+
+    tracemalloc.start()
+    begin = perf_counter()
+    graph = FollowGraph.from_edges(edges, args.users + 1)
+    build_seconds = perf_counter() - begin
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('built CSR graph in {:.2f}s, arrays use {:.1f} MB, peak while building {:.1f} MB'.format(
+        build_seconds, graph.nbytes() / 2 ** 20, peak / 2 ** 20))
+    print('(a Python set of the same edges takes about {:.0f} MB)'.format(
+        (sys.getsizeof(edges) + len(edges) * (sys.getsizeof((1, 2)) + 2 * 28)) / 2 ** 20))
+
+    timings = []
+    for user_id in rnd.sample(range(1, args.users + 1), args.samples):
+        begin = perf_counter()
+        graph.suggest(user_id, args.top, max_neighbors=args.max_neighbors)
+        timings.append(perf_counter() - begin)
+    print('suggest(): p50 {:.2f} ms, p99 {:.2f} ms, {:.0f} users/s'.format(
+        percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000, len(timings) / sum(timings)))
+
+    # 和 SuggestionEngine.flush() 一样：应用改动，找出受影响的用户，逐个重算
+    edge_list = list(edges)
+    begin = perf_counter()
+    dirty = set()
+    for _ in range(args.changes):
+        if rnd.random() < 0.5:
+            fan_id, star_id = rnd.randint(1, args.users), rnd.randint(1, args.users)
+            graph.add_edge(fan_id, star_id)
+        else:
+            fan_id, star_id = rnd.choice(edge_list)
+            graph.remove_edge(fan_id, star_id)
+        dirty.update((fan_id, star_id))
+        dirty.update(graph.fans(fan_id)[:args.refresh_fanout])
+        dirty.update(graph.stars(fan_id)[:args.refresh_fanout])
+    for user_id in dirty:
+        graph.suggest(user_id, args.top, max_neighbors=args.max_neighbors)
+    elapsed = perf_counter() - begin
+    print('refresh after {} changes: {} users recomputed in {:.2f}s ({:.2f} ms per change)'.format(
+        args.changes, len(dirty), elapsed, elapsed / args.changes * 1000))
+
+
+if __name__ == '__main__':
+    main()
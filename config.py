@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 from dotenv import load_dotenv
 
 
@@ -11,7 +12,105 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 只读副本：DATABASE_REPLICA_URLS 用逗号分隔，每个副本注册成一个 bind，GET 请求的查询
+    # 随机选一个副本执行。本地测试时可以把 app.db 复制一份，用 sqlite:///replica.db 当副本
+    SQLALCHEMY_BINDS = {'replica{}'.format(i): url for i, url in enumerate(
+        filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')))}
+    SQLALCHEMY_REPLICAS = sorted(SQLALCHEMY_BINDS)
+    # 用户写过数据后这么多秒内的请求都读主库
+    REPLICA_LAG_WINDOW = 5
     POSTS_PER_PAGE = 10
+    # 主页时间线是否使用 timeline_entry 表；从关闭切换到开启后需要先运行 flask timeline rebuild
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT', '1') != '0'
+    # post 列表加载作者的方式：joined, selectin, subquery 或 lazy
+    POST_AUTHOR_LOADING = os.environ.get('POST_AUTHOR_LOADING') or 'joined'
+    # 测试模式下一个 feed 页面最多允许发出的 SQL 语句数
+    FEED_SQL_BUDGET = 8
+    # load_user 的缓存：local（进程内 LRU）、redis 或留空关闭
+    USER_CACHE_BACKEND = os.environ.get('USER_CACHE_BACKEND', 'local')
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 300
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # post 行和个人资料头部的 HTML 片段缓存：local、redis 或留空关闭
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'local')
+    FRAGMENT_CACHE_SIZE = 10000
+    FRAGMENT_CACHE_TTL = 3600
+    # 同一个用户 LAST_SEEN_THROTTLE 秒内只更新一次 last_seen，
+    # 每 LAST_SEEN_FLUSH_INTERVAL 秒批量写回一次（0 表示立即写回）
+    LAST_SEEN_THROTTLE = 60
+    LAST_SEEN_FLUSH_INTERVAL = 10
+    # 密码哈希：werkzeug 的方法字符串（含迭代次数）、salt 长度、进程池大小（0 表示不用进程池）
+    # 和最多排队的哈希计算个数
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:50000'
+    PASSWORD_SALT_LENGTH = 8
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = 32
+    PASSWORD_HASH_QUEUE_TIMEOUT = 2
+    # LOGIN_ATTEMPT_WINDOW 秒内同一个用户名/IP 最多失败的次数
+    LOGIN_ATTEMPT_WINDOW = 300
+    LOGIN_MAX_ATTEMPTS = 5
+    LOGIN_MAX_ATTEMPTS_PER_IP = 20
+    # 编译后的 Jinja 模板缓存目录，默认关闭。部署时设成 web worker 可写、其他用户不可写的目录
+    # （不要放在源码目录或共享的 /tmp 里），再用 flask templates compile 编译好所有模板
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR', '')
+    # 服务端 session：sql（web_session 表）、memory（进程内 LRU，只适合单进程）或留空使用 Flask
+    # 默认的签名 cookie。普通 session 闲置 SESSION_IDLE_LIFETIME 后失效，勾选“记住我”时是永久
+    # session，保留 PERMANENT_SESSION_LIFETIME；每 SESSION_SWEEP_INTERVAL 秒批量删除过期的 session
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sql')
+    SESSION_IDLE_LIFETIME = timedelta(days=1)
+    PERMANENT_SESSION_LIFETIME = timedelta(days=30)
+    SESSION_MEMORY_SIZE = 10000
+    SESSION_SWEEP_INTERVAL = 3600
+    # 按端点限制请求速率：local（进程内）、redis（多进程共享）或留空关闭。
+    # key 是端点名，可以加 ':方法'；登录用户按 id 计数，匿名用户按 IP 计数
+    # （登录失败次数也按 IP 计）。部署在 nginx 之类的反向代理后面时，把 TRUSTED_PROXIES
+    # 设成前面可信代理的层数，客户端 IP 从 X-Forwarded-For 倒数第 TRUSTED_PROXIES 个取；
+    # 0 表示直接用连接的地址，这时不能信任 X-Forwarded-For，否则谁都能伪造 IP 绕过限制
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+    RATELIMIT_BACKEND = os.environ.get('RATELIMIT_BACKEND', 'local')
+    RATELIMITS = {
+        'main.index:POST': '30/minute;300/day',
+        'main.follow': '30/minute',
+        'main.unfollow': '30/minute',
+        'main.translate_text': '60/minute',
+        'main.translate_batch': '20/minute',
+        'auth.register:POST': '10/hour',
+        'auth.reset_password_request:POST': '5/hour',
+        'api.get_token': '10/hour',
+        'api.update_follows': '30/minute',
+    }
+    # 新 post 的语言在后台线程里检测：攒够 LANGUAGE_DETECTION_BATCH 条或等 LANGUAGE_DETECTION_INTERVAL
+    # 秒写回一次（0 表示发 post 时直接检测），检测结果按正文缓存 LANGUAGE_CACHE_SIZE 条
+    LANGUAGE_DETECTION_WORKERS = 1
+    LANGUAGE_DETECTION_BATCH = 100
+    LANGUAGE_DETECTION_INTERVAL = 1
+    LANGUAGE_CACHE_SIZE = 10000
+    # 关注推荐：每个用户保存前 SUGGESTIONS_PER_USER 个；朋友的朋友和共同粉丝的权重；
+    # 每个用户最多看多少个关注/粉丝；follow 之后最多刷新多少个相关用户、多久刷新一次；
+    # 内存中的关注图多久从数据库重新加载一次
+    SUGGESTIONS_PER_USER = 10
+    SUGGESTION_FOF_WEIGHT = 1.0
+    SUGGESTION_SHARED_WEIGHT = 0.5
+    SUGGESTION_MAX_NEIGHBORS = 200
+    SUGGESTION_REFRESH_FANOUT = 100
+    SUGGESTION_REFRESH_INTERVAL = 5
+    SUGGESTION_GRAPH_TTL = 3600
+    # 全文检索：auto（有 FTS5 的 SQLite 用 FTS5，否则用 Python 倒排索引）、fts5、python 或留空关闭
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or os.path.join(basedir, 'search_index')
+    # 本地生成的 identicon 头像的磁盘缓存目录和允许的最大尺寸
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or os.path.join(basedir, 'avatar_cache')
+    # 模板里用到的头像尺寸，/avatar 只接受这几种
+    AVATAR_SIZES = (24, 70, 128, 256)
+    # API 令牌的有效期（秒）、每页最多返回的条数和批量接口一次最多处理的 id 个数
+    API_TOKEN_EXPIRATION = 3600
+    API_MAX_PER_PAGE = 100
+    API_BULK_LIMIT = 100
+    # 按请求统计 SQL、模板和外部调用的耗时，输出 Server-Timing 头、每个请求一行的
+    # JSON 日志和 METRICS_PATH 上的 Prometheus 指标（指标不需要登录，应在反向代理上限制访问）
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0') != '0'
+    INSTRUMENTATION_SLOW_STATEMENTS = 3
+    METRICS_PATH = '/metrics'
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL') is not None
@@ -19,5 +118,23 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = [os.environ.get('ADMIN')]
+    # 发送失败后等待 EMAIL_RETRY_BACKOFF * 2^(n-1) 秒重试，最多 EMAIL_MAX_ATTEMPTS 次
+    EMAIL_MAX_ATTEMPTS = 5
+    EMAIL_RETRY_BACKOFF = 30
+    # 任务被 worker 领走后超过这么多秒没有结果就重新排队
+    EMAIL_JOB_LEASE = 600
+    # 翻译服务的地址，sl、tl、q（源语言、目标语言、正文）作为查询参数附加上去，例如
+    # https://translate.googleapis.com/translate_a/single?client=gtx&dt=t
     TRANSLATION_SERVICE_API = os.environ.get('TRANSLATION_SERVICE_API')
+    # (连接超时, 读超时)，单位秒
+    TRANSLATION_TIMEOUT = (3.05, 10)
+    TRANSLATION_RETRIES = 2
+    TRANSLATION_POOL_SIZE = 8
+    TRANSLATION_CACHE_BACKEND = os.environ.get('TRANSLATION_CACHE_BACKEND', 'local')
+    TRANSLATION_CACHE_SIZE = 4096
+    TRANSLATION_CACHE_TTL = 24 * 3600
+    # 是否把翻译结果存进 translation 表
+    TRANSLATION_PERSIST = True
+    # /translate/batch 一次最多翻译的条数
+    TRANSLATION_BATCH_LIMIT = 50
 
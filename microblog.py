@@ -1,11 +1,11 @@
-from app_dir import create_app, db
-from app_dir.models import User, Post
+from app_dir import create_app, db, cli
+from app_dir.models import User, Post, TimelineEntry
 
 
 app = create_app()
+cli.register(app)
 
 
 @app.shell_context_processor
 def make_shell_context():
-    return {'db': db, 'User': User, 'Post': Post}
-
+    return {'db': db, 'User': User, 'Post': Post, 'TimelineEntry': TimelineEntry}
@@ -0,0 +1,45 @@
+"""add timeline_entry table
+
+Revision ID: a1c5e2f09b3d
+Revises: d08832f02256
+Create Date: 2026-10-18 10:12:40.215381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c5e2f09b3d'
+down_revision = 'd08832f02256'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_entry',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_entry_user_id_timestamp', 'timeline_entry', ['user_id', 'timestamp'], unique=False)
+    # 用已有的 post 和 follows 数据填充时间线
+    op.execute(
+        'INSERT INTO timeline_entry (user_id, post_id, timestamp) '
+        'SELECT user_id, id, timestamp FROM post WHERE user_id IS NOT NULL'
+    )
+    op.execute(
+        'INSERT INTO timeline_entry (user_id, post_id, timestamp) '
+        'SELECT DISTINCT follows.fan_id, post.id, post.timestamp FROM post '
+        'JOIN follows ON follows.star_id = post.user_id WHERE follows.fan_id IS NOT NULL'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_timeline_entry_user_id_timestamp', table_name='timeline_entry')
+    op.drop_table('timeline_entry')
@@ -0,0 +1,38 @@
+"""add counters to user
+
+Revision ID: b7d3e8a41c62
+Revises: a1c5e2f09b3d
+Create Date: 2026-10-18 11:03:27.640918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e8a41c62'
+down_revision = 'a1c5e2f09b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('fans_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('stars_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+    # 用已有数据回填计数
+    user = sa.table('user', sa.column('id'), sa.column('fans_count'),
+                    sa.column('stars_count'), sa.column('posts_count'))
+    follows = sa.table('follows', sa.column('fan_id'), sa.column('star_id'))
+    post = sa.table('post', sa.column('user_id'))
+    op.execute(user.update().values(
+        fans_count=sa.select([sa.func.count()]).where(follows.c.star_id == user.c.id).as_scalar(),
+        stars_count=sa.select([sa.func.count()]).where(follows.c.fan_id == user.c.id).as_scalar(),
+        posts_count=sa.select([sa.func.count()]).where(post.c.user_id == user.c.id).as_scalar(),
+    ))
+
+
+def downgrade():
+    op.drop_column('user', 'posts_count')
+    op.drop_column('user', 'stars_count')
+    op.drop_column('user', 'fans_count')
@@ -0,0 +1,57 @@
+"""add primary key and indexes to follows
+
+Revision ID: c4f1a9d72e85
+Revises: b7d3e8a41c62
+Create Date: 2026-10-18 11:48:05.377142
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f1a9d72e85'
+down_revision = 'b7d3e8a41c62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite 不能给已有的表加主键，所以新建一张表，把去重后的数据拷过去再改名
+    op.create_table('follows_new',
+    sa.Column('fan_id', sa.Integer(), nullable=False),
+    sa.Column('star_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['fan_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['star_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('fan_id', 'star_id')
+    )
+    op.execute(
+        'INSERT INTO follows_new (fan_id, star_id) '
+        'SELECT DISTINCT fan_id, star_id FROM follows '
+        'WHERE fan_id IS NOT NULL AND star_id IS NOT NULL'
+    )
+    op.drop_table('follows')
+    op.rename_table('follows_new', 'follows')
+    op.create_index('ix_follows_star_id_fan_id', 'follows', ['star_id', 'fan_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+    # 上一个版本回填 fans_count/stars_count 时重复的关注还在表里，去重之后重新计算
+    user = sa.table('user', sa.column('id'), sa.column('fans_count'), sa.column('stars_count'))
+    follows = sa.table('follows', sa.column('fan_id'), sa.column('star_id'))
+    op.execute(user.update().values(
+        fans_count=sa.select([sa.func.count()]).where(follows.c.star_id == user.c.id).as_scalar(),
+        stars_count=sa.select([sa.func.count()]).where(follows.c.fan_id == user.c.id).as_scalar(),
+    ))
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_follows_star_id_fan_id', table_name='follows')
+    op.create_table('follows_old',
+    sa.Column('fan_id', sa.Integer(), nullable=True),
+    sa.Column('star_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['fan_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['star_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO follows_old (fan_id, star_id) SELECT fan_id, star_id FROM follows')
+    op.drop_table('follows')
+    op.rename_table('follows_old', 'follows')
@@ -0,0 +1,35 @@
+"""add email_digest to user
+
+Revision ID: f3b9d2a67c40
+Revises: e5a8c1f24d96
+Create Date: 2026-10-18 15:02:37.196421
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b9d2a67c40'
+down_revision = 'e5a8c1f24d96'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('email_digest', sa.String(length=32), nullable=True))
+
+    # 已有用户的 digest 在 Python 里算好回填
+    user = sa.table('user', sa.column('id'), sa.column('email'), sa.column('email_digest'))
+    conn = op.get_bind()
+    rows = conn.execute(sa.select([user.c.id, user.c.email]).where(user.c.email.isnot(None))).fetchall()
+    if rows:
+        conn.execute(
+            user.update().where(user.c.id == sa.bindparam('b_id')).values(email_digest=sa.bindparam('b_digest')),
+            [{'b_id': id, 'b_digest': md5(email.strip().lower().encode('utf-8')).hexdigest()}
+             for id, email in rows])
+
+
+def downgrade():
+    op.drop_column('user', 'email_digest')
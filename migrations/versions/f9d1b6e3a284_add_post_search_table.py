@@ -0,0 +1,32 @@
+"""add post_search table
+
+Revision ID: f9d1b6e3a284
+Revises: e7a2c4b9d031
+Create Date: 2026-10-18 20:12:37.418265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f9d1b6e3a284'
+down_revision = 'e7a2c4b9d031'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 全文检索的 FTS5 虚拟表，只在 SQLite 带 FTS5 时创建，否则应用用 Python 倒排索引。
+    # 已有的 post 升级后用 flask search reindex 建索引
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    try:
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(terms)')
+    except sa.exc.OperationalError:
+        pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS post_search')
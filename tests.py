@@ -0,0 +1,1021 @@
+import base64
+import json
+import os
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+import unittest
+from smtplib import SMTPServerDisconnected
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from config import Config
+from app_dir import create_app, db, last_seen, login_throttle, rate_limiter, \
+    server_sessions, suggestion_engine, user_cache
+from app_dir.models import EmailJob, Post, TimelineEntry, User, WebSession
+from app_dir.email import claim_email_jobs, process_email_jobs, send_email
+from app_dir.pagination import keyset_paginate
+from app_dir.search import search_index
+from app_dir.avatars import email_digest
+from app_dir.ratelimit import MemoryBackend
+from app_dir.translate import translator, translate, translate_many, ERROR_TEXT
+
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    PASSWORD_HASH_WORKERS = 0
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    LANGUAGE_DETECTION_INTERVAL = 0
+    SUGGESTION_REFRESH_INTERVAL = 0
+    SEARCH_BACKEND = ''
+    SESSION_BACKEND = 'memory'
+    SESSION_SWEEP_INTERVAL = 0
+    RATELIMIT_BACKEND = ''
+    JINJA_BYTECODE_CACHE_DIR = ''
+
+
+class AppTestCase(unittest.TestCase):
+    # 每个测试一个临时目录里的 SQLite 文件：后台线程和 session 存储用的是连接池里的其他连接
+    config = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = type('Config', (TestConfig,), dict(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.tmpdir, 'test.db'),
+            AVATAR_CACHE_DIR=os.path.join(self.tmpdir, 'avatars'),
+            SEARCH_INDEX_PATH=os.path.join(self.tmpdir, 'search_index'),
+            **self.config))
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def client(self):
+        # main 蓝本的 before_request 要读 Accept-Language
+        client = self.app.test_client()
+        client.environ_base['HTTP_ACCEPT_LANGUAGE'] = 'en'
+        return client
+
+    def login(self, username, password='cat'):
+        user = User(username=username, email='{}@example.com'.format(username))
+        user.set_password(password)
+        db.session.add(user)
+        db.session.commit()
+        client = self.client()
+        response = client.post('/auth/login', data=dict(username=username, password=password))
+        self.assertEqual(response.status_code, 302)
+        return client
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubTranslationHandler(BaseHTTPRequestHandler):
+    """假的翻译服务：q 里带 slow 时超时，带 flaky 时前两次返回 503，带 down 时一直返回 503。"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        text = parse_qs(urlparse(self.path).query)['q'][0]
+        with server.lock:
+            server.hits.append(text)
+            server.ports.add(self.client_address[1])
+            attempt = server.hits.count(text)
+        if 'slow' in text:
+            time.sleep(1)
+        if 'down' in text or ('flaky' in text and attempt <= 2):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps([[['T:' + text]]]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TranslateCase(AppTestCase):
+    config = dict(TRANSLATION_TIMEOUT=(1, 0.3), TRANSLATION_RETRIES=2)
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubTranslationHandler)
+        self.server.hits = []
+        self.server.ports = set()
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = dict(self.config, TRANSLATION_SERVICE_API='http://127.0.0.1:{}/t'.format(
+            self.server.server_address[1]))
+        AppTestCase.setUp(self)
+
+    def tearDown(self):
+        translator.close(self.app)
+        AppTestCase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cache_and_persist(self):
+        self.assertEqual(translate('hello', 'en', 'zh'), 'T:hello')
+        self.assertEqual(translate('hello', 'en', 'zh'), 'T:hello')
+        self.assertEqual(self.server.hits, ['hello'])
+        # 清掉 LRU 之后从 translation 表里读
+        self.app.extensions['translator']['cache'].clear()
+        self.assertEqual(translate('hello', 'en', 'zh'), 'T:hello')
+        self.assertEqual(self.server.hits, ['hello'])
+
+    def test_batch(self):
+        translate('b', 'en', 'zh')
+        results = translate_many([('a', 'en'), ('b', 'en'), ('c', 'en'), ('down', 'en')], 'zh')
+        self.assertEqual(results, ['T:a', 'T:b', 'T:c', ERROR_TEXT])
+        self.assertEqual(sorted(set(self.server.hits)), ['a', 'b', 'c', 'down'])
+        self.assertEqual(self.server.hits.count('b'), 1)
+
+    def test_retry(self):
+        self.assertEqual(translate('flaky', 'en', 'zh'), 'T:flaky')
+        self.assertEqual(self.server.hits.count('flaky'), 3)
+
+    def test_retries_exhausted(self):
+        self.assertEqual(translate('down', 'en', 'zh'), ERROR_TEXT)
+        self.assertEqual(self.server.hits.count('down'), 3)
+        # 失败的结果不缓存
+        translate('down', 'en', 'zh')
+        self.assertEqual(self.server.hits.count('down'), 6)
+
+    def test_timeout(self):
+        self.app.config['TRANSLATION_RETRIES'] = 0
+        started = time.perf_counter()
+        self.assertEqual(translate('slow', 'en', 'zh'), ERROR_TEXT)
+        self.assertLess(time.perf_counter() - started, 0.9)
+
+    def test_connection_reuse(self):
+        for text in ('one', 'two', 'three', 'four'):
+            self.assertEqual(translate(text, 'en', 'zh'), 'T:' + text)
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_text_is_url_encoded(self):
+        text = 'a&tl=xx#b + c'
+        self.assertEqual(translate(text, 'en', 'zh'), 'T:' + text)
+        self.assertEqual(self.server.hits, [text])
+
+    def test_batch_endpoint(self):
+        client = self.login('susan')
+        response = client.post('/translate/batch', data=json.dumps({
+            'target_language': 'zh',
+            'items': [{'id': '1', 'text': 'a', 'source_language': 'en'},
+                      {'id': '2', 'text': 'b', 'source_language': 'auto'}]}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['translations'], {'1': 'T:a', '2': 'T:b'})
+
+    def test_batch_endpoint_rejects_bad_items(self):
+        client = self.login('susan')
+        for data in (['a'],
+                     {'target_language': 'zh', 'items': [{'text': 1, 'source_language': 'en'}]},
+                     {'target_language': 'zh', 'items': [{'text': 'a', 'source_language': 'english'}]},
+                     {'target_language': 'chinese', 'items': [{'text': 'a', 'source_language': 'en'}]},
+                     {'target_language': 'zh', 'items': ['a']}):
+            response = client.post('/translate/batch', data=json.dumps(data),
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 400, data)
+        self.assertEqual(self.server.hits, [])
+
+
+class LoginThrottleCase(AppTestCase):
+    def tearDown(self):
+        # login_throttle 是进程内共享的，别让后面的测试里 susan 登不上
+        login_throttle.reset('susan')
+        AppTestCase.tearDown(self)
+
+    def test_expired_keys_are_swept(self):
+        login_throttle.reset('alice')
+        window = self.app.config['LOGIN_ATTEMPT_WINDOW']
+        now = time.time()
+        with mock.patch('app_dir.passwords.time', return_value=now):
+            for i in range(500):
+                login_throttle.record_failure('user{}'.format(i), '10.0.{}.{}'.format(i // 256, i % 256))
+        self.assertGreaterEqual(len(login_throttle), 1000)
+        with mock.patch('app_dir.passwords.time', return_value=now + window + 1):
+            login_throttle.record_failure('alice', '10.1.0.1')
+        self.assertEqual(len(login_throttle), 2)
+        self.assertFalse(login_throttle.is_blocked('user1', '10.0.0.1'))
+
+    def post_login(self, client, username, password):
+        return client.post('/auth/login', data=dict(username=username, password=password),
+                           follow_redirects=True)
+
+    def test_login_blocked_after_max_attempts(self):
+        for name in ('susan', 'bob'):
+            user = User(username=name, email='{}@example.com'.format(name))
+            user.set_password('cat')
+            db.session.add(user)
+        db.session.commit()
+        client = self.client()
+        # 按 IP 的失败次数没有 reset，每个测试用自己的 IP
+        client.environ_base['REMOTE_ADDR'] = '10.9.0.1'
+        for _ in range(self.app.config['LOGIN_MAX_ATTEMPTS']):
+            self.assertIn(b'Invalid username or password.', self.post_login(client, 'susan', 'dog').data)
+        with mock.patch.object(User, 'check_password') as check_password:
+            response = self.post_login(client, 'susan', 'cat')
+        self.assertIn(b'Too many failed login attempts.', response.data)
+        check_password.assert_not_called()
+        # 同一个 IP 上的其他用户不受影响
+        self.assertNotIn(b'Too many', self.post_login(client, 'bob', 'cat').data)
+        self.assertEqual(client.get('/index').status_code, 200)
+
+    def test_api_token_blocked_after_max_attempts(self):
+        user = User(username='susan', email='susan@example.com')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        client = self.client()
+        client.environ_base['REMOTE_ADDR'] = '10.9.0.2'
+
+        def get_token(password):
+            auth = base64.b64encode('susan:{}'.format(password).encode('utf-8')).decode('ascii')
+            return client.post('/api/v1/tokens', headers={'Authorization': 'Basic ' + auth}).status_code
+        codes = [get_token('dog') for _ in range(self.app.config['LOGIN_MAX_ATTEMPTS'])]
+        self.assertEqual(set(codes), {401})
+        self.assertEqual(get_token('cat'), 429)
+
+
+class HashingBusyCase(AppTestCase):
+    config = dict(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE=1, PASSWORD_HASH_QUEUE_TIMEOUT=0.01)
+
+    def test_busy_hasher_returns_503(self):
+        db.session.add(User(username='susan', email='susan@example.com', password_hash='pbkdf2:sha256:1$a$b'))
+        db.session.commit()
+        client = self.client()
+        client.environ_base['REMOTE_ADDR'] = '10.9.0.3'
+        # 占住唯一的排队名额，后面的哈希计算等不到就抛出 HashingBusy
+        slots = self.app.extensions['password_hasher']._slots
+        slots.acquire()
+        try:
+            response = client.post('/auth/login', data=dict(username='susan', password='cat'))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '5')
+            self.assertIn('text/html', response.content_type)
+            auth = base64.b64encode(b'susan:cat').decode('ascii')
+            response = client.post('/api/v1/tokens', headers={'Authorization': 'Basic ' + auth})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.get_json()['error'], 'Service Unavailable')
+        finally:
+            slots.release()
+
+
+class SearchCase(AppTestCase):
+    backend = 'fts5'
+
+    def setUp(self):
+        self.config = dict(SEARCH_BACKEND=self.backend)
+        AppTestCase.setUp(self)
+        # create_all 不建 FTS5 虚拟表，部署时由迁移创建，这里用重建索引补上
+        search_index.reindex()
+        self.client = self.login('susan')
+
+    def test_post_is_saved_and_indexed(self):
+        response = self.client.post('/index', data=dict(post='the quick brown fox'))
+        self.assertEqual(response.status_code, 302)
+        db.session.remove()
+        post = Post.query.one()
+        self.assertEqual(post.author.posts_count, 1)
+        posts, _ = search_index.search('quick fox', 10)
+        self.assertEqual(posts, [post])
+        self.assertEqual(search_index.reindex(), 1)
+        posts, _ = search_index.search('brown', 10)
+        self.assertEqual([p.id for p in posts], [post.id])
+
+    def test_post_is_searchable_before_language_detection(self):
+        with mock.patch('app_dir.main.routes.language_detector.submit'):
+            self.client.post('/index', data=dict(post='the quick brown fox'))
+        posts, _ = search_index.search('fox', 10)
+        self.assertEqual([post.body for post in posts], ['the quick brown fox'])
+        self.assertIsNone(posts[0].language)
+
+    def add_post(self, body, language):
+        post = Post(body=body, language=language, author=User.query.filter_by(username='susan').one())
+        db.session.add(post)
+        db.session.flush()
+        search_index.add_posts([post])
+        db.session.commit()
+        return post
+
+    def test_query_drops_only_stopwords_of_its_language(self):
+        post = self.add_post('die hard is a great movie', 'en')
+        self.add_post('die Katze ist hier', 'de')
+        self.assertEqual(search_index.search('die hard', 10, language='en')[0], [post])
+        self.assertEqual(search_index.search('the movie', 10, language='en-US')[0], [post])
+        # 对德语界面 die 是停用词，只按 hard 检索
+        self.assertEqual(search_index.search('die hard', 10, language='de')[0], [post])
+        self.assertEqual(search_index.search('die', 10, language='de')[0], [])
+        response = self.client.get('/search?q=die', headers={'Accept-Language': 'en'})
+        self.assertIn(b'die hard is a great movie', response.data)
+
+    def test_paging(self):
+        posts = [self.add_post('quick post {}'.format(i), 'en') for i in range(5)]
+        seen = []
+        after = None
+        for _ in range(3):
+            page, after = search_index.search('quick', 2, after=after, language='en')
+            seen.extend(page)
+            if after is None:
+                break
+        self.assertEqual(sorted(post.id for post in seen), [post.id for post in posts])
+
+    def test_init_app_does_not_touch_database(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            create_app(type('Config', (TestConfig,), dict(
+                SQLALCHEMY_DATABASE_URI=self.app.config['SQLALCHEMY_DATABASE_URI'],
+                SEARCH_BACKEND=self.backend, SEARCH_INDEX_PATH=self.app.config['SEARCH_INDEX_PATH'])))
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        self.assertEqual(statements, [])
+
+
+class PythonSearchCase(SearchCase):
+    backend = 'python'
+
+    def tearDown(self):
+        search_index.backend.close()
+        SearchCase.tearDown(self)
+
+
+class ReplicaRoutingCase(AppTestCase):
+    def setUp(self):
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.config = dict(SQLALCHEMY_BINDS={'replica0': 'sqlite:///' + self.replica_path},
+                           SQLALCHEMY_REPLICAS=['replica0'], REPLICA_LAG_WINDOW=5)
+        AppTestCase.setUp(self)
+        # 副本是另一个数据库文件，内容和主库不同，从页面上就能看出查询发到了哪里
+        self.replica = db.get_engine(self.app, bind='replica0')
+        db.metadata.create_all(bind=self.replica)
+        self.web = self.login('susan')
+        user = User.query.filter_by(username='susan').one()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert().values(id=user.id, username='susan', email=user.email,
+                                                        password_hash=user.password_hash))
+            conn.execute(Post.__table__.insert().values(body='from the replica', user_id=user.id,
+                                                        timestamp=datetime.utcnow()))
+        self.token = user.generate_api_token(600)
+        # 测试里一直推着的 app context 会让各个请求共用一个 g，请求之间的 db_wrote 会串起来
+        db.session.remove()
+        self.app_context.pop()
+
+    def tearDown(self):
+        self.app_context.push()
+        AppTestCase.tearDown(self)
+        self.replica.dispose()
+        os.remove(self.replica_path)
+
+    def profile(self):
+        response = self.web.get('/user/susan')
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_get_reads_from_replica(self):
+        self.assertIn('from the replica', self.profile())
+
+    def test_reads_stay_on_primary_after_write(self):
+        self.assertEqual(self.web.post('/index', data=dict(post='from the primary')).status_code, 302)
+        page = self.profile()
+        self.assertIn('from the primary', page)
+        self.assertNotIn('from the replica', page)
+        # REPLICA_LAG_WINDOW 过去之后又回到副本
+        with mock.patch('app_dir.routing.time', return_value=time.time() + 6):
+            self.assertIn('from the replica', self.profile())
+
+    def test_request_switches_to_primary_after_writing(self):
+        primary = db.get_engine(self.app)
+        with self.app.test_request_context('/'):
+            self.assertIs(db.session.get_bind(clause=text('SELECT 1')), self.replica)
+            self.assertIs(db.session.get_bind(clause=User.__table__.update()), primary)
+            self.assertIs(db.session.get_bind(clause=text('SELECT 1')), primary)
+            db.session.remove()
+
+    def test_api_writes_do_not_create_a_session(self):
+        response = self.client().post('/api/v1/follows', headers={'Authorization': 'Bearer ' + self.token},
+                                      json={'follow': []})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def bind_for(self, clause):
+        with self.app.test_request_context('/'):
+            engine = db.session.get_bind(clause=clause)
+            db.session.remove()
+            return engine
+
+    def test_text_statements(self):
+        primary = db.get_engine(self.app)
+        replica = db.get_engine(self.app, bind='replica0')
+        self.assertIs(self.bind_for(text('SELECT 1')), replica)
+        self.assertIs(self.bind_for(text('  select rowid FROM post_search')), replica)
+        self.assertIs(self.bind_for(text('CREATE VIRTUAL TABLE temp.t USING fts5(x)')), primary)
+        self.assertIs(self.bind_for(text('DELETE FROM post_search')), primary)
+        self.assertIs(self.bind_for(User.__table__.update()), primary)
+
+
+class ServerSessionCase(AppTestCase):
+    config = dict(SESSION_BACKEND='sql')
+
+    @staticmethod
+    def sid(client):
+        for cookie in client.cookie_jar:
+            if cookie.name == 'session':
+                return cookie.value
+
+    def sids(self):
+        return {row.sid for row in WebSession.query}
+
+    def test_sid_rotates_on_login_and_logout(self):
+        client = self.client()
+        with client.session_transaction() as session:
+            session['before'] = 1
+        anonymous = self.sid(client)
+        self.assertEqual(self.sids(), {anonymous})
+        user = User(username='susan', email='susan@example.com')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        client.post('/auth/login', data=dict(username='susan', password='cat'))
+        logged_in = self.sid(client)
+        self.assertNotEqual(logged_in, anonymous)
+        self.assertEqual(self.sids(), {logged_in})
+        self.assertEqual(WebSession.query.get(logged_in).user_id, user.id)
+        client.get('/auth/logout')
+        self.assertNotIn(logged_in, self.sids())
+        self.assertNotEqual(self.sid(client), logged_in)
+
+    def test_password_reset_revokes_sessions(self):
+        phone = self.login('susan')
+        laptop = self.client()
+        laptop.post('/auth/login', data=dict(username='susan', password='cat'))
+        self.assertEqual(len(self.sids()), 2)
+        token = User.query.filter_by(username='susan').one().generate_reset_password_token()
+        response = self.client().post('/auth/reset_password/' + token,
+                                      data=dict(password='dog', repeated_password='dog'))
+        self.assertEqual(response.status_code, 302)
+        # 只剩下重置密码的这个客户端放 flash 消息的匿名 session
+        self.assertEqual([row.user_id for row in WebSession.query], [None])
+        for client in (phone, laptop):
+            self.assertEqual(client.get('/index').status_code, 302)
+
+    def test_idle_session_expires(self):
+        client = self.login('susan')
+        row = WebSession.query.one()
+        # 没勾“记住我”的 session 闲置 SESSION_IDLE_LIFETIME 后过期
+        lifetime = self.app.config['SESSION_IDLE_LIFETIME']
+        self.assertLess(abs(row.expires - datetime.utcnow() - lifetime), timedelta(minutes=1))
+        self.assertEqual(client.get('/index').status_code, 200)
+        row.expires = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        response = client.get('/index')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/auth/login', response.headers['Location'])
+
+    def test_sweeper_deletes_expired_sessions(self):
+        now = datetime.utcnow()
+        db.session.add_all([WebSession(sid='old{}'.format(i), data='{}', expires=now - timedelta(hours=1))
+                            for i in range(3)])
+        db.session.add(WebSession(sid='live', data='{}', expires=now + timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(server_sessions.sweep(), 3)
+        self.assertEqual(self.sids(), {'live'})
+
+        db.session.add(WebSession(sid='old', data='{}', expires=now - timedelta(hours=1)))
+        db.session.commit()
+        self.app.config['SESSION_SWEEP_INTERVAL'] = 0.05
+        self.login('susan')
+        try:
+            for _ in range(100):
+                db.session.rollback()
+                if 'old' not in self.sids():
+                    break
+                time.sleep(0.05)
+            self.assertNotIn('old', self.sids())
+            self.assertIn('live', self.sids())
+        finally:
+            server_sessions.stop(self.app)
+            self.app.extensions['server_sessions']['worker'].join()
+
+
+class ConditionalGetCase(AppTestCase):
+    # 用默认的 sql session 存储，304 里也算上读 web_session 的那条语句
+    config = dict(SESSION_BACKEND='sql')
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.client = self.login('susan')
+        self.client.post('/index', data=dict(post='hello'))
+        self.statements = []
+        event.listen(Engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        event.remove(Engine, 'before_cursor_execute', self.count_statement)
+        AppTestCase.tearDown(self)
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def revalidate(self, url):
+        # 第一次 GET 显示发 post 之后的 flash 消息，不带 ETag
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_revalidated_get_issues_one_query(self):
+        for url in ('/index', '/user/susan'):
+            response = self.revalidate(url)
+            del self.statements[:]
+            response = self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304, url)
+            sessions = [statement for statement in self.statements if 'FROM web_session' in statement]
+            self.assertEqual(len(sessions), 1, self.statements)
+            self.assertLessEqual(len(self.statements) - len(sessions), 1, '{}: {}'.format(url, self.statements))
+
+    def test_if_modified_since_alone_is_not_enough(self):
+        response = self.revalidate('/user/susan')
+        response = self.client.get('/user/susan', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_index_etag_changes_before_csrf_token_expires(self):
+        etag = self.revalidate('/index').headers['ETag']
+        later = time.time() + self.app.config.get('WTF_CSRF_TIME_LIMIT', 3600) / 2
+        with mock.patch('app_dir.main.decorators.time', return_value=later):
+            response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_explore_is_not_conditional(self):
+        self.assertNotIn('ETag', self.revalidate('/explore').headers)
+
+    def test_new_suggestions_change_index_etag(self):
+        self.client.get('/index')
+        etag = self.client.get('/index').headers['ETag']
+        bob = User(username='bob', email='bob@example.com')
+        db.session.add(bob)
+        db.session.commit()
+        suggestion_engine.save({User.query.filter_by(username='susan').one().id: [(bob.id, 1.0)]})
+        response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Who to follow', response.data)
+
+    def test_profile_loads_user_once(self):
+        del self.statements[:]
+        self.assertEqual(self.client.get('/user/susan').status_code, 200)
+        users = [statement for statement in self.statements if 'user.username = ' in statement]
+        self.assertEqual(len(users), 1, users)
+        self.assertEqual(self.client.get('/user/nobody').status_code, 404)
+
+    def test_profile_follows_queries(self):
+        db.session.add(User(username='bob', email='bob@example.com'))
+        db.session.commit()
+        for url, count, link in (('/user/susan', 0, b'Edit your profile'), ('/user/bob', 1, b'/follow/bob')):
+            del self.statements[:]
+            response = self.client.get(url)
+            self.assertIn(link, response.data)
+            follows = [statement for statement in self.statements if 'follows' in statement]
+            self.assertEqual(len(follows), count, follows)
+        self.client.get('/follow/bob')
+        self.assertIn(b'/unfollow/bob', self.client.get('/user/bob').data)
+
+
+class AvatarCase(AppTestCase):
+    def test_sizes(self):
+        client = self.client()
+        digest = email_digest('nobody@example.com')
+        for size in (24, 70, 128, 256):
+            self.assertEqual(client.get('/avatar/{}/{}'.format(digest, size)).status_code, 200)
+        for size in (0, 25, 512, 9999):
+            self.assertEqual(client.get('/avatar/{}/{}'.format(digest, size)).status_code, 404)
+
+    def test_only_existing_users_are_cached(self):
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        client = self.client()
+        cache_dir = self.app.config['AVATAR_CACHE_DIR']
+        response = client.get('/avatar/{}/70'.format(email_digest('nobody@example.com')))
+        self.assertEqual(response.data[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertFalse(os.path.exists(cache_dir) and os.listdir(cache_dir))
+        response = client.get('/avatar/{}/70'.format(email_digest('nobody@example.com')),
+                              headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        response = client.get('/avatar/{}/70'.format(email_digest('susan@example.com')))
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(os.listdir(cache_dir), ['{}-70.png'.format(email_digest('susan@example.com'))])
+
+
+class RateLimitCase(AppTestCase):
+    config = dict(RATELIMIT_BACKEND='local', RATELIMITS={
+        'api.get_token': '2/minute',
+        'api.update_follows': '2/minute',
+        'main.index:POST': '2/minute',
+        'main.index': '3/minute',
+        'auth.login': '2/minute',
+    })
+
+    def test_denied_hits_are_not_counted(self):
+        backend = MemoryBackend()
+        self.assertEqual(backend.hit([('a', 1, 60), ('b', 3, 60)]), 0)
+        for _ in range(3):
+            self.assertGreater(backend.hit([('a', 1, 60), ('b', 3, 60)]), 0)
+        self.assertEqual([backend.hit([('b', 3, 60)]) for _ in range(2)], [0, 0])
+        self.assertGreater(backend.hit([('b', 3, 60)]), 0)
+
+    def test_api_limits_are_per_token_user(self):
+        self.login('susan')
+        db.session.add(User(username='bob', email='bob@example.com'))
+        db.session.commit()
+        client = self.client()
+        auth = {'Authorization': 'Basic ' + base64.b64encode(b'susan:cat').decode('ascii')}
+        codes = [client.post('/api/v1/tokens', headers=auth).status_code for _ in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+        token = User.query.filter_by(username='susan').one().generate_api_token(600)
+        headers = {'Authorization': 'Bearer ' + token}
+        codes = [client.post('/api/v1/follows', headers=headers, json={}).status_code for _ in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+        # 同一个 IP 上的其他令牌用户不受影响
+        token = User.query.filter_by(username='bob').one().generate_api_token(600)
+        response = client.post('/api/v1/follows', headers={'Authorization': 'Bearer ' + token}, json={})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rejected_post_does_not_use_up_get_quota(self):
+        client = self.login('susan')
+        rate_limiter.reset()
+        codes = [client.post('/index', data=dict(post='hi')).status_code for _ in range(4)]
+        self.assertEqual(codes, [302, 302, 429, 429])
+        self.assertEqual(client.get('/index').status_code, 200)
+
+    def test_forwarded_for_ignored_without_trusted_proxies(self):
+        client = self.client()
+        codes = [client.get('/auth/login', headers={'X-Forwarded-For': '10.0.0.{}'.format(i)}).status_code
+                 for i in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+
+
+class TrustedProxyCase(AppTestCase):
+    config = dict(RATELIMIT_BACKEND='local', RATELIMITS={'auth.login': '2/minute'}, TRUSTED_PROXIES=1)
+
+    def get_login(self, forwarded_for):
+        return self.client().get('/auth/login', headers={'X-Forwarded-For': forwarded_for}).status_code
+
+    def test_clients_are_keyed_on_forwarded_for(self):
+        codes = [self.get_login('1.1.1.1, 10.0.0.1') for _ in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+        # 只信任最后一层代理加上的地址，客户端自己伪造的前几项不起作用
+        self.assertEqual(self.get_login('2.2.2.2, 10.0.0.1'), 429)
+        self.assertEqual(self.get_login('10.0.0.2'), 200)
+
+
+class ApiFollowsCase(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.client = self.login('susan')
+        for name in ('bob', 'carol'):
+            db.session.add(User(username=name, email='{}@example.com'.format(name)))
+        db.session.commit()
+        self.ids = {user.username: user.id for user in User.query}
+        token = User.query.get(self.ids['susan']).generate_api_token(600)
+        self.headers = {'Authorization': 'Bearer ' + token}
+
+    def update(self, body):
+        return self.client.post('/api/v1/follows', headers=self.headers, json=body)
+
+    def test_rejects_malformed_bodies(self):
+        for body in ([1, 2], {'follow': '12'}, {'follow': {'1': 1}}, {'follow': [True]},
+                     {'follow': [1.5]}, {'follow': None}, {'follow': [1], 'unfollow': [1]}):
+            self.assertEqual(self.update(body).status_code, 400, body)
+
+    def test_reports_changed_ids(self):
+        bob, carol = self.ids['bob'], self.ids['carol']
+        self.assertEqual(self.update({'follow': [bob]}).get_json()['followed'], [bob])
+        data = self.update({'follow': [bob, carol, 999]}).get_json()
+        self.assertEqual(data, {'followed': [carol], 'unfollowed': [], 'not_found': [999]})
+        data = self.update({'unfollow': [bob, bob]}).get_json()
+        self.assertEqual(data['unfollowed'], [bob])
+        self.assertEqual(self.update({'unfollow': [bob]}).get_json()['unfollowed'], [])
+
+    def statements(self, body):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement.split()[0] + ' ' + statement.split()[2])
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(self.update(body).status_code, 200)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        return statements
+
+    def test_bulk_changes_use_one_statement(self):
+        bob, carol = self.ids['bob'], self.ids['carol']
+        self.update({'follow': [bob]})
+        statements = self.statements({'follow': [bob, carol]})
+        self.assertEqual(statements.count('INSERT follows'), 1)
+        statements = self.statements({'unfollow': [bob, carol]})
+        self.assertEqual(statements.count('DELETE follows'), 1)
+        db.session.expire_all()
+        counts = [(user.username, user.fans_count, user.stars_count) for user in User.query.order_by(User.id)]
+        self.assertEqual(counts, [('susan', 0, 0), ('bob', 0, 0), ('carol', 0, 0)])
+
+    def test_timeline_rebuild_skips_posts_without_author(self):
+        bob = self.ids['bob']
+        self.update({'follow': [bob]})
+        db.session.add_all([Post(body='mine', user_id=self.ids['susan']), Post(body='bob', user_id=bob),
+                            Post(body='orphan')])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+        entries = {(entry.user_id, Post.query.get(entry.post_id).body) for entry in TimelineEntry.query}
+        self.assertEqual(entries, {(self.ids['susan'], 'mine'), (self.ids['susan'], 'bob'), (bob, 'bob')})
+
+
+class LastSeenCase(AppTestCase):
+    config = dict(LAST_SEEN_FLUSH_INTERVAL=60, LAST_SEEN_THROTTLE=0)
+
+    def test_buffer_is_per_app(self):
+        user = User(username='susan', email='susan@example.com')
+        db.session.add(user)
+        db.session.commit()
+        when = datetime(2020, 1, 2, 3, 4, 5)
+        self.assertTrue(last_seen.touch(user.id, when))
+        self.assertEqual(last_seen.stats()['buffer_size'], 1)
+        other = create_app(type('Config', (TestConfig,), dict(SQLALCHEMY_DATABASE_URI='sqlite://')))
+        with other.app_context():
+            self.assertEqual(last_seen.stats()['buffer_size'], 0)
+        # 停掉这个 app 的后台线程时把缓冲区写回
+        last_seen.stop(self.app)
+        self.app.extensions['last_seen']['worker'].join()
+        self.assertEqual(last_seen.stats(), dict(last_seen.stats(), buffer_size=0, flushed_rows=1))
+        db.session.expire_all()
+        self.assertEqual(User.query.get(user.id).last_seen, when)
+
+
+class FeedBudgetCase(AppTestCase):
+    config = dict(LAST_SEEN_THROTTLE=3600)
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.client = self.login('susan')
+        # 一页上每条 post 的作者都不同，作者按 N+1 加载时语句数会超过预算
+        per_page = self.app.config['POSTS_PER_PAGE']
+        for i in range(per_page + 2):
+            name = 'user{}'.format(i)
+            user = User(username=name, email='{}@example.com'.format(name))
+            db.session.add_all([user, Post(body=name, author=user)])
+            db.session.commit()
+            self.client.get('/follow/' + name)
+        self.client.post('/index', data=dict(post='mine'))
+
+    def test_feeds_stay_within_budget(self):
+        self.assertIsNotNone(self.app.config['FEED_SQL_BUDGET'])
+        for url in ('/index', '/explore', '/user/user0'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+        # 下一页也用同样的预算
+        for url in ('/index', '/explore'):
+            match = re.search(r'href="(/[^"]*before=[^"]+)"', self.client.get(url).get_data(as_text=True))
+            self.assertEqual(self.client.get(match.group(1).replace('&amp;', '&')).status_code, 200)
+
+    def test_n_plus_one_breaks_budget(self):
+        self.app.config['POST_AUTHOR_LOADING'] = 'lazy'
+        with self.assertRaisesRegex(AssertionError, 'main.explore issued \\d+ SQL statements'):
+            self.client.get('/explore')
+
+
+class KeysetPaginationCase(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        user = User(username='susan', email='susan@example.com')
+        start = datetime(2020, 1, 1)
+        # 最后两条时间相同，按 id 区分先后
+        self.posts = [Post(body=str(i), author=user, timestamp=start + timedelta(minutes=min(i, 3)))
+                      for i in range(5)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+    def bodies(self, page):
+        return [post.body for post in page.items]
+
+    def test_walk_older_and_back(self):
+        pages = []
+        page = keyset_paginate(Post.query, 2)
+        self.assertFalse(page.has_prev)
+        while True:
+            pages.append(self.bodies(page))
+            if not page.has_next:
+                break
+            page = keyset_paginate(Post.query, 2, before=page.next_cursor)
+        self.assertEqual(pages, [['4', '3'], ['2', '1'], ['0']])
+        back = []
+        while page.has_prev:
+            page = keyset_paginate(Post.query, 2, after=page.prev_cursor)
+            back.append(self.bodies(page))
+        self.assertEqual(back, [['2', '1'], ['4', '3']])
+
+    def test_empty_after_page_links_back(self):
+        second = keyset_paginate(Post.query, 2, before=keyset_paginate(Post.query, 2).next_cursor)
+        self.assertEqual(self.bodies(second), ['2', '1'])
+        # 比第二页新的 post 都被删掉了，“上一页”是空的，但要能回到第二页
+        Post.query.filter(Post.body.in_(['3', '4'])).delete(synchronize_session=False)
+        db.session.commit()
+        page = keyset_paginate(Post.query, 2, after=second.prev_cursor)
+        self.assertEqual(page.items, [])
+        self.assertFalse(page.has_prev)
+        self.assertEqual(self.bodies(keyset_paginate(Post.query, 2, before=page.next_cursor)), ['2', '1'])
+
+    def test_empty_before_page_links_back(self):
+        first = keyset_paginate(Post.query, 2)
+        Post.query.filter(Post.body.in_(['0', '1', '2'])).delete(synchronize_session=False)
+        db.session.commit()
+        page = keyset_paginate(Post.query, 2, before=first.next_cursor)
+        self.assertEqual(page.items, [])
+        self.assertFalse(page.has_next)
+        self.assertEqual(self.bodies(keyset_paginate(Post.query, 2, after=page.prev_cursor)), ['4', '3'])
+
+    def test_bad_cursor_is_first_page(self):
+        page = keyset_paginate(Post.query, 2, before='not-a-cursor')
+        self.assertEqual(self.bodies(page), ['4', '3'])
+        self.assertFalse(page.has_prev)
+
+
+class FakeMail(object):
+    """假的 Flask-Mail：failures 里按主题排好每次发送要抛的异常（None 表示发送成功）。"""
+
+    def __init__(self, failures=None, refuse=False):
+        self.failures = failures or {}
+        self.refuse = refuse
+        self.sent = []
+        self.connections = 0
+
+    def connect(self):
+        if self.refuse:
+            raise ConnectionRefusedError(111, 'Connection refused')
+        self.connections += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, message):
+        errors = self.failures.get(message.subject)
+        error = errors.pop(0) if errors else None
+        if error is not None:
+            raise error
+        self.sent.append(message.subject)
+
+
+class EmailQueueCase(AppTestCase):
+    config = dict(EMAIL_MAX_ATTEMPTS=2, EMAIL_RETRY_BACKOFF=30, EMAIL_JOB_LEASE=600)
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        for subject in ('a', 'b', 'c'):
+            send_email(subject, 'admin@example.com', ['susan@example.com'], subject, subject)
+
+    def jobs(self):
+        db.session.expire_all()
+        return {job.subject: (job.status, job.attempts) for job in EmailJob.query}
+
+    def process(self, mail):
+        with mock.patch('app_dir.email.get_mail', return_value=mail):
+            return process_email_jobs(10)
+
+    def test_claim_is_exclusive(self):
+        first = claim_email_jobs(2)
+        self.assertEqual([job.subject for job in first], ['a', 'b'])
+        self.assertEqual([job.subject for job in claim_email_jobs(2)], ['c'])
+        self.assertEqual(claim_email_jobs(2), [])
+        self.assertEqual({status for status, _ in self.jobs().values()}, {'sending'})
+
+    def test_expired_lease_is_requeued(self):
+        claim_email_jobs(3)
+        EmailJob.query.filter_by(subject='b').update(
+            {'claimed_at': datetime.utcnow() - timedelta(seconds=601)})
+        db.session.commit()
+        self.assertEqual([job.subject for job in claim_email_jobs(3)], ['b'])
+
+    def test_failed_send_is_retried_with_backoff(self):
+        mail = FakeMail({'b': [ValueError('rejected'), ValueError('rejected')]})
+        self.assertEqual(self.process(mail), 3)
+        self.assertEqual(mail.sent, ['a', 'c'])
+        self.assertEqual(self.jobs(), {'a': ('sent', 0), 'b': ('queued', 1), 'c': ('sent', 0)})
+        job = EmailJob.query.filter_by(subject='b').one()
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=25))
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.process(mail)
+        self.assertEqual(self.jobs()['b'], ('failed', 2))
+
+    def test_disconnect_reconnects_once(self):
+        mail = FakeMail({'b': [SMTPServerDisconnected('gone')]})
+        self.assertEqual(self.process(mail), 3)
+        self.assertEqual(mail.connections, 2)
+        self.assertEqual(mail.sent, ['a', 'b', 'c'])
+        self.assertEqual(self.jobs(), {'a': ('sent', 0), 'b': ('sent', 0), 'c': ('sent', 0)})
+
+    def test_second_disconnect_ends_batch_without_counting_attempts(self):
+        mail = FakeMail({'b': [SMTPServerDisconnected('gone'), SMTPServerDisconnected('gone')]})
+        self.process(mail)
+        self.assertEqual(mail.sent, ['a'])
+        self.assertEqual(self.jobs(), {'a': ('sent', 0), 'b': ('queued', 0), 'c': ('queued', 0)})
+
+    def test_connection_refused_does_not_count_attempts(self):
+        self.process(FakeMail(refuse=True))
+        self.assertEqual(self.jobs(), {'a': ('queued', 0), 'b': ('queued', 0), 'c': ('queued', 0)})
+        # 放回队列后等 EMAIL_RETRY_BACKOFF 秒再试，不会马上又被领走
+        self.assertEqual(claim_email_jobs(3), [])
+
+
+class DictRedis(object):
+    """测试用的 Redis 客户端，只实现缓存用到的几个命令，值和真的 Redis 一样以 bytes 返回。"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value.encode('utf-8') if isinstance(value, str) else value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.data) if key.startswith(pattern.rstrip('*'))]
+
+
+class RedisUserCacheCase(AppTestCase):
+    config = dict(USER_CACHE_BACKEND='redis')
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.app.redis = DictRedis()
+        self.client = self.login('susan')
+        self.id = User.query.filter_by(username='susan').one().id
+        db.session.remove()
+
+    def cached(self):
+        raw = self.app.redis.get('user:{}'.format(self.id))
+        return json.loads(raw.decode('utf-8')) if raw is not None else None
+
+    def test_json_without_password_hash(self):
+        with self.app.test_request_context():
+            user = user_cache.get_user(self.id)
+            self.assertIsNotNone(self.cached())
+            self.assertNotIn('password_hash', self.cached())
+            db.session.remove()
+            user = user_cache.get_user(self.id)
+            self.assertEqual(user.username, 'susan')
+            self.assertIsInstance(user.last_seen, datetime)
+            self.assertTrue(user.check_password('cat'))
+        self.assertEqual(self.client.get('/user/susan').status_code, 200)
+
+    def load(self):
+        with self.app.test_request_context():
+            user_cache.get_user(self.id)
+            db.session.remove()
+        self.assertIsNotNone(self.cached())
+
+    def test_bulk_writes_invalidate(self):
+        self.load()
+        self.app.config['LAST_SEEN_THROTTLE'] = 0
+        self.assertTrue(last_seen.touch(self.id))
+        self.assertIsNone(self.cached())
+        self.load()
+        user_cache.clear()
+        self.assertIsNone(self.cached())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)